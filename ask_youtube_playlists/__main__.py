@@ -0,0 +1,6 @@
+"""Allows running the command-line interface with `python -m`."""
+import sys
+
+from ask_youtube_playlists.cli import main
+
+sys.exit(main())
@@ -0,0 +1,439 @@
+"""Pluggable caching of expensive function calls.
+
+Functions decorated with `cache_data` delegate to the active `CacheBackend`
+every time they are called:
+
+- `MemoryCache` (the default) keeps a bounded, process-local LRU cache and
+  does not need Streamlit at all, which makes it the right choice for scripts
+  and batch workers.
+- `StreamlitCache` uses `st.cache_data`. The web application selects it with
+  `set_cache_backend(StreamlitCache())`.
+- `SQLiteCache` keeps the results in a SQLite file, so they survive restarts
+  and are shared by every process that opens the same file, e.g. the
+  replicas of the web application and the batch workers. The entries expire
+  after a TTL and the least recently used ones are evicted beyond a maximum
+  number of entries. A hit does not write to the file, so the processes
+  only take turns when they store new results.
+- `NoCache` disables caching.
+
+The batched functions, which answer many (question, context) pairs at once,
+cannot be wrapped as a whole: they look up each item with `get_many` and
+only compute the missing ones, then store them with `set_many`.
+
+Streamlit is only imported when the `StreamlitCache` is used.
+"""
+import collections
+import functools
+import hashlib
+import inspect
+import os
+import pickle
+import sqlite3
+import threading
+import time
+from typing import (Any, Callable, Dict, Hashable, List, Optional,
+                    Sequence, TypeVar, Union)
+
+from ask_youtube_playlists import instrumentation
+
+F = TypeVar("F", bound=Callable[..., Any])
+
+# Returned by the lookups when there is no entry, as None is a valid result
+_MISSING = object()
+
+
+class CacheBackend:
+    """Base class of the cache backends."""
+
+    def wrap(self, func: Callable) -> Callable:
+        """Returns a cached version of `func`."""
+        raise NotImplementedError
+
+    def get_many(self, function: str, keys: Sequence[Hashable]
+                 ) -> Dict[Hashable, Any]:
+        """Returns the cached results of the items of a batched function.
+
+        Args:
+            function (str): The name of the function.
+            keys (Sequence[Hashable]): The picklable key of each item.
+
+        Returns:
+            Dict[Hashable, Any]: The results of the keys that are cached.
+        """
+        return {}
+
+    def set_many(self, function: str, results: Dict[Hashable, Any]) -> None:
+        """Stores the results of the items of a batched function, by key."""
+
+
+class NoCache(CacheBackend):
+    """Backend that calls the functions every time."""
+
+    def wrap(self, func: Callable) -> Callable:
+        return func
+
+
+class MemoryCache(CacheBackend):
+    """Process-local LRU cache keyed by the pickled arguments.
+
+    Calls whose arguments cannot be pickled are not cached.
+
+    Args:
+        maxsize (int): The maximum number of results kept per function.
+            Defaults to 128.
+    """
+
+    def __init__(self, maxsize: int = 128):
+        self.maxsize = maxsize
+        self._items: Dict[str, collections.OrderedDict] = {}
+        self._items_lock = threading.Lock()
+
+    @staticmethod
+    def _make_key(args: tuple, kwargs: dict) -> Optional[Hashable]:
+        try:
+            pickled = pickle.dumps((args, sorted(kwargs.items())))
+        except (pickle.PicklingError, TypeError, AttributeError):
+            return None
+        return hashlib.sha256(pickled).hexdigest()
+
+    def get_many(self, function: str, keys: Sequence[Hashable]
+                 ) -> Dict[Hashable, Any]:
+        with self._items_lock:
+            results = self._items.get(function)
+            if results is None:
+                return {}
+            hits = {key: results[key] for key in keys if key in results}
+            for key in hits:
+                results.move_to_end(key)
+        return hits
+
+    def set_many(self, function: str, results: Dict[Hashable, Any]) -> None:
+        with self._items_lock:
+            items = self._items.setdefault(function,
+                                           collections.OrderedDict())
+            items.update(results)
+            while len(items) > self.maxsize:
+                items.popitem(last=False)
+
+    def wrap(self, func: Callable) -> Callable:
+        results: collections.OrderedDict = collections.OrderedDict()
+        lock = threading.Lock()
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            key = self._make_key(args, kwargs)
+            if key is None:
+                return func(*args, **kwargs)
+            with lock:
+                if key in results:
+                    results.move_to_end(key)
+                    return results[key]
+            result = func(*args, **kwargs)
+            with lock:
+                results[key] = result
+                if len(results) > self.maxsize:
+                    results.popitem(last=False)
+            return result
+
+        return wrapper
+
+
+def _fingerprint(value: Any) -> Any:
+    """Replaces the documents inside a value by a short fingerprint.
+
+    A document is identified by the video and position of the chunk and by
+    the hash of its text, so the key does not grow with the context and a
+    chunk that changes after re-chunking is not mistaken for the old one.
+    """
+    if isinstance(value, (list, tuple)):
+        return type(value)(_fingerprint(item) for item in value)
+    if hasattr(value, "page_content") and hasattr(value, "metadata"):
+        text_hash = hashlib.sha256(
+            value.page_content.encode("utf-8")
+        ).hexdigest()
+        return ("document", value.metadata.get("url"),
+                value.metadata.get("index"), text_hash)
+    return value
+
+
+class SQLiteCache(CacheBackend):
+    """Persistent cache stored in a SQLite file.
+
+    The key of a call is the hash of its bound arguments, including the
+    defaults, with the documents replaced by their fingerprint. For the
+    answering functions, it is made of the model, the generation parameters,
+    the question and the chunks of the context.
+
+    SQLite allows one writer at a time, so the lookups avoid writing:
+
+    - Hits and misses are counted in memory and added to the counts of the
+      file every `stats_flush_interval` seconds and by `stats`, so `stats`
+      reports the hit rate of every process that shares the cache, up to
+      their last flush.
+    - The access time of an entry is only updated if it is older than
+      `touch_interval` seconds, so the eviction order is approximate.
+    - The entries are counted in memory, and the least recently used are
+      only evicted once there are `max_entries // 10` entries too many.
+
+    Args:
+        path (Union[str, os.PathLike]): The SQLite file. It is created if it
+            does not exist.
+        ttl (float, optional): The number of seconds an entry is valid.
+            Defaults to no expiration.
+        max_entries (int): The maximum number of entries. The least recently
+            used are evicted first. Defaults to 10000.
+        touch_interval (float): The number of seconds before the access time
+            of an entry is updated again. Defaults to 60.
+        stats_flush_interval (float): The number of seconds between two
+            writes of the hit and miss counts. Defaults to 10.
+    """
+
+    def __init__(self,
+                 path: Union[str, os.PathLike],
+                 ttl: Optional[float] = None,
+                 max_entries: int = 10_000,
+                 touch_interval: float = 60.0,
+                 stats_flush_interval: float = 10.0):
+        self.path = os.fspath(path)
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.touch_interval = touch_interval
+        self.stats_flush_interval = stats_flush_interval
+        self._local = threading.local()
+        # The hits and misses of each function since the last flush
+        self._counts: Dict[str, List[int]] = {}
+        self._counts_lock = threading.Lock()
+        self._last_flush = time.monotonic()
+        with self._connect() as connection:
+            connection.execute(
+                "CREATE TABLE IF NOT EXISTS entries ("
+                "function TEXT, key TEXT, value BLOB, created REAL, "
+                "accessed REAL, PRIMARY KEY (function, key))"
+            )
+            connection.execute(
+                "CREATE INDEX IF NOT EXISTS entries_accessed "
+                "ON entries (accessed)"
+            )
+            connection.execute(
+                "CREATE TABLE IF NOT EXISTS stats ("
+                "function TEXT PRIMARY KEY, hits INTEGER, misses INTEGER)"
+            )
+            self._n_entries = connection.execute(
+                "SELECT COUNT(*) FROM entries"
+            ).fetchone()[0]
+
+    def _connect(self) -> sqlite3.Connection:
+        """Returns the connection of the current thread."""
+        connection = getattr(self._local, "connection", None)
+        if connection is None:
+            connection = sqlite3.connect(self.path, timeout=30)
+            connection.execute("PRAGMA journal_mode=WAL")
+            self._local.connection = connection
+        return connection
+
+    @staticmethod
+    def _make_key(func: Callable, args: tuple, kwargs: dict
+                  ) -> Optional[str]:
+        try:
+            bound = inspect.signature(func).bind(*args, **kwargs)
+            bound.apply_defaults()
+            pickled = pickle.dumps(sorted(
+                (name, _fingerprint(value))
+                for name, value in bound.arguments.items()
+            ))
+        except (pickle.PicklingError, TypeError, AttributeError):
+            return None
+        return hashlib.sha256(pickled).hexdigest()
+
+    def _count(self, function: str, hit: bool) -> None:
+        with self._counts_lock:
+            counts = self._counts.setdefault(function, [0, 0])
+            counts[0 if hit else 1] += 1
+            is_due = time.monotonic() - self._last_flush >= \
+                self.stats_flush_interval
+        if is_due:
+            self.flush_stats()
+        instrumentation.increment("cache.hits" if hit else "cache.misses")
+
+    def flush_stats(self) -> None:
+        """Adds the hits and misses counted since the last flush to the
+        counts of the file."""
+        with self._counts_lock:
+            counts, self._counts = self._counts, {}
+            self._last_flush = time.monotonic()
+        if not counts:
+            return
+        with self._connect() as connection:
+            connection.executemany(
+                "INSERT INTO stats VALUES (?, ?, ?) ON CONFLICT(function) DO "
+                "UPDATE SET hits = hits + ?, misses = misses + ?",
+                [(function, hits, misses, hits, misses)
+                 for function, (hits, misses) in counts.items()],
+            )
+
+    def get(self, function: str, key: str, default: Any = None) -> Any:
+        """Returns the cached result of a call, or `default` if it is
+        missing or expired."""
+        now = time.time()
+        with self._connect() as connection:
+            row = connection.execute(
+                "SELECT value, created, accessed FROM entries "
+                "WHERE function = ? AND key = ?", (function, key)
+            ).fetchone()
+            if row is None:
+                return default
+            value, created, accessed = row
+            if self.ttl is not None and now - created > self.ttl:
+                connection.execute(
+                    "DELETE FROM entries WHERE function = ? AND key = ?",
+                    (function, key)
+                )
+                return default
+            if now - accessed > self.touch_interval:
+                connection.execute(
+                    "UPDATE entries SET accessed = ? "
+                    "WHERE function = ? AND key = ?", (now, function, key)
+                )
+        return pickle.loads(value)
+
+    def set(self, function: str, key: str, value: Any) -> None:
+        """Stores the result of a call, and evicts the least recently used
+        entries beyond `max_entries` once there are enough of them."""
+        now = time.time()
+        with self._connect() as connection:
+            connection.execute(
+                "INSERT OR REPLACE INTO entries VALUES (?, ?, ?, ?, ?)",
+                (function, key, pickle.dumps(value), now, now),
+            )
+            # Replaced entries and the entries of the other processes make
+            # the count approximate, so it is corrected after each eviction
+            self._n_entries += 1
+            if self._n_entries <= self.max_entries + self.max_entries // 10:
+                return
+            connection.execute(
+                "DELETE FROM entries WHERE rowid IN (SELECT rowid FROM "
+                "entries ORDER BY accessed DESC LIMIT -1 OFFSET ?)",
+                (self.max_entries,)
+            )
+            self._n_entries = connection.execute(
+                "SELECT COUNT(*) FROM entries"
+            ).fetchone()[0]
+
+    @staticmethod
+    def _hash_key(key: Hashable) -> str:
+        return hashlib.sha256(pickle.dumps(key)).hexdigest()
+
+    def get_many(self, function: str, keys: Sequence[Hashable]
+                 ) -> Dict[Hashable, Any]:
+        hits = {}
+        for key in keys:
+            result = self.get(function, self._hash_key(key), _MISSING)
+            self._count(function, hit=result is not _MISSING)
+            if result is not _MISSING:
+                hits[key] = result
+        return hits
+
+    def set_many(self, function: str, results: Dict[Hashable, Any]) -> None:
+        for key, result in results.items():
+            self.set(function, self._hash_key(key), result)
+
+    def stats(self) -> Dict[str, Dict[str, float]]:
+        """Returns the hits, misses and hit rate of each function."""
+        self.flush_stats()
+        with self._connect() as connection:
+            rows = connection.execute(
+                "SELECT function, hits, misses FROM stats"
+            ).fetchall()
+        return {function: {"hits": hits,
+                           "misses": misses,
+                           "hit_rate": hits / max(hits + misses, 1)}
+                for function, hits, misses in rows}
+
+    def clear(self) -> None:
+        """Removes every entry and resets the counters."""
+        with self._counts_lock:
+            self._counts = {}
+        with self._connect() as connection:
+            connection.execute("DELETE FROM entries")
+            connection.execute("DELETE FROM stats")
+        self._n_entries = 0
+
+    def wrap(self, func: Callable) -> Callable:
+        function = f"{func.__module__}.{func.__qualname__}"
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            key = self._make_key(func, args, kwargs)
+            if key is None:
+                return func(*args, **kwargs)
+            result = self.get(function, key, _MISSING)
+            self._count(function, hit=result is not _MISSING)
+            if result is _MISSING:
+                result = func(*args, **kwargs)
+                self.set(function, key, result)
+            return result
+
+        return wrapper
+
+
+class StreamlitCache(CacheBackend):
+    """Backend that uses `st.cache_data`.
+
+    The items of the batched functions are kept in a process-local
+    `MemoryCache`, like `st.cache_data` does.
+    """
+
+    def __init__(self) -> None:
+        self._items = MemoryCache()
+
+    def wrap(self, func: Callable) -> Callable:
+        import streamlit as st
+        return st.cache_data(func)
+
+    def get_many(self, function: str, keys: Sequence[Hashable]
+                 ) -> Dict[Hashable, Any]:
+        return self._items.get_many(function, keys)
+
+    def set_many(self, function: str, results: Dict[Hashable, Any]) -> None:
+        self._items.set_many(function, results)
+
+
+_backend: CacheBackend = MemoryCache()
+
+
+def get_cache_backend() -> CacheBackend:
+    """Returns the active cache backend."""
+    return _backend
+
+
+def set_cache_backend(backend: CacheBackend) -> None:
+    """Sets the cache backend used by the functions decorated with
+    `cache_data`.
+
+    Each function keeps the results cached by previous backends, so switching
+    back to a backend reuses them.
+    """
+    global _backend
+    _backend = backend
+
+
+def cache_data(func: F) -> F:
+    """Caches the results of a function with the active backend.
+
+    The backend is looked up on every call, so it can be selected after the
+    decorated function has been imported.
+
+    Args:
+        func (Callable): The function to cache.
+    """
+    wrapped_by_backend: Dict[CacheBackend, Callable] = {}
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        backend = _backend
+        cached_func = wrapped_by_backend.get(backend)
+        if cached_func is None:
+            cached_func = wrapped_by_backend[backend] = backend.wrap(func)
+        return cached_func(*args, **kwargs)
+
+    return wrapper  # type: ignore
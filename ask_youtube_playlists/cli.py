@@ -0,0 +1,606 @@
+"""Command-line interface to ingest playlists and answer questions in batch.
+
+It works over the same layout as the web application::
+
+    data/<playlist>/raw/Video_<i>.json (or .npz, see `migrate-raw`)
+    data/<playlist>/<model>_<chunk_size>_<overlap>/
+
+Examples::
+
+    ask-youtube-playlists download "<playlist url>" --name huberman
+    ask-youtube-playlists migrate-raw huberman --remove-json
+    ask-youtube-playlists embed huberman --model msmarco-MiniLM-L-6-v3
+    ask-youtube-playlists sync --model msmarco-MiniLM-L-6-v3 --workers 4
+    ask-youtube-playlists ask questions.txt \\
+        --retriever huberman/msmarco-MiniLM-L-6-v3_320_64 \\
+        --mode extractive --workers 8 --output answers.jsonl
+
+Each line of the output of `ask` is a question record with its `documents`,
+in the format of `DocumentInfo.to_dict` (the same as the HTTP service), and
+its `answers` or `answer`.
+"""
+import argparse
+import concurrent.futures
+import json
+import logging
+import pathlib
+import sys
+from typing import Any, Dict, Iterator, List, Optional, Sequence
+
+import dotenv
+
+from ask_youtube_playlists import caching, instrumentation
+from ask_youtube_playlists.data_processing import (
+    create_embeddings_pipeline,
+    download_playlist,
+    get_max_chunk_tokens,
+    get_raw_transcript_paths,
+    get_retriever_directory_name,
+    is_youtube_playlist,
+    migrate_raw_directory,
+    CHUNKING_MODES,
+    RAW_FORMATS,
+    VECTOR_STORE_TYPES,
+)
+from ask_youtube_playlists.question_answering import (
+    Retriever,
+    get_extractive_answers,
+    get_generative_answer,
+    rerank,
+    search_extractive_answers,
+    set_scoring_workers,
+)
+from ask_youtube_playlists.reporting import LoggingReporter
+
+logger = logging.getLogger("ask_youtube_playlists")
+
+DEFAULT_EMBEDDING_MODEL = "msmarco-MiniLM-L-6-v3"
+DEFAULT_MAX_CHUNK_SIZE = 320
+DEFAULT_MIN_OVERLAP_SIZE = 64
+MODES = ["retrieve", "extractive", "generative"]
+
+
+def read_questions(questions_path: pathlib.Path) -> List[Dict[str, Any]]:
+    """Reads the questions to answer.
+
+    Files with the `.jsonl` extension must contain a JSON object per line
+    with, at least, a `question` field. Any other field (e.g. an `id`) is
+    copied to the output. Other files are read as plain text with a question
+    per line. Empty lines are skipped in both formats.
+
+    Args:
+        questions_path (pathlib.Path): The path to the questions file.
+
+    Raises:
+        KeyError: If a JSON line does not have a `question` field.
+    """
+    records = []
+    with open(questions_path, "r", encoding="utf-8") as file:
+        for line in file:
+            line = line.strip()
+            if not line:
+                continue
+            if questions_path.suffix != ".jsonl":
+                records.append({"question": line})
+                continue
+            record = json.loads(line)
+            if "question" not in record:
+                raise KeyError(f"Key question not found in line {line}.")
+            records.append(record)
+    return records
+
+
+def _batched(items: Sequence, batch_size: int) -> Iterator[Sequence]:
+    """Yields consecutive slices of `items` of at most `batch_size`."""
+    for start in range(0, len(items), batch_size):
+        yield items[start:start + batch_size]
+
+
+def _resolve_retriever_directory(data_directory: pathlib.Path,
+                                 retriever: str) -> pathlib.Path:
+    """Returns the retriever directory, which may be relative to the data
+    directory (`<playlist>/<model>_<chunk_size>_<overlap>`)."""
+    path = pathlib.Path(retriever)
+    if (path / "hyperparams.yaml").exists():
+        return path
+    return data_directory / retriever
+
+
+def _get_playlist_directories(data_directory: pathlib.Path,
+                              playlists: Sequence[str]
+                              ) -> List[pathlib.Path]:
+    """Returns the directories of the given playlists or, if none is given,
+    of every playlist with a `raw` directory."""
+    if playlists:
+        return [data_directory / playlist for playlist in playlists]
+    return sorted(directory.parent
+                  for directory in data_directory.glob("*/raw")
+                  if directory.is_dir())
+
+
+def is_retriever_outdated(retriever_directory: pathlib.Path) -> bool:
+    """Returns whether the embeddings of a retriever are missing or older
+    than the raw transcripts of its playlist."""
+    raw_directory = retriever_directory.parent / "raw"
+    embeddings_directory = retriever_directory / "embeddings"
+    raw_files = {path.stem: path
+                 for path in get_raw_transcript_paths(raw_directory)}
+    embedding_files = {path.stem: path
+                       for path in embeddings_directory.glob("*.npy")}
+    if set(raw_files) != set(embedding_files):
+        return True
+    return any(
+        raw_files[stem].stat().st_mtime > embedding_files[stem].stat().st_mtime
+        for stem in raw_files
+    )
+
+
+def _download(args: argparse.Namespace) -> int:
+    if not is_youtube_playlist(args.url):
+        logger.error("Invalid YouTube playlist link: %s", args.url)
+        return 1
+    raw_directory = args.data_dir / args.name / "raw"
+    raw_directory.mkdir(parents=True, exist_ok=True)
+    download_playlist(args.url, raw_directory, reporter=LoggingReporter(),
+                      raw_format=args.raw_format)
+    return 0
+
+
+def _migrate_raw(args: argparse.Namespace) -> int:
+    for playlist_directory in _get_playlist_directories(args.data_dir,
+                                                        args.playlists):
+        new_paths = migrate_raw_directory(playlist_directory / "raw",
+                                          remove_json=args.remove_json)
+        logger.info("Converted %d transcripts of %s", len(new_paths),
+                    playlist_directory.name)
+    return 0
+
+
+def _get_chunk_size(args: argparse.Namespace) -> int:
+    """Returns the chunk size of the arguments. By default, it is
+    `DEFAULT_MAX_CHUNK_SIZE` characters or, in the `tokens` mode, the limit
+    of the embedding model. In the `tokens` mode, it is capped to that limit
+    like `create_embeddings_pipeline` does."""
+    if args.chunking_mode == "tokens":
+        max_chunk_tokens = get_max_chunk_tokens(args.model)
+        if args.chunk_size is None:
+            return max_chunk_tokens
+        return min(args.chunk_size, max_chunk_tokens)
+    if args.chunk_size is not None:
+        return args.chunk_size
+    return DEFAULT_MAX_CHUNK_SIZE
+
+
+def _get_directory_name(args: argparse.Namespace) -> str:
+    return get_retriever_directory_name(args.model,
+                                        _get_chunk_size(args),
+                                        args.overlap,
+                                        args.chunking_mode)
+
+
+def _embed_playlists(playlist_directories: List[pathlib.Path],
+                     args: argparse.Namespace,
+                     resume: bool = False) -> int:
+    """Runs the embeddings pipeline for each playlist in a worker pool.
+
+    With `resume`, the videos that are already embedded with the same
+    parameters are skipped.
+    """
+    directory_name = _get_directory_name(args)
+
+    def embed(playlist_directory: pathlib.Path) -> None:
+        logger.info("Creating the embeddings of %s", playlist_directory.name)
+        create_embeddings_pipeline(playlist_directory / directory_name,
+                                   args.model,
+                                   max_chunk_size=_get_chunk_size(args),
+                                   min_overlap_size=args.overlap,
+                                   reporter=LoggingReporter(),
+                                   chunking_mode=args.chunking_mode,
+                                   vector_store_type=args.vector_store,
+                                   n_summary_vectors=args.summary_vectors,
+                                   resume=resume,
+                                   dedup_threshold=args.dedup_threshold)
+
+    failures = 0
+    with concurrent.futures.ThreadPoolExecutor(args.workers) as executor:
+        futures = {executor.submit(embed, directory): directory
+                   for directory in playlist_directories}
+        for future in concurrent.futures.as_completed(futures):
+            error = future.exception()
+            if error is not None:
+                failures += 1
+                logger.error("Could not embed %s: %s",
+                             futures[future].name, error)
+    return 1 if failures else 0
+
+
+def _embed(args: argparse.Namespace) -> int:
+    playlist_directories = _get_playlist_directories(args.data_dir,
+                                                     args.playlists)
+    return _embed_playlists(playlist_directories, args, args.resume)
+
+
+def _sync(args: argparse.Namespace) -> int:
+    directory_name = _get_directory_name(args)
+    playlist_directories = [
+        directory
+        for directory in _get_playlist_directories(args.data_dir,
+                                                   args.playlists)
+        if is_retriever_outdated(directory / directory_name)
+    ]
+    if not playlist_directories:
+        logger.info("Every playlist is up to date.")
+        return 0
+    # Only the new or updated videos of each playlist are embedded
+    return _embed_playlists(playlist_directories, args, resume=True)
+
+
+def _answer_batch(retrievers: List[Retriever],
+                  records: Sequence[Dict[str, Any]],
+                  args: argparse.Namespace) -> List[Dict[str, Any]]:
+    """Retrieves the documents of a batch of questions and answers them.
+
+    The questions of the batch are embedded and scored together.
+    """
+    questions = [record["question"] for record in records]
+    if args.rerank_model is None:
+        retrieved = Retriever.retrieve_batch(retrievers, questions, args.k,
+                                             n_videos=args.n_videos,
+                                             mmr_lambda=args.mmr_lambda)
+    else:
+        n_candidates = args.candidates or 4 * args.k
+        latency_budget = (None if args.rerank_budget_ms is None
+                          else args.rerank_budget_ms / 1000)
+        retrieved = [
+            rerank(question, candidates, args.k,
+                   model_name=args.rerank_model,
+                   latency_budget=latency_budget)
+            for question, candidates in zip(
+                questions,
+                Retriever.retrieve_batch(retrievers, questions, n_candidates,
+                                         n_videos=args.n_videos,
+                                         mmr_lambda=args.mmr_lambda)
+            )
+        ]
+    results = []
+    for record, document_infos in zip(records, retrieved):
+        question = record["question"]
+        result = dict(record)
+        result["documents"] = [document_info.to_dict()
+                               for document_info in document_infos]
+        early_stop = any(value is not None
+                         for value in (args.answer_threshold,
+                                       args.answer_budget_ms))
+        if args.mode == "extractive" and early_stop:
+            result["answers"] = search_extractive_answers(
+                question,
+                [document_info.document.page_content
+                 for document_info in document_infos],
+                args.extractive_model,
+                score_threshold=args.answer_threshold,
+                time_budget=(None if args.answer_budget_ms is None
+                             else args.answer_budget_ms / 1000),
+            )
+        elif args.mode == "extractive":
+            result["answers"] = get_extractive_answers(
+                [(question, document_info.document.page_content)
+                 for document_info in document_infos],
+                args.extractive_model,
+            )
+        elif args.mode == "generative":
+            result["answer"] = get_generative_answer(
+                question,
+                [document_info.document for document_info in document_infos],
+                model_name=args.generative_model,
+                temperature=args.temperature,
+                max_length=args.max_length,
+                map_reduce=args.map_reduce,
+            )
+        results.append(result)
+    return results
+
+
+def _ask(args: argparse.Namespace) -> int:
+    records = read_questions(args.questions)
+    retrievers: List[Any] = [
+        Retriever(_resolve_retriever_directory(args.data_dir, retriever))
+        for retriever in args.retriever or []
+    ]
+    if args.shard:
+        from ask_youtube_playlists.sharding import ShardedRetriever
+
+        retrievers.append(ShardedRetriever(
+            args.shard, timeout=args.shard_timeout_ms / 1000
+        ))
+    if not retrievers:
+        logger.error("At least one --retriever or --shard is needed.")
+        return 2
+    output = (open(args.output, "w", encoding="utf-8")
+              if args.output is not None else sys.stdout)
+    try:
+        with concurrent.futures.ThreadPoolExecutor(args.workers) as executor:
+            batches = executor.map(
+                lambda batch: _answer_batch(retrievers, batch, args),
+                _batched(records, args.batch_size),
+            )
+            for n_answered, results in enumerate(batches, start=1):
+                for result in results:
+                    output.write(json.dumps(result, default=str) + "\n")
+                output.flush()
+                logger.info("Answered %d/%d questions",
+                            min(n_answered * args.batch_size, len(records)),
+                            len(records))
+    finally:
+        if output is not sys.stdout:
+            output.close()
+    return 0
+
+
+def _serve(args: argparse.Namespace) -> int:
+    # aiohttp is only needed by this command
+    from ask_youtube_playlists.service import run_service
+
+    instrumentation.enable()
+    run_service(
+        [_resolve_retriever_directory(args.data_dir, retriever)
+         for retriever in args.retriever],
+        host=args.host,
+        port=args.port,
+        extractive_model_name=(None if args.no_extractive
+                               else args.extractive_model),
+        max_batch_size=args.max_batch_size,
+        batch_window=args.batch_window_ms / 1000,
+        memory_map=args.memory_map,
+    )
+    return 0
+
+
+def _shard_serve(args: argparse.Namespace) -> int:
+    from ask_youtube_playlists.sharding import run_shard_server
+
+    run_shard_server(
+        [_resolve_retriever_directory(args.data_dir, retriever)
+         for retriever in args.retriever],
+        host=args.host,
+        port=args.port,
+        memory_map=args.memory_map,
+    )
+    return 0
+
+
+def _add_embedding_arguments(parser: argparse.ArgumentParser) -> None:
+    parser.add_argument("playlists", nargs="*",
+                        help="Names of the playlists inside the data "
+                             "directory. Defaults to every playlist.")
+    parser.add_argument("--model", default=DEFAULT_EMBEDDING_MODEL,
+                        help="Name of the embedding model.")
+    parser.add_argument("--chunk-size", type=int,
+                        help="Maximum number of characters (or tokens) in a "
+                             f"chunk. Defaults to {DEFAULT_MAX_CHUNK_SIZE} "
+                             "characters or to the token limit of the "
+                             "model.")
+    parser.add_argument("--overlap", type=int,
+                        default=DEFAULT_MIN_OVERLAP_SIZE,
+                        help="Minimum number of characters (or tokens) "
+                             "shared by two consecutive chunks.")
+    parser.add_argument("--chunking-mode", choices=CHUNKING_MODES,
+                        default="characters",
+                        help="Measure the chunks in characters or in tokens "
+                             "of the tokenizer of the embedding model.")
+    parser.add_argument("--vector-store", choices=VECTOR_STORE_TYPES,
+                        default="in-memory",
+                        help="Where the retriever searches the embeddings. "
+                             "chroma-db also stores them in a persistent "
+                             "Chroma collection.")
+    parser.add_argument("--summary-vectors", type=int, default=1,
+                        help="Number of vectors that summarize each video, "
+                             "used by `ask --n-videos`.")
+    parser.add_argument("--dedup-threshold", type=float,
+                        help="Store the chunks whose text is at least this "
+                             "similar (between 0 and 1) to a previous chunk "
+                             "only once, with a reference to each video and "
+                             "timestamp. Defaults to no deduplication.")
+
+
+def build_parser() -> argparse.ArgumentParser:
+    """Returns the parser of the command-line arguments."""
+    parser = argparse.ArgumentParser(
+        prog="ask-youtube-playlists",
+        description="Ingest YouTube playlists and answer questions about "
+                    "them.")
+    parser.add_argument("--data-dir", type=pathlib.Path,
+                        default=pathlib.Path("data"),
+                        help="Directory with a folder per playlist. "
+                             "Defaults to ./data.")
+    parser.add_argument("--workers", type=int, default=1,
+                        help="Number of worker threads.")
+    parser.add_argument("--scoring-workers", type=int,
+                        help="Number of threads that score the embeddings "
+                             "of a question. Defaults to the number of "
+                             "cores.")
+    parser.add_argument("-v", "--verbose", action="store_true",
+                        help="Log the progress of each step.")
+    parser.add_argument("--timings", action="store_true",
+                        help="Log the time spent in each step when the "
+                             "command finishes.")
+    parser.add_argument("--answer-cache", type=pathlib.Path,
+                        help="SQLite file where the answers are cached, "
+                             "shared by every process that uses it.")
+    parser.add_argument("--answer-cache-ttl", type=float,
+                        help="Hours an answer stays in the answer cache. "
+                             "Defaults to no expiration.")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    download_parser = subparsers.add_parser(
+        "download", help="Download the transcripts of a playlist.")
+    download_parser.add_argument("url", help="URL of the YouTube playlist.")
+    download_parser.add_argument("--name", required=True,
+                                 help="Name of the playlist folder.")
+    download_parser.add_argument("--raw-format", choices=RAW_FORMATS,
+                                 default="json",
+                                 help="Format of the transcripts. `npz` is "
+                                      "a compact compressed format.")
+    download_parser.set_defaults(handler=_download)
+
+    migrate_parser = subparsers.add_parser(
+        "migrate-raw", help="Convert the JSON transcripts of playlists to the "
+                            "compact format.")
+    migrate_parser.add_argument("playlists", nargs="*",
+                                help="Names of the playlists inside the data "
+                                     "directory. Defaults to every playlist.")
+    migrate_parser.add_argument("--remove-json", action="store_true",
+                                help="Remove the JSON files once converted.")
+    migrate_parser.set_defaults(handler=_migrate_raw)
+
+    embed_parser = subparsers.add_parser(
+        "embed", help="Chunk and embed the transcripts of playlists.")
+    _add_embedding_arguments(embed_parser)
+    embed_parser.add_argument("--resume", action="store_true",
+                              help="Skip the videos already embedded with "
+                                   "the same parameters, e.g. after an "
+                                   "interrupted run.")
+    embed_parser.set_defaults(handler=_embed)
+
+    sync_parser = subparsers.add_parser(
+        "sync", help="Embed the playlists whose embeddings are missing or "
+                     "older than their transcripts.")
+    _add_embedding_arguments(sync_parser)
+    sync_parser.set_defaults(handler=_sync)
+
+    ask_parser = subparsers.add_parser(
+        "ask", help="Answer the questions of a file and write JSONL.")
+    ask_parser.add_argument("questions", type=pathlib.Path,
+                            help="A text file with a question per line or a "
+                                 "JSONL file with a `question` field.")
+    ask_parser.add_argument("--retriever", action="append",
+                            help="Retriever directory, absolute or relative "
+                                 "to the data directory, e.g. "
+                                 "playlist/msmarco-MiniLM-L-6-v3_320_64. "
+                                 "Can be repeated.")
+    ask_parser.add_argument("--shard", action="append",
+                            help="URL of a shard server started with "
+                                 "`shard-serve`. Can be repeated.")
+    ask_parser.add_argument("--shard-timeout-ms", type=float, default=2000,
+                            help="Maximum time to wait for each shard. The "
+                                 "shards that do not answer in time are "
+                                 "skipped.")
+    ask_parser.add_argument("--mode", choices=MODES, default="retrieve",
+                            help="Only retrieve documents or also answer "
+                                 "with an extractive or generative model.")
+    ask_parser.add_argument("-k", type=int, default=5,
+                            help="Number of documents to retrieve.")
+    ask_parser.add_argument("--batch-size", type=int, default=32,
+                            help="Number of questions per batch.")
+    ask_parser.add_argument("--n-videos", type=int,
+                            help="Only search the chunks of the videos "
+                                 "whose summary is the most similar to the "
+                                 "question. Faster, but it may miss "
+                                 "documents. Defaults to every video.")
+    ask_parser.add_argument("--mmr-lambda", type=float,
+                            help="Diversify the documents with maximal "
+                                 "marginal relevance, with this weight (0 "
+                                 "to 1) of the relevance against the "
+                                 "diversity, and merge adjacent chunks of a "
+                                 "video. Defaults to ranking by relevance.")
+    ask_parser.add_argument("--rerank-model",
+                            help="Re-rank the retrieved documents with this "
+                                 "cross-encoder, e.g. "
+                                 "cross-encoder/ms-marco-MiniLM-L-6-v2.")
+    ask_parser.add_argument("--candidates", type=int,
+                            help="Number of documents retrieved for the "
+                                 "re-ranker. Defaults to 4 * k.")
+    ask_parser.add_argument("--rerank-budget-ms", type=float,
+                            help="Maximum time spent re-ranking each "
+                                 "question. The documents left are kept in "
+                                 "the order of the retriever.")
+    ask_parser.add_argument("--extractive-model",
+                            default="deepset/roberta-base-squad2")
+    ask_parser.add_argument("--answer-threshold", type=float,
+                            help="In extractive mode, stop reading the "
+                                 "documents once an answer has this score.")
+    ask_parser.add_argument("--answer-budget-ms", type=float,
+                            help="In extractive mode, maximum time spent "
+                                 "reading the documents of each question.")
+    ask_parser.add_argument("--generative-model", default="gpt-3.5-turbo")
+    ask_parser.add_argument("--temperature", type=float, default=0.7)
+    ask_parser.add_argument("--max-length", type=int, default=256)
+    ask_parser.add_argument("--map-reduce", action="store_true",
+                            help="Answer groups of documents that fit the "
+                                 "context of the generative model "
+                                 "concurrently and combine their answers.")
+    ask_parser.add_argument("--output", type=pathlib.Path,
+                            help="Output JSONL file. Defaults to stdout.")
+    ask_parser.set_defaults(handler=_ask)
+
+    serve_parser = subparsers.add_parser(
+        "serve", help="Serve the retrievers and models over HTTP.")
+    serve_parser.add_argument("--retriever", action="append", required=True,
+                              help="Retriever directory, as in `ask`. Can be "
+                                   "repeated.")
+    serve_parser.add_argument("--host", default="127.0.0.1")
+    serve_parser.add_argument("--port", type=int, default=8080)
+    serve_parser.add_argument("--extractive-model",
+                              default="deepset/roberta-base-squad2")
+    serve_parser.add_argument("--no-extractive", action="store_true",
+                              help="Do not load the extractive model.")
+    serve_parser.add_argument("--max-batch-size", type=int, default=32,
+                              help="Maximum number of requests per batch.")
+    serve_parser.add_argument("--batch-window-ms", type=float, default=5,
+                              help="Maximum time a request waits for others "
+                                   "to form a batch.")
+    serve_parser.add_argument("--memory-map", action="store_true",
+                              help="Map the embeddings from an index file "
+                                   "shared by every process of the host "
+                                   "instead of loading them.")
+    serve_parser.set_defaults(handler=_serve)
+
+    shard_parser = subparsers.add_parser(
+        "shard-serve",
+        help="Serve retrievers as a shard of `ask --shard`.")
+    shard_parser.add_argument("--retriever", action="append", required=True,
+                              help="Retriever directory, as in `ask`. Can be "
+                                   "repeated.")
+    shard_parser.add_argument("--host", default="127.0.0.1")
+    shard_parser.add_argument("--port", type=int, default=8090)
+    shard_parser.add_argument("--memory-map", action="store_true",
+                              help="Map the embeddings from an index file "
+                                   "shared by every process of the host "
+                                   "instead of loading them.")
+    shard_parser.set_defaults(handler=_shard_serve)
+    return parser
+
+
+def main(argv: Optional[Sequence[str]] = None) -> int:
+    """Runs the command-line interface.
+
+    Args:
+        argv (Sequence[str], optional): The arguments. Defaults to
+            `sys.argv[1:]`.
+
+    Returns:
+        int: The exit code.
+    """
+    args = build_parser().parse_args(argv)
+    logging.basicConfig(
+        level=logging.INFO if args.verbose else logging.WARNING,
+        format="%(asctime)s %(levelname)s %(name)s: %(message)s",
+    )
+    if args.timings:
+        instrumentation.enable()
+    if args.scoring_workers is not None:
+        set_scoring_workers(args.scoring_workers)
+    # Load OPENAI_API_KEY from the .env file
+    dotenv.load_dotenv()
+    if args.answer_cache is not None:
+        ttl = (None if args.answer_cache_ttl is None
+               else args.answer_cache_ttl * 3600)
+        caching.set_cache_backend(caching.SQLiteCache(args.answer_cache,
+                                                      ttl=ttl))
+    exit_code = args.handler(args)
+    if args.timings:
+        instrumentation.log_metrics(logger, logging.WARNING)
+    return exit_code
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -13,17 +13,45 @@ from .create_embeddings import (get_embedding_model,
                                 EMBEDDING_MODELS_NAMES,
                                 get_embedding_spec,
                                 create_embeddings_pipeline,
-                                load_embeddings
+                                load_embeddings,
+                                summarize_video_embeddings,
+                                get_max_chunk_tokens,
+                                get_token_counter,
+                                CHUNKING_MODES,
                                 )
 
+from .manifest import EmbeddingManifest
+
+from .dedup import ChunkDeduplicator, load_references
+
+from .vector_store import ChromaVectorStore, VECTOR_STORE_TYPES
+
+from .shared_index import (acquire_shared_index,
+                           release_shared_index,
+                           build_index,
+                           is_index_outdated,
+                           get_shared_index_references,
+                           )
+
+from .chunk_store import ChunkStore, load_chunk_store
+
 from .create_documents import (get_documents_from_directory,
                                extract_documents_from_list_of_dicts)
 
 from .download_transcripts import (download_playlist,
                                    create_chunked_data,
+                                   iter_chunked_data,
+                                   find_sentence_boundaries,
+                                   find_semantic_boundaries,
+                                   load_transcript,
+                                   save_transcript,
+                                   get_raw_transcript_paths,
+                                   migrate_raw_directory,
+                                   RAW_FORMATS,
                                    )
 
 from .utils import (is_youtube_playlist,
                     get_device,
                     get_available_directories,
+                    get_retriever_directory_name,
                     )
@@ -0,0 +1,351 @@
+"""Columnar storage of the chunks of a retriever.
+
+A `langchain.schema.Document` per chunk is a pydantic model with its own
+metadata dictionary, which repeats the title, url and thumbnail of the video
+in every chunk. Holding them for a whole collection takes several times the
+size of the text. `ChunkStore` keeps the chunks in columns instead:
+
+- The texts, encoded in UTF-8, in a single byte array with the offset where
+  each text starts.
+- The numeric metadata present in every chunk (`start`, `duration`,
+  `index`...) in numpy arrays.
+- The rest of the metadata (`title`, `url`, `thumbnail`...) dictionary
+  encoded: a numpy array with a code per chunk and a list with each distinct
+  value once.
+
+Documents are only built for the chunks that are returned, with `document`.
+The back-references of the chunks deduplicated by `ChunkDeduplicator` are
+added to their metadata as a list of `duplicates`.
+
+The columns are cached in `index/chunks.npz`, which is rebuilt when it is
+older than the chunked data or the back-references, so a retriever does
+not parse the JSON files every time it is loaded.
+"""
+import json
+import os
+import pathlib
+import tempfile
+from typing import (Any, Dict, List, Optional, Sequence, Tuple, Union,
+                    TYPE_CHECKING)
+
+import numpy as np
+
+from ask_youtube_playlists import instrumentation
+from .create_documents import _extract_json_files_from_directory, _read_json
+from .dedup import DUPLICATES_FILE_NAME, load_references
+from .shared_index import INDEX_DIRECTORY
+
+if TYPE_CHECKING:
+    from langchain.schema import Document
+
+PathLike = Union[str, os.PathLike]
+
+CHUNK_STORE_FILE_NAME = "chunks.npz"
+# Code of the chunks that do not have a dictionary encoded field
+MISSING = -1
+
+
+def _is_number(value: Any) -> bool:
+    return isinstance(value, (int, float)) and not isinstance(value, bool)
+
+
+class ChunkStore:
+    """The chunks of the videos of a retriever, stored by columns.
+
+    Args:
+        texts (np.ndarray): The UTF-8 texts of every chunk, concatenated.
+        text_offsets (np.ndarray): Where the text of each chunk starts in
+            `texts`, plus the total size.
+        video_offsets (np.ndarray): The row where the chunks of each video
+            start, plus the total number of chunks.
+        numeric_fields (Dict[str, np.ndarray]): The numeric metadata.
+        encoded_fields (Dict[str, Tuple[np.ndarray, List[Any]]]): The codes
+            and the distinct values of the rest of the metadata.
+        field_names (Sequence[str]): The order of the metadata fields.
+        video_names (Sequence[str], optional): The name of each video.
+        references (Dict[int, List[Dict[str, Any]]], optional): The
+            metadata of the duplicates of a chunk, by row.
+    """
+
+    def __init__(self,
+                 texts: np.ndarray,
+                 text_offsets: np.ndarray,
+                 video_offsets: np.ndarray,
+                 numeric_fields: Dict[str, np.ndarray],
+                 encoded_fields: Dict[str, Tuple[np.ndarray, List[Any]]],
+                 field_names: Sequence[str],
+                 video_names: Optional[Sequence[str]] = None,
+                 references: Optional[Dict[int, List[Dict[str, Any]]]] = None):
+        self.texts = texts
+        self.text_offsets = text_offsets
+        self.video_offsets = video_offsets
+        self.numeric_fields = numeric_fields
+        self.encoded_fields = encoded_fields
+        self.field_names = list(field_names)
+        self.video_names = list(video_names or [])
+        self.references = references or {}
+
+    @classmethod
+    def from_videos(cls, videos: Sequence[Sequence[Dict[str, Any]]],
+                    text_key: str = "text",
+                    video_names: Optional[Sequence[str]] = None
+                    ) -> "ChunkStore":
+        """Builds the columns from the chunk dictionaries of each video.
+
+        Raises:
+            KeyError: If a chunk does not have the `text_key`.
+        """
+        chunks = [chunk for video in videos for chunk in video]
+        field_names: Dict[str, None] = {}
+        for chunk in chunks:
+            if text_key not in chunk:
+                raise KeyError(f"Key {text_key} not found in item {chunk}.")
+            field_names.update(dict.fromkeys(chunk))
+        field_names.pop(text_key, None)
+
+        encoded_texts = [chunk[text_key].encode("utf-8") for chunk in chunks]
+        text_offsets = np.cumsum([0] + [len(text) for text in encoded_texts],
+                                 dtype=np.int64)
+        texts = np.frombuffer(b"".join(encoded_texts), dtype=np.uint8)
+
+        numeric_fields = {}
+        encoded_fields = {}
+        for name in field_names:
+            values = [chunk.get(name) for chunk in chunks]
+            if all(_is_number(value) for value in values):
+                is_integer = all(isinstance(value, int) for value in values)
+                numeric_fields[name] = np.array(
+                    values, dtype=np.int64 if is_integer else np.float64
+                )
+                continue
+            codes: Dict[Any, int] = {}
+            column = np.empty(len(chunks), dtype=np.int32)
+            for row, chunk in enumerate(chunks):
+                if name not in chunk:
+                    column[row] = MISSING
+                else:
+                    column[row] = codes.setdefault(chunk[name], len(codes))
+            encoded_fields[name] = (column, list(codes))
+
+        video_offsets = np.cumsum([0] + [len(video) for video in videos],
+                                  dtype=np.int64)
+        return cls(texts, text_offsets, video_offsets, numeric_fields,
+                   encoded_fields, list(field_names), video_names)
+
+    @classmethod
+    def from_directory(cls, directory_path: PathLike,
+                       text_key: str = "text") -> "ChunkStore":
+        """Builds the columns from the JSON files of a `chunked_data`
+        directory, in the order of `get_documents_from_directory`."""
+        json_files = _extract_json_files_from_directory(directory_path)
+        return cls.from_videos([_read_json(path) for path in json_files],
+                               text_key=text_key,
+                               video_names=[path.stem for path in json_files])
+
+    def save(self, path: PathLike) -> None:
+        """Writes the columns to a `.npz` file."""
+        arrays = {"texts": self.texts,
+                  "text_offsets": self.text_offsets,
+                  "video_offsets": self.video_offsets}
+        for name, column in self.numeric_fields.items():
+            arrays[f"numeric/{name}"] = column
+        for name, (column, _) in self.encoded_fields.items():
+            arrays[f"encoded/{name}"] = column
+        header = {"field_names": self.field_names,
+                  "video_names": self.video_names,
+                  "references": [[row, references] for row, references
+                                 in self.references.items()],
+                  "values": {name: values for name, (_, values)
+                             in self.encoded_fields.items()}}
+        arrays["header"] = np.frombuffer(json.dumps(header).encode("utf-8"),
+                                         dtype=np.uint8)
+        with open(path, "wb") as file:
+            np.savez(file, **arrays)
+
+    @classmethod
+    def load(cls, path: PathLike) -> "ChunkStore":
+        """Reads the columns written by `save`."""
+        with np.load(str(path)) as arrays:
+            header = json.loads(arrays["header"].tobytes().decode("utf-8"))
+            numeric_fields = {}
+            encoded_fields = {}
+            for key in arrays.files:
+                kind, _, name = key.partition("/")
+                if kind == "numeric":
+                    numeric_fields[name] = arrays[key]
+                elif kind == "encoded":
+                    encoded_fields[name] = (arrays[key],
+                                            header["values"][name])
+            return cls(arrays["texts"], arrays["text_offsets"],
+                       arrays["video_offsets"], numeric_fields,
+                       encoded_fields, header["field_names"],
+                       header.get("video_names"),
+                       {row: references for row, references
+                        in header.get("references", [])})
+
+    def __len__(self) -> int:
+        return len(self.text_offsets) - 1
+
+    @property
+    def n_videos(self) -> int:
+        """Returns the number of videos."""
+        return len(self.video_offsets) - 1
+
+    @property
+    def video_sizes(self) -> np.ndarray:
+        """Returns the number of chunks of each video."""
+        return np.diff(self.video_offsets)
+
+    def text(self, row: int) -> str:
+        """Returns the text of a chunk."""
+        start, end = self.text_offsets[row], self.text_offsets[row + 1]
+        return self.texts[start:end].tobytes().decode("utf-8")
+
+    def metadata(self, row: int) -> Dict[str, Any]:
+        """Returns the metadata of a chunk, as in its JSON file."""
+        metadata = {}
+        for name in self.field_names:
+            if name in self.numeric_fields:
+                metadata[name] = self.numeric_fields[name][row].item()
+            else:
+                column, values = self.encoded_fields[name]
+                if column[row] != MISSING:
+                    metadata[name] = values[column[row]]
+        if row in self.references:
+            metadata["duplicates"] = self.references[row]
+        return metadata
+
+    def document(self, row: int) -> "Document":
+        """Builds the document of a chunk."""
+        from langchain.schema import Document
+
+        return Document(page_content=self.text(row),
+                        metadata=self.metadata(row))
+
+    def video_documents(self, video: int) -> List["Document"]:
+        """Builds the documents of the chunks of a video."""
+        return [self.document(row)
+                for row in range(self.video_offsets[video],
+                                 self.video_offsets[video + 1])]
+
+    def add_references(
+            self,
+            references: Dict[Tuple[str, int], List[Dict[str, Any]]]
+    ) -> None:
+        """Attaches the back-references read by `load_references` to the
+        rows of the chunks they belong to.
+
+        Raises:
+            KeyError: If a reference belongs to an unknown video.
+        """
+        positions = {name: position
+                     for position, name in enumerate(self.video_names)}
+        self.references = {
+            int(self.video_offsets[positions[video]]) + index: video_references
+            for (video, index), video_references in references.items()
+        }
+
+    def filter_rows(self, where: Dict[str, Any]) -> np.ndarray:
+        """Returns the rows of the chunks whose metadata has the values of
+        `where`.
+
+        Raises:
+            ValueError: If `where` has operators, e.g.
+                `{"start": {"$gte": 60}}`.
+        """
+        if any(key.startswith("$") or isinstance(value, dict)
+               for key, value in where.items()):
+            raise ValueError("The in-memory vector store only supports "
+                             "equality filters, e.g. {'title': 'Episode 1'}."
+                             f" Got {where}.")
+        is_selected = np.ones(len(self), dtype=bool)
+        for name, value in where.items():
+            if name in self.numeric_fields:
+                is_selected &= self.numeric_fields[name] == value
+            elif name in self.encoded_fields:
+                column, values = self.encoded_fields[name]
+                codes = [code for code, other in enumerate(values)
+                         if other == value]
+                is_selected &= np.isin(column, codes)
+            else:
+                is_selected[:] = False
+        return np.flatnonzero(is_selected).astype(np.int64)
+
+    def check_indexes(self) -> None:
+        """Checks that the `index` of each chunk is its position in its
+        video.
+
+        Raises:
+            ValueError: If a chunk is out of place.
+        """
+        if "index" not in self.numeric_fields:
+            return
+        positions = np.arange(len(self)) - np.repeat(self.video_offsets[:-1],
+                                                     self.video_sizes)
+        wrong = np.flatnonzero(self.numeric_fields["index"] != positions)
+        if len(wrong):
+            row = wrong[0]
+            raise ValueError("The index of the document does not match its "
+                             "position in the list. Index: "
+                             f"{self.numeric_fields['index'][row]}, "
+                             f"Position: {positions[row]}")
+
+
+def get_chunk_store_path(retriever_directory: PathLike) -> pathlib.Path:
+    """Returns the path of the cached chunk store of a retriever."""
+    return pathlib.Path(retriever_directory).joinpath(INDEX_DIRECTORY,
+                                                      CHUNK_STORE_FILE_NAME)
+
+
+def is_chunk_store_outdated(retriever_directory: PathLike) -> bool:
+    """Returns whether the cached chunk store of a retriever is missing or
+    older than its chunked data or its back-references."""
+    store_path = get_chunk_store_path(retriever_directory)
+    if not store_path.exists():
+        return True
+    store_mtime = store_path.stat().st_mtime
+    chunked_data_directory = pathlib.Path(retriever_directory) / \
+        "chunked_data"
+    paths = [chunked_data_directory] + \
+        _extract_json_files_from_directory(chunked_data_directory)
+    duplicates_path = pathlib.Path(retriever_directory) / DUPLICATES_FILE_NAME
+    if duplicates_path.exists():
+        paths.append(duplicates_path)
+    return any(path.stat().st_mtime > store_mtime for path in paths)
+
+
+def load_chunk_store(retriever_directory: PathLike,
+                     cache: bool = True) -> ChunkStore:
+    """Loads the chunks of a retriever.
+
+    Args:
+        retriever_directory (PathLike): The directory of the retriever.
+        cache (bool): Whether to read the chunks from `index/chunks.npz`,
+            building it if it is missing or outdated. If the file cannot be
+            written, the chunks are still returned. Defaults to True.
+    """
+    retriever_directory = pathlib.Path(retriever_directory)
+    store_path = get_chunk_store_path(retriever_directory)
+    with instrumentation.span("chunk_store.load"):
+        if cache and not is_chunk_store_outdated(retriever_directory):
+            return ChunkStore.load(store_path)
+        chunked_data_directory = retriever_directory / "chunked_data"
+        store = ChunkStore.from_directory(chunked_data_directory)
+        store.add_references(load_references(retriever_directory))
+    if cache:
+        try:
+            store_path.parent.mkdir(exist_ok=True)
+            file_descriptor, temporary_path = tempfile.mkstemp(
+                dir=store_path.parent, suffix=".npz"
+            )
+            os.close(file_descriptor)
+            try:
+                store.save(temporary_path)
+                os.replace(temporary_path, store_path)
+            except BaseException:
+                os.unlink(temporary_path)
+                raise
+        except OSError:
+            # E.g. a read-only directory. The chunks are parsed next time
+            pass
+    return store
@@ -4,9 +4,10 @@ their corresponding python objects.
 import os
 import json
 import pathlib
-from typing import List, Union, Dict
+from typing import List, Union, Dict, TYPE_CHECKING
 
-from langchain.schema import Document
+if TYPE_CHECKING:
+    from langchain.schema import Document
 
 DocumentDict = Dict[str, Union[str, float]]
 PathLike = Union[str, os.PathLike]
@@ -22,8 +23,10 @@ def _read_json(json_path: PathLike) -> List[DocumentDict]:
 
 def extract_documents_from_list_of_dicts(json_data: List[dict],
                                          text_key: str = "text"
-                                         ) -> List[Document]:
+                                         ) -> List["Document"]:
     """Extracts documents from a list of dictionaries."""
+    from langchain.schema import Document
+
     documents = []
     for item in json_data:
         if text_key not in item:
@@ -38,7 +41,7 @@ def extract_documents_from_list_of_dicts(json_data: List[dict],
 
 
 def _extract_documents_from_json(json_path: PathLike,
-                                 text_key: str = "text") -> List[Document]:
+                                 text_key: str = "text") -> List["Document"]:
     """Reads a json file with the YouTube video transcripts format and creates
     a list of documents.
 
@@ -82,16 +85,20 @@ def _extract_json_files_from_directory(directory_path: PathLike,
             the json files. Usually .../data/playlist_name/processed.
         start_with (str): The json files must start with this string. Defaults
             to "".
+
+    Returns:
+        List[pathlib.Path]: The paths sorted by name, so that they are in the
+            same order as the embeddings returned by `load_embeddings`.
     """
     directory_path = pathlib.Path(directory_path)
-    json_files = list(directory_path.glob(f"{start_with}*.json"))
+    json_files = sorted(directory_path.glob(f"{start_with}*.json"))
     return json_files
 
 
 def get_documents_from_directory(directory_path: Union[str, os.PathLike],
                                  start_with: str = "",
                                  text_key: str = "text"
-                                 ) -> List[List[Document]]:
+                                 ) -> List[List["Document"]]:
     """Extracts the documents from a directory with json files.
 
     Deprecated. We should use the `extract_documents_from_list_of_dicts`.
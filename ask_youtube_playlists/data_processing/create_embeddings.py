@@ -1,30 +1,69 @@
 """Functions to create the Vector database."""
+import functools
+import itertools
 import os
 import pathlib
+import time
 from dataclasses import dataclass
 
-from typing import List, Union, Dict, Callable
-
-from langchain.embeddings import base
-from langchain import embeddings
-from langchain.schema import Document
-from langchain import vectorstores
+from typing import (Any, List, Optional, Tuple, Union, Dict, Callable,
+                    Iterator, TYPE_CHECKING)
 
 import numpy as np
 import yaml
 import json
-import streamlit as st
 
+from ask_youtube_playlists import instrumentation
+from ask_youtube_playlists.reporting import Reporter, resolve_reporter
 from .utils import get_device
-from .download_transcripts import create_chunked_data
-from .create_documents import extract_documents_from_list_of_dicts
+from .download_transcripts import (iter_chunked_data,
+                                   get_raw_transcript_paths,
+                                   find_semantic_boundaries,
+                                   find_sentence_boundaries,
+                                   BoundaryDetector,
+                                   TokenCounter)
+from .create_documents import _read_json
+from .dedup import ChunkDeduplicator, DUPLICATES_FILE_NAME, load_references
+from .manifest import EmbeddingManifest
+from .vector_store import ChromaVectorStore, VECTOR_STORE_TYPES
+
+if TYPE_CHECKING:
+    from langchain.embeddings import base
+    from langchain.schema import Document
+    from langchain import vectorstores
 
 DocumentDict = Dict[str, Union[str, float]]
 PathLike = Union[str, os.PathLike]
 
+# Number of chunks embedded at once by `create_embeddings_pipeline`. The
+# OpenAI client splits each batch into concurrent requests, so it receives
+# larger batches to keep several requests in flight.
+EMBEDDING_BATCH_SIZE = 64
+OPENAI_EMBEDDING_BATCH_SIZE = 1024
+# Minimum number of seconds between two persists of the Chroma collection by
+# `create_embeddings_pipeline`. Persisting rewrites the whole collection, so
+# persisting after every video would make the ingestion quadratic.
+VECTOR_STORE_PERSIST_INTERVAL = 60.0
+
+# `characters` measures the chunks in characters and `tokens` in tokens of
+# the tokenizer of the embedding model. `sentences` and `semantic` measure
+# them in characters, but end them at the end of a sentence or where the
+# topic changes.
+CHUNKING_MODES = ["characters", "tokens", "sentences", "semantic"]
+
+# Number of special tokens the tokenizer of each model type adds to a text,
+# e.g. [CLS] and [SEP].
+SPECIAL_TOKENS = {
+    "sentence-transformers": 2,
+    "openai": 0,
+}
+
+# Maps each model type to the name of its class in `langchain.embeddings`.
+# The classes are looked up when a model is loaded, so importing this module
+# does not import langchain.
 MODEL_TYPES = {
-    "sentence-transformers": embeddings.SentenceTransformerEmbeddings,
-    "openai": embeddings.OpenAIEmbeddings,
+    "sentence-transformers": "SentenceTransformerEmbeddings",
+    "openai": "OpenAIEmbeddings",
 }
 
 
@@ -69,16 +108,22 @@ EMBEDDING_MODELS_NAMES = [embedding_model.model_name
 
 
 def get_embedding_model(embedding_model_name: str,
-                        ) -> base.Embeddings:
+                        ) -> "base.Embeddings":
     """Returns the embedding model.
 
+    The OpenAI models are served by an `OpenAIEmbeddingClient`, which sends
+    concurrent, rate limited requests.
+
     Args:
         embedding_model_name (str): The name of the embedding model.
 
     Raises:
         ValueError: If the model type is not supported.
     """
+    from langchain import embeddings
+
     embedding_model_spec = get_embedding_spec(embedding_model_name)
+    model: "base.Embeddings"
     if embedding_model_spec.model_type == "sentence-transformers":
         model_name = f"sentence-transformers/{embedding_model_spec.model_name}"
         device = get_device()
@@ -87,8 +132,11 @@ def get_embedding_model(embedding_model_name: str,
             model_kwargs={"device": device},
         )
     elif embedding_model_spec.model_type == "openai":
-        model = embeddings.OpenAIEmbeddings(  # type: ignore
+        from .openai_embeddings import OpenAIEmbeddingClient
+
+        model = OpenAIEmbeddingClient(
             model=embedding_model_spec.model_name,
+            token_counter=get_token_counter(embedding_model_spec.model_name),
         )
     else:
         raise ValueError(f"Model type {embedding_model_spec.model_type} is not"
@@ -116,14 +164,64 @@ def get_embedding_spec(model_name: str) -> EmbeddingModelSpec:
                      f"supported model names are {supported_model_names}.")
 
 
+def get_max_chunk_tokens(embedding_model_name: str) -> int:
+    """Returns the maximum number of tokens of a chunk that the embedding
+    model does not truncate."""
+    embedding_model_spec = get_embedding_spec(embedding_model_name)
+    special_tokens = SPECIAL_TOKENS[embedding_model_spec.model_type]
+    return embedding_model_spec.max_seq_length - special_tokens
+
+
+def get_token_counter(embedding_model_name: str) -> TokenCounter:
+    """Returns a function that counts the tokens of each text with the
+    tokenizer of the embedding model, without the special tokens.
+
+    Args:
+        embedding_model_name (str): The name of the embedding model.
+
+    Raises:
+        ValueError: If the model type is not supported.
+    """
+    embedding_model_spec = get_embedding_spec(embedding_model_name)
+    if embedding_model_spec.model_type == "sentence-transformers":
+        from transformers import AutoTokenizer
+
+        tokenizer = AutoTokenizer.from_pretrained(
+            f"sentence-transformers/{embedding_model_spec.model_name}"
+        )
+
+        def count_tokens(texts: List[str]) -> List[int]:
+            if not texts:
+                return []
+            input_ids = tokenizer(texts, add_special_tokens=False,
+                                  verbose=False)["input_ids"]
+            return [len(ids) for ids in input_ids]
+
+    elif embedding_model_spec.model_type == "openai":
+        import tiktoken
+
+        encoding = tiktoken.encoding_for_model(embedding_model_spec.model_name)
+
+        def count_tokens(texts: List[str]) -> List[int]:
+            return [len(tokens)
+                    for tokens in encoding.encode_ordinary_batch(texts)]
+
+    else:
+        raise ValueError(f"Model type {embedding_model_spec.model_type} is not"
+                         f" supported. The supported model types are "
+                         f"{list(MODEL_TYPES.keys())}.")
+    return count_tokens
+
+
 def create_vectorstore(embedding_model_name: str,
-                       documents: List[Document],
+                       documents: List["Document"],
                        vector_store_type: str = "in-memory",
-                       **kwargs) -> vectorstores.VectorStore:
+                       **kwargs) -> "vectorstores.VectorStore":
     """Returns a vector store that contains the vectors of the documents.
 
-    Currently, it only supports "in-memory" mode. In the future, it may
-    support "chroma-db" mode as well.
+    It supports the "in-memory" and "chroma-db" modes. The retrievers use
+    their own `ChromaVectorStore` instead, which stores precomputed
+    embeddings.
 
     Note:
         In order to be able to make the vector store persistent, the
@@ -152,8 +250,10 @@ def create_vectorstore(embedding_model_name: str,
             " vector store, set the `vector_store_type` argument to "
             "`in-memory`.")
 
+    from langchain import vectorstores
+
     object_mapper: Dict[str, Callable] = {
-        # "chroma-db": vectorstores.Chroma.from_documents,
+        "chroma-db": vectorstores.Chroma.from_documents,
         "in-memory": vectorstores.DocArrayInMemorySearch.from_documents,
     }
     embedding_model = get_embedding_model(embedding_model_name)
@@ -164,7 +264,7 @@ def create_vectorstore(embedding_model_name: str,
     return vectorstore
 
 
-def save_vectorstore(chroma_vectorstore: vectorstores.Chroma) -> None:
+def save_vectorstore(chroma_vectorstore: "vectorstores.Chroma") -> None:
     """Makes the vectorstore persistent in the local disk.
 
     The vectorstore is saved in the persist directory indicated when the
@@ -176,7 +276,7 @@ def save_vectorstore(chroma_vectorstore: vectorstores.Chroma) -> None:
     chroma_vectorstore.persist()
 
 
-def load_vectorstore(persist_directory: PathLike) -> vectorstores.Chroma:
+def load_vectorstore(persist_directory: PathLike) -> "vectorstores.Chroma":
     """Loads a vectorstore from the local disk.
 
     Args:
@@ -186,6 +286,8 @@ def load_vectorstore(persist_directory: PathLike) -> vectorstores.Chroma:
     Returns:
         VectorStore: The Chroma vectorstore.
     """
+    from langchain import vectorstores
+
     chroma_vectorstore = vectorstores.Chroma(
         persist_directory=str(persist_directory)
     )
@@ -195,12 +297,16 @@ def load_vectorstore(persist_directory: PathLike) -> vectorstores.Chroma:
 def _create_hyperparams_yaml(directory: PathLike,
                              model_name: str,
                              max_chunk_size: int,
-                             min_overlap_size: int):
+                             min_overlap_size: int,
+                             chunking_mode: str = "characters",
+                             vector_store_type: str = "in-memory"):
     """Creates the hyperparams.yaml file in the directory."""
     hyperparams = {
         "model_name": model_name,
         "max_chunk_size": max_chunk_size,
         "min_overlap_size": min_overlap_size,
+        "chunking_mode": chunking_mode,
+        "vector_store": vector_store_type,
     }
     # Create the directory if it does not exist.
     pathlib.Path(directory).mkdir(parents=False, exist_ok=True)
@@ -234,11 +340,19 @@ def save_json(chunked_data: List[dict],
         json.dump(chunked_data, file)
 
 
+@instrumentation.timed("ingest.create_embeddings_pipeline")
 def create_embeddings_pipeline(retriever_directory: PathLike,
                                embedding_model_name: str,
                                max_chunk_size: int,
                                min_overlap_size: int,
-                               use_st_progress_bar: bool = True) -> None:
+                               use_st_progress_bar: bool = True,
+                               reporter: Optional[Reporter] = None,
+                               chunking_mode: str = "characters",
+                               vector_store_type: str = "in-memory",
+                               n_summary_vectors: int = 1,
+                               resume: bool = False,
+                               dedup_threshold: Optional[float] = None
+                               ) -> None:
     """Sets up the embeddings for the given embedding model in the directory.
 
     Steps:
@@ -248,62 +362,180 @@ def create_embeddings_pipeline(retriever_directory: PathLike,
 
         3. Chunks the data.
 
-        4. Creates the embeddings and saves them in the retriever_directory.
+        4. Creates the embeddings and saves them in the retriever_directory,
+        with a few vectors that summarize each video in the `summaries`
+        folder.
+
+        5. Records each completed video in `manifest.json` (see
+        `EmbeddingManifest`) and reports it with `Reporter.checkpoint`.
+        With `chroma-db`, the collection is persisted at most every
+        `VECTOR_STORE_PERSIST_INTERVAL` seconds and at the end, and the
+        videos are only recorded once their chunks are persisted.
 
     Args:
         retriever_directory (PathLike): The directory where the embeddings will
             be saved. It should be inside a `data/playlist_name` directory.
             This function assumes that the playlist directory contains a
-            `raw` directory with the json files of each video.
+            `raw` directory with the transcript of each video, in JSON or
+            in the compact `.npz` format.
         embedding_model_name (str): The name of the embedding model.
-        max_chunk_size (int): The maximum number of characters in a chunk.
-        min_overlap_size (int): The minimum number of characters in the overlap
-            between two consecutive chunks.
+        max_chunk_size (int): The maximum number of characters (or tokens)
+            in a chunk. In the `tokens` mode, it is capped to the number of
+            tokens the embedding model does not truncate.
+        min_overlap_size (int): The minimum number of characters (or tokens)
+            in the overlap between two consecutive chunks.
         use_st_progress_bar (bool): Whether to use the Streamlit progress bar
-            or not.
+            or not. Ignored if a `reporter` is given.
+        reporter (Reporter, optional): Where the progress is reported. Pass a
+            `LoggingReporter` or a `NullReporter` to run the pipeline without
+            Streamlit.
+        chunking_mode (str): One of `CHUNKING_MODES`. The `tokens` mode
+            counts the tokens with the tokenizer of the embedding model, so
+            the chunks can be packed up to its limit without truncation. The
+            `sentences` mode ends the chunks at the end of a sentence,
+            judging by the punctuation, and the `semantic` mode where the
+            similarity between the embeddings of adjacent segments drops.
+            The segment embeddings are cached in the
+            `segment_embeddings/<model>` directory of the playlist. Both
+            modes keep whole sentences or topics in the overlap, so a smaller
+            `min_overlap_size` is usually enough.
+        vector_store_type (str): `in-memory` or `chroma-db`. With
+            `chroma-db`, the chunks are also upserted, video by video, into
+            a persistent Chroma collection in the `chroma` folder, and the
+            retriever queries it instead of loading the embeddings in
+            memory.
+        n_summary_vectors (int): The number of vectors that summarize each
+            video, used to route the questions to the relevant videos. See
+            `summarize_video_embeddings`. Defaults to 1, the centroid.
+        resume (bool): Whether to skip the videos that the manifest records
+            as completed with the same parameters, e.g. to resume an
+            interrupted run. Defaults to False.
+        dedup_threshold (float, optional): If given, the chunks whose text
+            is a near duplicate of a previous chunk of the playlist (with a
+            Jaccard similarity of their word shingles of at least this
+            value) are neither embedded nor stored. Their video and
+            timestamp are recorded as back-references of the kept chunk in
+            `duplicates.json`. See `ChunkDeduplicator`. Defaults to no
+            deduplication.
+
+    Raises:
+        ValueError: If the chunking mode or the vector store type is not
+            supported.
     """
+    if chunking_mode not in CHUNKING_MODES:
+        raise ValueError(f"Chunking mode {chunking_mode} is not supported. "
+                         f"The supported chunking modes are "
+                         f"{CHUNKING_MODES}.")
+    if vector_store_type not in VECTOR_STORE_TYPES:
+        raise ValueError(f"Vector store type {vector_store_type} is not "
+                         f"supported. The supported vector store types are "
+                         f"{VECTOR_STORE_TYPES}.")
     retriever_directory = pathlib.Path(retriever_directory)
-    embedding_model = get_embedding_model(embedding_model_name)
+    with instrumentation.span("ingest.load_embedding_model"):
+        embedding_model = get_embedding_model(embedding_model_name)
+    if get_embedding_spec(embedding_model_name).model_type == "openai":
+        batch_size = OPENAI_EMBEDDING_BATCH_SIZE
+    else:
+        batch_size = EMBEDDING_BATCH_SIZE
+
+    token_counter: Optional[TokenCounter] = None
+    boundary_detector: Optional[BoundaryDetector] = None
+    if chunking_mode == "tokens":
+        token_counter = get_token_counter(embedding_model_name)
+        max_chunk_size = min(max_chunk_size,
+                             get_max_chunk_tokens(embedding_model_name))
+    elif chunking_mode == "sentences":
+        boundary_detector = find_sentence_boundaries
 
     # Create the hyperparams.yaml file.
     _create_hyperparams_yaml(
         retriever_directory,
         embedding_model_name,
         max_chunk_size,
-        min_overlap_size
+        min_overlap_size,
+        chunking_mode,
+        vector_store_type,
     )
 
     playlist_directory = pathlib.Path(retriever_directory).parent
+    segment_embeddings_directory = playlist_directory.joinpath(
+        "segment_embeddings", embedding_model_name
+    )
     json_files_directory = playlist_directory / "raw"
     chunked_data_directory = retriever_directory / "chunked_data"
-    json_files = list(json_files_directory.glob("*.json"))
+    json_files = get_raw_transcript_paths(json_files_directory)
 
-    st_progress_bar = st.progress(0) if use_st_progress_bar else None
+    reporter = resolve_reporter(reporter, use_st_progress_bar)
     total = len(json_files)
 
     # Create the `processed` directory if it does not exist.
     pathlib.Path(retriever_directory).mkdir(parents=True, exist_ok=True)
 
-    for i, json_file_path in enumerate(json_files, start=1):
-        if st_progress_bar is not None:
-            st_progress_bar.progress(i / total, f"{i}/{total}")
+    vector_store: Optional[ChromaVectorStore] = None
+    if vector_store_type == "chroma-db":
+        vector_store = ChromaVectorStore(retriever_directory / "chroma")
 
-        chunked_data = create_chunked_data(
-            json_file_path,
-            max_chunk_size,
-            min_overlap_size
+    manifest = EmbeddingManifest(retriever_directory, {
+        "model_name": embedding_model_name,
+        "max_chunk_size": max_chunk_size,
+        "min_overlap_size": min_overlap_size,
+        "chunking_mode": chunking_mode,
+        "vector_store": vector_store_type,
+        "n_summary_vectors": n_summary_vectors,
+        "dedup_threshold": dedup_threshold,
+    })
+    deduplicator: Optional[ChunkDeduplicator] = None
+    previous_references = {}
+    if dedup_threshold is not None:
+        deduplicator = ChunkDeduplicator(dedup_threshold)
+        if resume:
+            previous_references = load_references(retriever_directory)
+    else:
+        retriever_directory.joinpath(DUPLICATES_FILE_NAME).unlink(
+            missing_ok=True
         )
 
+    checkpoints = _PendingCheckpoints(manifest, vector_store)
+    for i, json_file_path in enumerate(json_files, start=1):
+        reporter.progress(i / total, f"{i}/{total}")
         file_name = json_file_path.stem
-
-        # Save the chunked data in the `processed` directory.
-        save_json(chunked_data, chunked_data_directory, f"{file_name}.json")
-
-        new_documents = extract_documents_from_list_of_dicts(chunked_data)
-        documents_text = [document.page_content for document in new_documents]
-
-        new_video_embeddings = embedding_model.embed_documents(documents_text)
-        new_video_embeddings = np.array(new_video_embeddings)  # type: ignore
+        if resume and manifest.is_completed(file_name, json_file_path):
+            instrumentation.increment("ingest.resumed_videos")
+            if deduplicator is not None:
+                _restore_deduplicator(deduplicator, file_name,
+                                      chunked_data_directory,
+                                      previous_references)
+            reporter.checkpoint(file_name, i, total,
+                                manifest.videos[file_name]["n_chunks"],
+                                skipped=True)
+            continue
+        if chunking_mode == "semantic":
+            boundary_detector = _get_semantic_boundary_detector(
+                embedding_model,
+                segment_embeddings_directory / f"{file_name}.npy",
+                json_file_path,
+            )
+        chunks = iter_chunked_data(json_file_path,
+                                   max_chunk_size,
+                                   min_overlap_size,
+                                   token_counter,
+                                   boundary_detector)
+        if deduplicator is not None:
+            # The later videos may duplicate the chunks of this one, so they
+            # are embedded again as well
+            resume = False
+            chunks = deduplicator.filter(file_name, chunks)
+        on_batch = None
+        if vector_store is not None:
+            vector_store.delete_video(file_name)
+            on_batch = functools.partial(vector_store.add, file_name)
+        new_video_embeddings = _embed_chunks(
+            chunks,
+            embedding_model,
+            chunked_data_directory / f"{file_name}.json",
+            batch_size=batch_size,
+            on_batch=on_batch,
+        )
 
         # Save the embeddings in the `embeddings` directory.
         embeddings_directory = retriever_directory / "embeddings"
@@ -312,6 +544,230 @@ def create_embeddings_pipeline(retriever_directory: PathLike,
         embeddings_path = embeddings_directory / f"{file_name}.npy"
         np.save(str(embeddings_path), new_video_embeddings)
 
+        summaries_directory = retriever_directory / "summaries"
+        summaries_directory.mkdir(exist_ok=True)
+        np.save(str(summaries_directory / f"{file_name}.npy"),
+                summarize_video_embeddings(new_video_embeddings,
+                                           n_summary_vectors))
+
+        if deduplicator is not None:
+            deduplicator.save_references(retriever_directory)
+        checkpoints.add(file_name, json_file_path, len(new_video_embeddings))
+        reporter.checkpoint(file_name, i, total, len(new_video_embeddings))
+
+        instrumentation.increment("ingest.videos")
+        instrumentation.increment("ingest.chunks", len(new_video_embeddings))
+    checkpoints.flush()
+
+
+class _PendingCheckpoints:
+    """Records the embedded videos in the manifest once their chunks are on
+    disk.
+
+    Without a vector store, the files of a video are written before it is
+    added, so it is recorded at once. Otherwise, the videos wait until the
+    vector store is persisted, which happens at most every
+    `VECTOR_STORE_PERSIST_INTERVAL` seconds.
+    """
+
+    def __init__(self, manifest: EmbeddingManifest,
+                 vector_store: Optional[ChromaVectorStore]):
+        self.manifest = manifest
+        self.vector_store = vector_store
+        self.videos: List[Tuple[str, pathlib.Path, int]] = []
+        self.last_persist = time.monotonic()
+
+    def add(self, video_name: str, raw_path: pathlib.Path,
+            n_chunks: int) -> None:
+        self.videos.append((video_name, raw_path, n_chunks))
+        since_persist = time.monotonic() - self.last_persist
+        if self.vector_store is None or \
+                since_persist >= VECTOR_STORE_PERSIST_INTERVAL:
+            self.flush()
+
+    def flush(self) -> None:
+        """Persists the vector store and records the pending videos."""
+        if not self.videos:
+            return
+        if self.vector_store is not None:
+            with instrumentation.span("ingest.persist_vector_store"):
+                self.vector_store.persist()
+            self.last_persist = time.monotonic()
+        for video_name, raw_path, n_chunks in self.videos:
+            self.manifest.mark_completed(video_name, raw_path, n_chunks)
+        self.videos.clear()
+
+
+def _restore_deduplicator(
+        deduplicator: ChunkDeduplicator,
+        video: str,
+        chunked_data_directory: pathlib.Path,
+        previous_references: Dict[Tuple[str, int], List[Dict[str, Any]]]
+) -> None:
+    """Adds the chunks and the back-references of a video embedded by a
+    previous run to the deduplicator."""
+    for chunk in _read_json(chunked_data_directory / f"{video}.json"):
+        deduplicator.add(video, int(chunk["index"]), str(chunk["text"]))
+    for key, references in previous_references.items():
+        deduplicator.references.setdefault(key, []).extend(
+            reference for reference in references
+            if reference["video"] == video
+        )
+
+
+def _get_segment_embeddings(texts: List[str],
+                            embedding_model: "base.Embeddings",
+                            cache_path: pathlib.Path,
+                            raw_path: pathlib.Path) -> np.ndarray:
+    """Embeds each segment of a transcript.
+
+    The embeddings are cached in `cache_path`, so they are computed once per
+    transcript and embedding model and reused when the playlist is chunked
+    again, e.g. with other sizes. The cache is refreshed if the raw
+    transcript is newer.
+    """
+    is_cached = cache_path.exists() and \
+        cache_path.stat().st_mtime >= raw_path.stat().st_mtime
+    if is_cached:
+        segment_embeddings = np.load(cache_path)
+        if len(segment_embeddings) == len(texts):
+            return segment_embeddings
+
+    with instrumentation.span("ingest.embed_segments"):
+        segment_embeddings = np.array(embedding_model.embed_documents(texts),
+                                      dtype=np.float32)
+    instrumentation.increment("ingest.embedded_segments", len(texts))
+    cache_path.parent.mkdir(parents=True, exist_ok=True)
+    np.save(cache_path, segment_embeddings)
+    return segment_embeddings
+
+
+def _get_semantic_boundary_detector(embedding_model: "base.Embeddings",
+                                    cache_path: pathlib.Path,
+                                    raw_path: pathlib.Path
+                                    ) -> BoundaryDetector:
+    """Returns a boundary detector that finds the topic changes of a
+    transcript from the cached embeddings of its segments."""
+    def detect_boundaries(texts: List[str]) -> np.ndarray:
+        if not texts:
+            return np.zeros(0, dtype=bool)
+        return find_semantic_boundaries(
+            _get_segment_embeddings(texts, embedding_model, cache_path,
+                                    raw_path)
+        )
+
+    return detect_boundaries
+
+
+def _embed_chunks(chunks: Iterator[DocumentDict],
+                  embedding_model: "base.Embeddings",
+                  chunked_data_path: pathlib.Path,
+                  batch_size: int = EMBEDDING_BATCH_SIZE,
+                  on_batch: Optional[Callable[[List[DocumentDict],
+                                               np.ndarray], None]] = None
+                  ) -> np.ndarray:
+    """Embeds the chunks in batches as they are generated and writes them to
+    a JSON file.
+
+    The chunks are pulled from the iterator a batch at a time, e.g. from
+    `iter_chunked_data`, which builds them as the segments of the transcript
+    are read, so only a batch of chunks is kept in memory. The embeddings of
+    the video are kept until they are returned.
+
+    Args:
+        chunks (Iterator[DocumentDict]): The chunks of a video.
+        embedding_model (base.Embeddings): The embedding model.
+        chunked_data_path (pathlib.Path): The JSON file where the chunks are
+            saved. It has the same content as `save_json` would write.
+        batch_size (int): The number of chunks embedded at once.
+        on_batch (Callable, optional): Called with each batch of chunks and
+            their embeddings, e.g. to add them to a vector store.
+    Returns:
+        np.ndarray: The embeddings of the chunks.
+    """
+    chunked_data_path.parent.mkdir(parents=True, exist_ok=True)
+    embedding_batches = []
+    with open(chunked_data_path, "w") as file:
+        file.write("[")
+        separator = ""
+        while True:
+            with instrumentation.span("ingest.chunk"):
+                batch = list(itertools.islice(chunks, batch_size))
+            if not batch:
+                break
+            for chunk in batch:
+                file.write(separator + json.dumps(chunk))
+                separator = ", "
+
+            with instrumentation.span("ingest.embed"):
+                embedding_batches.append(np.array(
+                    embedding_model.embed_documents(
+                        [str(chunk["text"]) for chunk in batch]
+                    )
+                ))
+            if on_batch is not None:
+                on_batch(batch, embedding_batches[-1])
+        file.write("]")
+
+    if not embedding_batches:
+        return np.array([])
+    return np.concatenate(embedding_batches)
+
+
+def _normalize_rows(matrix: np.ndarray) -> np.ndarray:
+    norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+    norms[norms == 0] = 1
+    return matrix / norms
+
+
+def summarize_video_embeddings(embeddings: np.ndarray,
+                               n_vectors: int = 1,
+                               n_iterations: int = 10) -> np.ndarray:
+    """Returns a few unit vectors that summarize the chunks of a video.
+
+    With a single vector, it is the normalized centroid of the chunks. With
+    more, they are the centroids of a spherical k-means of the chunks, so a
+    video that covers several topics is close to each of them. They are
+    used by the retriever to route the questions to the relevant videos.
+
+    Args:
+        embeddings (np.ndarray): The embeddings of the chunks of the video.
+        n_vectors (int): The maximum number of vectors. Defaults to 1.
+        n_iterations (int): The number of k-means iterations. Defaults to
+            10.
+
+    Returns:
+        np.ndarray: A matrix with a row per vector, `min(n_vectors,
+        len(embeddings))` rows.
+    """
+    embeddings = np.asarray(embeddings, dtype=np.float32)
+    if len(embeddings) == 0:
+        return embeddings.reshape(0, embeddings.shape[-1]
+                                  if embeddings.ndim == 2 else 0)
+    unit_embeddings = _normalize_rows(embeddings)
+    n_vectors = min(n_vectors, len(unit_embeddings))
+    if n_vectors == 1:
+        return _normalize_rows(unit_embeddings.mean(axis=0, keepdims=True))
+
+    # Farthest-point initialization, which is deterministic
+    centers = [unit_embeddings[0]]
+    closest = unit_embeddings @ centers[0]
+    for _ in range(1, n_vectors):
+        center = unit_embeddings[np.argmin(closest)]
+        centers.append(center)
+        closest = np.maximum(closest, unit_embeddings @ center)
+    center_matrix = np.array(centers)
+
+    for _ in range(n_iterations):
+        assignment = np.argmax(unit_embeddings @ center_matrix.T, axis=1)
+        sums = np.zeros_like(center_matrix)
+        np.add.at(sums, assignment, unit_embeddings)
+        # Empty clusters keep their center
+        is_empty = ~sums.any(axis=1)
+        sums[is_empty] = center_matrix[is_empty]
+        center_matrix = _normalize_rows(sums)
+    return center_matrix
+
 
 def load_embeddings(embedding_directory: PathLike) -> List[np.ndarray]:
     """Loads the embeddings from the retriever_directory.
@@ -321,12 +777,12 @@ def load_embeddings(embedding_directory: PathLike) -> List[np.ndarray]:
             saved.
 
     Returns:
-        List[np.ndarray]: The embeddings. The order of the embeddings in
-            the list is the same as the order of the json files in the
-            `processed` directory.
+        List[np.ndarray]: The embeddings, sorted by file name. The order of
+            the embeddings in the list is the same as the order of the json
+            files in the `chunked_data` directory.
     """
 
-    numpy_files = list(pathlib.Path(embedding_directory).glob("*.npy"))
+    numpy_files = sorted(pathlib.Path(embedding_directory).glob("*.npy"))
 
     video_embeddings = []
     for numpy_file in numpy_files:
@@ -0,0 +1,242 @@
+"""Detection of near-duplicate chunks before they are embedded.
+
+Podcast playlists repeat passages: re-uploads, compilations of clips, intros
+and sponsor reads. `ChunkDeduplicator` finds the chunks whose text is nearly
+the same as a chunk seen before, so that they are neither embedded nor
+stored. The first occurrence is kept and records a back-reference to the
+video and timestamp of every duplicate.
+
+The similarity of two chunks is the Jaccard similarity of their sets of
+word shingles (sequences of `shingle_size` words). It is estimated with
+MinHash signatures, and the candidates are found with locality-sensitive
+hashing (LSH): the signatures are split in bands, and two chunks are
+candidates if they share all the values of a band. The bands are chosen so
+that a pair at the threshold is very likely a candidate, and the exact
+similarity of the shingles of the candidates filters out the false
+positives. Only the candidates are compared, so each chunk costs about the
+same regardless of how many chunks were seen.
+"""
+import json
+import os
+import pathlib
+import re
+import zlib
+from typing import (Any, Dict, Iterable, Iterator, List, Optional, Set,
+                    Tuple, Union)
+
+import numpy as np
+
+from ask_youtube_playlists import instrumentation
+from .manifest import write_json_atomically
+
+PathLike = Union[str, os.PathLike]
+
+DUPLICATES_FILE_NAME = "duplicates.json"
+# Mersenne prime of the universal hash functions of the permutations
+_PRIME = (1 << 61) - 1
+_MAX_HASH = (1 << 32) - 1
+
+_WORD_PATTERN = re.compile(r"\w+")
+
+
+def get_shingles(text: str, shingle_size: int = 5) -> Set[int]:
+    """Returns the hashes of the sequences of `shingle_size` consecutive
+    words of a text, ignoring case and punctuation.
+
+    A text with fewer words is a single shingle.
+    """
+    words = _WORD_PATTERN.findall(text.lower())
+    if not words:
+        return set()
+    n_shingles = max(1, len(words) - shingle_size + 1)
+    return {zlib.crc32(" ".join(words[i:i + shingle_size]).encode("utf-8"))
+            for i in range(n_shingles)}
+
+
+def choose_bands(n_permutations: int, threshold: float) -> Tuple[int, int]:
+    """Returns the number of bands and of rows per band whose LSH threshold,
+    about `(1 / bands) ** (1 / rows)`, is the highest one not above
+    `threshold`.
+
+    Above its LSH threshold, a pair is a candidate with a high probability,
+    so the pairs at `threshold` are rarely missed. The candidates below
+    `threshold` are false positives, discarded by the exact comparison.
+    """
+    for bands in range(1, n_permutations + 1):
+        if n_permutations % bands:
+            continue
+        rows = n_permutations // bands
+        # The LSH threshold decreases as the number of bands increases
+        if (1 / bands) ** (1 / rows) <= threshold:
+            return bands, rows
+    return n_permutations, 1
+
+
+def jaccard_similarity(shingles: np.ndarray, other: np.ndarray) -> float:
+    """Returns the Jaccard similarity of two sorted arrays of distinct
+    shingles."""
+    n_common = len(np.intersect1d(shingles, other, assume_unique=True))
+    return n_common / max(len(shingles) + len(other) - n_common, 1)
+
+
+class MinHasher:
+    """Computes MinHash signatures of sets of shingles.
+
+    Args:
+        n_permutations (int): The length of the signatures. The error of the
+            estimated similarity is about `1 / sqrt(n_permutations)`.
+        seed (int): The seed of the permutations. Signatures are only
+            comparable if they use the same seed.
+    """
+
+    def __init__(self, n_permutations: int = 128, seed: int = 0):
+        rng = np.random.default_rng(seed)
+        self.n_permutations = n_permutations
+        self._a = rng.integers(1, _MAX_HASH, size=n_permutations,
+                               dtype=np.uint64)
+        self._b = rng.integers(0, _MAX_HASH, size=n_permutations,
+                               dtype=np.uint64)
+
+    def signature(self, shingles: Set[int]) -> np.ndarray:
+        """Returns the signature of a non-empty set of shingles."""
+        hashes = np.fromiter(shingles, dtype=np.uint64, count=len(shingles))
+        # The hashes and the coefficients are below 2 ** 32, so the products
+        # do not overflow
+        permuted = (np.outer(hashes, self._a) + self._b) % _PRIME
+        return (permuted & _MAX_HASH).min(axis=0)
+
+
+def estimate_similarity(signature: np.ndarray, other: np.ndarray) -> float:
+    """Returns the Jaccard similarity estimated from two signatures."""
+    return float(np.mean(signature == other))
+
+
+class ChunkDeduplicator:
+    """Finds the chunks that are near duplicates of previous chunks.
+
+    Args:
+        threshold (float): The minimum Jaccard similarity of the shingles of
+            two chunks to consider them duplicates. Defaults to 0.8.
+        shingle_size (int): The number of words per shingle. Defaults to 5.
+        n_permutations (int): The length of the MinHash signatures. Defaults
+            to 128.
+    """
+
+    def __init__(self,
+                 threshold: float = 0.8,
+                 shingle_size: int = 5,
+                 n_permutations: int = 128):
+        self.threshold = threshold
+        self.shingle_size = shingle_size
+        self.hasher = MinHasher(n_permutations)
+        self.n_bands, self.n_rows = choose_bands(n_permutations, threshold)
+        self._buckets: List[Dict[bytes, List[int]]] = [
+            {} for _ in range(self.n_bands)
+        ]
+        # The sorted shingles of each kept chunk, by order of arrival
+        self._shingles: List[np.ndarray] = []
+        # The (video, index) of each kept chunk, by order of arrival
+        self._keys: List[Tuple[str, int]] = []
+        # (video, index) of a kept chunk -> the metadata of its duplicates
+        self.references: Dict[Tuple[str, int], List[Dict[str, Any]]] = {}
+
+    def _bands(self, signature: np.ndarray) -> Iterator[bytes]:
+        for band in range(self.n_bands):
+            yield signature[band * self.n_rows:
+                            (band + 1) * self.n_rows].tobytes()
+
+    def _sketch(self, text: str
+                ) -> Optional[Tuple[np.ndarray, np.ndarray]]:
+        """Returns the sorted shingles of a text and their signature, or
+        None if the text has no words."""
+        shingles = get_shingles(text, self.shingle_size)
+        if not shingles:
+            return None
+        shingle_array = np.sort(np.fromiter(shingles, dtype=np.uint32,
+                                            count=len(shingles)))
+        return shingle_array, self.hasher.signature(shingles)
+
+    def _find(self, shingles: np.ndarray, signature: np.ndarray
+              ) -> Optional[Tuple[str, int]]:
+        candidates = {candidate
+                      for buckets, band in zip(self._buckets,
+                                               self._bands(signature))
+                      for candidate in buckets.get(band, ())}
+        similarities = {
+            candidate: jaccard_similarity(shingles,
+                                          self._shingles[candidate])
+            for candidate in candidates
+        }
+        best = max(similarities, default=None, key=similarities.__getitem__)
+        if best is not None and similarities[best] >= self.threshold:
+            return self._keys[best]
+        return None
+
+    def _add(self, video: str, index: int, shingles: np.ndarray,
+             signature: np.ndarray) -> None:
+        position = len(self._keys)
+        self._keys.append((video, index))
+        self._shingles.append(shingles)
+        for buckets, band in zip(self._buckets, self._bands(signature)):
+            buckets.setdefault(band, []).append(position)
+
+    def find_duplicate(self, text: str) -> Optional[Tuple[str, int]]:
+        """Returns the (video, index) of a kept chunk that `text` duplicates,
+        or None."""
+        sketch = self._sketch(text)
+        return None if sketch is None else self._find(*sketch)
+
+    def add(self, video: str, index: int, text: str) -> None:
+        """Adds a kept chunk, so that later chunks can duplicate it."""
+        sketch = self._sketch(text)
+        if sketch is not None:
+            self._add(video, index, *sketch)
+
+    def filter(self, video: str, chunks: Iterable[Dict[str, Any]],
+               text_key: str = "text") -> Iterator[Dict[str, Any]]:
+        """Yields the chunks of a video that are not duplicates, and records
+        a back-reference for the rest.
+
+        The kept chunks have their `index` renumbered, so that it is their
+        position among the kept chunks, and their `index` before the
+        duplicates were removed as `original_index`. A back-reference is the
+        metadata of the duplicate, with its `video`, except its text and
+        index.
+        """
+        index = 0
+        for original_index, chunk in enumerate(chunks):
+            sketch = self._sketch(str(chunk[text_key]))
+            duplicate_of = None if sketch is None else self._find(*sketch)
+            if duplicate_of is not None:
+                reference = {key: value for key, value in chunk.items()
+                             if key not in (text_key, "index")}
+                reference["video"] = video
+                self.references.setdefault(duplicate_of, []).append(reference)
+                instrumentation.increment("ingest.duplicate_chunks")
+                continue
+            if sketch is not None:
+                self._add(video, index, *sketch)
+            yield dict(chunk, index=index,
+                       original_index=chunk.get("index", original_index))
+            index += 1
+
+    def save_references(self, retriever_directory: PathLike) -> None:
+        """Writes the back-references to `duplicates.json`."""
+        write_json_atomically(
+            pathlib.Path(retriever_directory) / DUPLICATES_FILE_NAME,
+            [{"video": video, "index": index, "references": references}
+             for (video, index), references in self.references.items()]
+        )
+
+
+def load_references(retriever_directory: PathLike
+                    ) -> Dict[Tuple[str, int], List[Dict[str, Any]]]:
+    """Reads the back-references written by `save_references`, by the
+    (video, index) of the kept chunk."""
+    path = pathlib.Path(retriever_directory) / DUPLICATES_FILE_NAME
+    if not path.exists():
+        return {}
+    with open(path, "r", encoding="utf-8") as file:
+        entries = json.load(file)
+    return {(entry["video"], entry["index"]): entry["references"]
+            for entry in entries}
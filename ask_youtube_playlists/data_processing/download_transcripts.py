@@ -1,12 +1,50 @@
-"""Code to download the transcripts from YouTube."""
+"""Code to download the transcripts from YouTube.
+
+`pytube` and `youtube_transcript_api` are imported inside the functions that
+use them, so chunking transcripts that are already on disk does not pay for
+those imports.
+
+The raw transcripts are stored in one of two formats:
+    - `json`: A pretty-printed JSON file with a dictionary per segment.
+    - `npz`: A compressed NumPy archive with the UTF-8 bytes of the
+      concatenated text and the columnar arrays `offsets` (the character
+      offset where each segment begins, plus the total length), `starts`
+      and `durations`. It is several times smaller and faster to read.
+`load_transcript` reads both formats into the same dictionary.
+"""
+import collections
+import os
 import pathlib
 import json
-from typing import Dict, List, Union, Tuple
+import re
+from typing import (Any, Callable, Deque, Dict, Iterable, Iterator, List,
+                    NamedTuple, Optional, Sequence, Union, Tuple)
 
-import streamlit as st
+import numpy as np
 
-import pytube
-from youtube_transcript_api import YouTubeTranscriptApi
+from ask_youtube_playlists import instrumentation
+from ask_youtube_playlists.reporting import Reporter, resolve_reporter
+
+RAW_FORMATS = ["json", "npz"]
+
+# Returns the number of tokens of each text
+TokenCounter = Callable[[List[str]], Sequence[int]]
+# Returns whether a chunk may end after each segment
+BoundaryDetector = Callable[[List[str]], np.ndarray]
+
+
+class _Segment(NamedTuple):
+    """A segment of a transcript, with the total duration of the segments
+    before it in `elapsed`."""
+    text: str
+    start: float
+    duration: float
+    elapsed: float
+
+
+# A segment ends a sentence if it ends with a terminal punctuation mark,
+# optionally followed by closing quotes or brackets.
+_SENTENCE_END = re.compile(r'[.!?\u2026]["\'\u201d)\]]*\s*$')
 
 
 def _get_playlist_info(url: str) -> Dict[str, str]:
@@ -18,6 +56,8 @@ def _get_playlist_info(url: str) -> Dict[str, str]:
         Dict[str, str]: A dictionary with the video titles as keys and the
             video IDs as values.
         """
+    import pytube
+
     playlist = pytube.Playlist(url)
 
     # Dict to hold title-ID pairs
@@ -29,70 +69,244 @@ def _get_playlist_info(url: str) -> Dict[str, str]:
     return video_dict
 
 
+@instrumentation.timed("ingest.download_transcript")
 def download_transcript(video_title: str,
                         video_id: str,
                         output_path: pathlib.Path,
-                        verbose: bool = True) -> None:
+                        verbose: bool = True,
+                        reporter: Optional[Reporter] = None) -> None:
     """Downloads the transcript of a YouTube video.
 
     Args:
         video_title (str): The title of the YouTube video.
         video_id (str): The ID of the YouTube video.
-        output_path (pathlib.Path): The path to the output file.
-        verbose (bool): Whether to print the progress of the download.
+        output_path (pathlib.Path): The path to the output file. Its suffix,
+            `.json` or `.npz`, selects the format.
+        verbose (bool): Whether to report the videos that could not be
+            downloaded.
+        reporter (Reporter, optional): Where the warnings are reported.
+            Defaults to the default reporter.
 
     Raises:
         Exception: If the transcript cannot be downloaded.
     """
+    from youtube_transcript_api import YouTubeTranscriptApi
+
     try:
         # Download transcript with youtube_transcript_api
         transcript = YouTubeTranscriptApi.get_transcript(
             video_id, languages=['en', 'en-US'])
 
-        # Save transcript to a JSON file
-        with open(output_path, 'w', encoding='utf-8') as file:
-            # Put the title and the video ID at the top of the JSON file and
-            # then dump the transcript
-            json.dump({
-                'title': video_title,
-                'video_id': video_id,
-                'transcript': transcript,
-            }, file, ensure_ascii=False, indent=4)
+        # Put the title and the video ID at the top of the file and then
+        # dump the transcript
+        save_transcript({
+            'title': video_title,
+            'video_id': video_id,
+            'transcript': transcript,
+        }, output_path)
 
     except Exception as error_msg:
+        instrumentation.increment("ingest.download_errors")
         if verbose:
-            st.warning(f'Could not download transcript for video '
-                       f'{video_title}.\nError message:\n{error_msg}')
+            resolve_reporter(reporter).warning(
+                f'Could not download transcript for video '
+                f'{video_title}.\nError message:\n{error_msg}')
 
 
+@instrumentation.timed("ingest.download_playlist")
 def download_playlist(url: str,
                       data_path: pathlib.Path,
-                      use_st_progress_bar: bool = False) -> None:
+                      use_st_progress_bar: bool = False,
+                      reporter: Optional[Reporter] = None,
+                      raw_format: str = "json") -> None:
     """Downloads the transcripts of a YouTube playlist.
 
     Args:
         url (str): The URL of the YouTube playlist.
         data_path (pathlib.Path): The path to the data directory.
-        use_st_progress_bar (bool): Whether to use a Streamlit progress bar.
+        use_st_progress_bar (bool): Whether to use a Streamlit progress bar
+            and warn about the videos that could not be downloaded. Ignored
+            if a `reporter` is given.
+        reporter (Reporter, optional): Where the progress and the warnings are
+            reported. As before reporters existed, the failed videos are only
+            reported if a reporter or `use_st_progress_bar` is given.
+            Defaults to the default reporter, for the progress only.
+        raw_format (str): The format of the transcripts, `json` or `npz`.
+
+    Raises:
+        ValueError: If the format is not supported.
     """
-    video_id_dict = _get_playlist_info(url)
+    if raw_format not in RAW_FORMATS:
+        raise ValueError(f"Unknown raw format {raw_format}. The available "
+                         f"formats are {RAW_FORMATS}.")
+    verbose = use_st_progress_bar or reporter is not None
+    reporter = resolve_reporter(reporter, use_st_progress_bar)
+    with instrumentation.span("ingest.playlist_info"):
+        video_id_dict = _get_playlist_info(url)
 
     total_videos = len(video_id_dict)
-    progress_bar = None
-
-    if use_st_progress_bar:
-        progress_bar = st.progress(0)
 
     for i, (video_title, video_id) in enumerate(video_id_dict.items()):
-        if progress_bar is not None:
-            progress_bar.progress((i + 1) / total_videos,
-                                  f'Downloading video {i + 1} of '
-                                  f'{total_videos}')
-        output_file = data_path / f'Video_{str(i + 1)}.json'
+        reporter.progress((i + 1) / total_videos,
+                          f'Downloading video {i + 1} of {total_videos}')
+        output_file = data_path / f'Video_{str(i + 1)}.{raw_format}'
         download_transcript(video_title,
                             video_id,
                             output_file,
-                            verbose=use_st_progress_bar)
+                            verbose=verbose,
+                            reporter=reporter)
+
+
+def save_transcript(transcript_data: Dict[str, Any],
+                    output_path: pathlib.Path) -> None:
+    """Saves a transcript in the format given by the suffix of the path.
+
+    Args:
+        transcript_data (Dict[str, Any]): A dictionary with the `title`,
+            the `video_id` and the `transcript`, a list of segments with
+            their `text`, `start` and `duration`.
+        output_path (pathlib.Path): The path to a `.json` or `.npz` file.
+
+    Raises:
+        ValueError: If the suffix is not supported.
+    """
+    output_path = pathlib.Path(output_path)
+    if output_path.suffix == '.json':
+        with open(output_path, 'w', encoding='utf-8') as file:
+            json.dump(transcript_data, file, ensure_ascii=False, indent=4)
+    elif output_path.suffix == '.npz':
+        _save_compact_transcript(transcript_data, output_path)
+    else:
+        raise ValueError(f"Unknown transcript format {output_path.suffix}.")
+
+
+def _save_compact_transcript(transcript_data: Dict[str, Any],
+                             output_path: pathlib.Path) -> None:
+    segments = transcript_data['transcript']
+    texts = [segment['text'] for segment in segments]
+    offsets = np.zeros(len(segments) + 1, dtype=np.int64)
+    np.cumsum([len(text) for text in texts], out=offsets[1:])
+    # Write through a file object so that NumPy does not add a second suffix
+    with open(output_path, 'wb') as file:
+        np.savez_compressed(
+            file,
+            title=np.array(transcript_data['title']),
+            video_id=np.array(transcript_data['video_id']),
+            text=np.frombuffer(''.join(texts).encode('utf-8'),
+                               dtype=np.uint8),
+            offsets=offsets,
+            starts=np.array([segment['start'] for segment in segments],
+                            dtype=np.float64),
+            durations=np.array([segment['duration'] for segment in segments],
+                               dtype=np.float64),
+        )
+
+
+@instrumentation.timed("ingest.load_transcript")
+def load_transcript(file_path: pathlib.Path) -> Dict[str, Any]:
+    """Loads a raw transcript saved as JSON or in the compact format.
+
+    Args:
+        file_path (pathlib.Path): The path to a `.json` or `.npz` file.
+    Returns:
+        Dict[str, Any]: A dictionary with the `title`, the `video_id` and the
+            `transcript`, a list of segments with their `text`, `start` and
+            `duration`.
+    Raises:
+        ValueError: If the suffix is not supported.
+    """
+    file_path = pathlib.Path(file_path)
+    if file_path.suffix == '.json':
+        with open(file_path, 'r', encoding='utf-8') as file:
+            return json.load(file)
+    if file_path.suffix != '.npz':
+        raise ValueError(f"Unknown transcript format {file_path.suffix}.")
+
+    with np.load(file_path, allow_pickle=False) as archive:
+        text = archive['text'].tobytes().decode('utf-8')
+        offsets = archive['offsets'].tolist()
+        starts = archive['starts'].tolist()
+        durations = archive['durations'].tolist()
+        title = str(archive['title'])
+        video_id = str(archive['video_id'])
+
+    transcript = [
+        {'text': text[begin:end],
+         'start': start,
+         'duration': duration}
+        for begin, end, start, duration
+        in zip(offsets[:-1], offsets[1:], starts, durations)
+    ]
+    return {'title': title, 'video_id': video_id, 'transcript': transcript}
+
+
+def _load_transcript_columns(file_path: pathlib.Path
+                             ) -> Tuple[str, str, List[str], np.ndarray,
+                                        np.ndarray]:
+    """Loads a raw transcript as columns: the title, the video ID, the text
+    of each segment and the arrays of starts and durations. The compact
+    format is read without building a dictionary per segment."""
+    file_path = pathlib.Path(file_path)
+    if file_path.suffix != '.npz':
+        transcript_data = load_transcript(file_path)
+        segments = transcript_data['transcript']
+        return (transcript_data['title'],
+                transcript_data['video_id'],
+                [segment['text'] for segment in segments],
+                np.array([segment['start'] for segment in segments],
+                         dtype=np.float64),
+                np.array([segment['duration'] for segment in segments],
+                         dtype=np.float64))
+
+    with np.load(file_path, allow_pickle=False) as archive:
+        text = archive['text'].tobytes().decode('utf-8')
+        offsets = archive['offsets'].tolist()
+        texts = [text[begin:end]
+                 for begin, end in zip(offsets[:-1], offsets[1:])]
+        return (str(archive['title']),
+                str(archive['video_id']),
+                texts,
+                archive['starts'],
+                archive['durations'])
+
+
+def get_raw_transcript_paths(raw_directory: pathlib.Path
+                             ) -> List[pathlib.Path]:
+    """Returns the raw transcripts of a directory sorted by name.
+
+    If a video is stored in both formats, e.g. after migrating without
+    removing the JSON files, the compact file is returned.
+    """
+    paths: Dict[str, pathlib.Path] = {}
+    for raw_format in reversed(RAW_FORMATS):
+        for path in pathlib.Path(raw_directory).glob(f'*.{raw_format}'):
+            paths.setdefault(path.stem, path)
+    return sorted(paths.values())
+
+
+def migrate_raw_directory(raw_directory: pathlib.Path,
+                          remove_json: bool = False) -> List[pathlib.Path]:
+    """Converts the `Video_*.json` transcripts of a directory to the compact
+    format.
+
+    Args:
+        raw_directory (pathlib.Path): The `raw` directory of a playlist.
+        remove_json (bool): Whether to remove the JSON files once converted.
+    Returns:
+        List[pathlib.Path]: The paths of the new `.npz` files.
+    """
+    new_paths = []
+    for json_path in sorted(pathlib.Path(raw_directory).glob('Video_*.json')):
+        npz_path = json_path.with_suffix('.npz')
+        save_transcript(load_transcript(json_path), npz_path)
+        # Keep the modification time so that the embeddings of the playlist
+        # are not considered outdated
+        json_stat = json_path.stat()
+        os.utime(npz_path, ns=(json_stat.st_atime_ns, json_stat.st_mtime_ns))
+        new_paths.append(npz_path)
+        if remove_json:
+            json_path.unlink()
+    return new_paths
 
 
 def _replace_newlines(json_file: dict) -> None:
@@ -105,13 +319,89 @@ def _replace_newlines(json_file: dict) -> None:
         segment['text'] = segment['text'].replace('\n', ' ')
 
 
-def _get_chunk_indices(segment_lengths: List[int],
+def _iter_segments(texts: Iterable[str],
+                   starts: Iterable[float],
+                   durations: Iterable[float]) -> Iterator[_Segment]:
+    """Yields the segments of a transcript, with their newlines replaced by
+    spaces."""
+    elapsed = 0.0
+    for text, start, duration in zip(texts, starts, durations):
+        yield _Segment(text.replace('\n', ' '), start, duration, elapsed)
+        elapsed += duration
+
+
+def _iter_chunk_segments(segments: Iterable[_Segment],
+                         max_chunk_size: int,
+                         min_overlap_size: int
+                         ) -> Iterator[Tuple[int, int, List[_Segment]]]:
+    """Yields the chunks of a stream of segments as the segments arrive.
+
+    The chunks are the same as the ones of `_get_chunk_indices`. Only the
+    segments from the beginning of the current chunk are kept in a window,
+    and the window is cut to the last `min_overlap_size` characters after
+    each chunk, so the segments can come from a generator over a very long
+    transcript.
+
+    Args:
+        segments (Iterable[_Segment]): The segments, in order.
+        max_chunk_size (int): The maximum size of a chunk.
+        min_overlap_size (int): The minimum size of the overlap between two
+            chunks.
+    Yields:
+        Tuple[int, int, List[_Segment]]: The beginning and ending indices of
+            each chunk, and its segments.
+    """
+    # The segments from `beginning_index` to the last one read
+    window: Deque[Tuple[int, _Segment]] = collections.deque()
+    beginning_index = 0
+    ending_index = 0
+    # The size of the segments from `beginning_index` to `ending_index`
+    chunk_size = 0
+    n_segments = 0
+
+    def get_chunk() -> List[_Segment]:
+        return [segment for index, segment in window
+                if beginning_index <= index <= ending_index]
+
+    for index, segment in enumerate(segments):
+        n_segments += 1
+        window.append((index, segment))
+        segment_length = len(segment.text)
+        if chunk_size + segment_length + 1 < max_chunk_size:
+            chunk_size += segment_length + 1
+            ending_index = index
+            continue
+
+        yield beginning_index, ending_index, get_chunk()
+        # Drop the first segments while the rest of the window is larger
+        # than the overlap
+        while beginning_index < index:
+            first_length = len(window[0][1].text) + 1
+            if chunk_size - first_length <= min_overlap_size:
+                break
+            chunk_size -= first_length
+            beginning_index += 1
+            window.popleft()
+        chunk_size += segment_length + 1
+        ending_index = index
+
+    if n_segments > 0:
+        ending_index = n_segments - 1
+        yield beginning_index, ending_index, get_chunk()
+
+
+def _get_chunk_indices(segment_lengths: Union[Sequence[int], np.ndarray],
                        max_chunk_size: int,
                        min_overlap_size: int) -> List[Tuple[int, int]]:
     """Gets the indices of the chunks.
 
+    Instead of advancing the window a segment at a time, it finds every
+    boundary at once with binary searches over the prefix sums of
+    `segment_length + 1`, and then only jumps from chunk to chunk.
+
     Args:
-        segment_lengths (List[int]): The lengths of the segments.
+        segment_lengths (Union[Sequence[int], np.ndarray]): The lengths of
+            the segments.
         max_chunk_size (int): The maximum size of a chunk.
         min_overlap_size (int): The minimum size of the overlap between two
             chunks.
@@ -119,101 +409,316 @@ def _get_chunk_indices(segment_lengths: List[int],
         List[Tuple[int, int]]: A list of tuples with the beginning and ending
             indices of the chunks.
     """
-    # Split the transcript into chunks
+    n_segments = len(segment_lengths)
+    # `prefix[i]` is the size of the segments before `i`, so the window
+    # [begin, end] has a size of `prefix[end + 1] - prefix[begin]`.
+    prefix = np.zeros(n_segments + 1, dtype=np.int64)
+    np.cumsum(np.asarray(segment_lengths, dtype=np.int64) + 1,
+              out=prefix[1:])
+    # For each beginning index, the first segment that does not fit in a
+    # window that starts there.
+    first_overflow = (np.searchsorted(prefix, prefix + max_chunk_size,
+                                      side='left') - 1).tolist()
+    # For each segment that does not fit, the beginning of the overlap that
+    # is kept: segments are dropped while the rest of the window is larger
+    # than `min_overlap_size`.
+    overlap_beginning = (np.searchsorted(prefix, prefix - min_overlap_size,
+                                         side='left') - 1).tolist()
+
     chunks_indices = []
+    beginning_index = 0
+    first_unread_index = 0
+    while True:
+        index = max(first_overflow[beginning_index], first_unread_index)
+        if index >= n_segments:
+            break
+        chunks_indices.append((beginning_index, max(index - 1, 0)))
+        beginning_index = max(beginning_index, overlap_beginning[index])
+        first_unread_index = index + 1
+
+    chunks_indices.append((beginning_index, n_segments - 1))
+    return chunks_indices
 
-    current_beginning_index = 0
-    current_ending_index = 0
-    current_chunk_size = 0
 
-    for current_index, segment_length in enumerate(segment_lengths):
-        if current_chunk_size + segment_length + 1 < max_chunk_size:
-            current_chunk_size += segment_length + 1
-            current_ending_index = current_index
-            continue
+def _get_token_chunk_indices(token_counts: Union[Sequence[int], np.ndarray],
+                             max_chunk_tokens: int,
+                             min_overlap_tokens: int,
+                             separator_length: int = 0
+                             ) -> List[Tuple[int, int]]:
+    """Packs the segments into chunks of at most `max_chunk_tokens` tokens.
 
-        chunks_indices.append(
-            (current_beginning_index, current_ending_index))
-        # Calculate the overlap
-        # current_chunk_size += segment_lengths[current_beginning_index] + 1
-        segment_len = segment_lengths[current_beginning_index] + 1
-        while current_chunk_size - segment_len > min_overlap_size:
+    Each chunk takes as many segments as fit. The next chunk starts with the
+    shortest suffix of the previous chunk that has at least
+    `min_overlap_tokens` tokens, as long as that leaves room for the next
+    segment. The boundaries are found with binary searches over the prefix
+    sums of `token_count + separator_length`, so each chunk costs O(log n).
 
-            current_chunk_size -= segment_len
-            current_beginning_index += 1
-            segment_len = segment_lengths[current_beginning_index] + 1
+    A segment with more tokens than the limit is a chunk on its own.
 
-        current_chunk_size += segment_length + 1
-        current_ending_index = current_index
-        # current_chunk_size += 1
+    Args:
+        token_counts (Union[Sequence[int], np.ndarray]): The number of tokens
+            of each segment.
+        max_chunk_tokens (int): The maximum number of tokens of a chunk.
+        min_overlap_tokens (int): The minimum number of tokens shared by two
+            consecutive chunks.
+        separator_length (int): The number of tokens added between two
+            segments when they are joined.
+    Returns:
+        List[Tuple[int, int]]: A list of tuples with the beginning and ending
+            indices of the chunks.
+    """
+    n_segments = len(token_counts)
+    if n_segments == 0:
+        return []
+    # `prefix[i]` is the size of the segments before `i`, each followed by a
+    # separator. The chunk [start, end] has
+    # `prefix[end + 1] - prefix[start] - separator_length` tokens.
+    prefix = np.zeros(n_segments + 1, dtype=np.int64)
+    np.cumsum(np.asarray(token_counts, dtype=np.int64) + separator_length,
+              out=prefix[1:])
+    budget = max_chunk_tokens + separator_length
 
-    chunks_indices.append((current_beginning_index, len(segment_lengths) - 1))
+    chunks_indices = []
+    start = 0
+    while True:
+        end = int(np.searchsorted(prefix, prefix[start] + budget,
+                                  side='right')) - 2
+        end = max(end, start)
+        chunks_indices.append((start, end))
+        if end == n_segments - 1:
+            return chunks_indices
+
+        # The last start whose overlap has at least `min_overlap_tokens`
+        if min_overlap_tokens > 0:
+            chunk_end = prefix[end + 1] - separator_length
+            overlap_limit = chunk_end - min_overlap_tokens
+            next_start = int(np.searchsorted(prefix, overlap_limit,
+                                             side='right')) - 1
+        else:
+            next_start = end + 1
+        # The first start that leaves room for the next segment
+        min_start = int(np.searchsorted(prefix, prefix[end + 2] - budget,
+                                        side='left'))
+        start = min(max(next_start, min_start, start + 1), end + 1)
+
+
+def find_sentence_boundaries(texts: List[str]) -> np.ndarray:
+    """Returns whether each segment ends a sentence, judging by its
+    punctuation.
 
-    return chunks_indices
+    Args:
+        texts (List[str]): The text of each segment.
+    Returns:
+        np.ndarray: A boolean array with a value per segment.
+    """
+    return np.fromiter((_SENTENCE_END.search(text) is not None
+                        for text in texts),
+                       dtype=bool, count=len(texts))
 
 
-def create_chunked_data(file_path: pathlib.Path,
-                        max_chunk_size: int,
-                        min_overlap_size: int
-                        ) -> List[Dict[str, Union[str, List[str]]]]:
-    """Creates chunked data from a JSON file.
+def find_semantic_boundaries(segment_embeddings: np.ndarray,
+                             quantile: float = 0.2) -> np.ndarray:
+    """Returns whether the topic changes after each segment.
+
+    The topic changes where the cosine similarity between the embeddings of
+    two adjacent segments is among the lowest `quantile` of the transcript.
 
     Args:
-        file_path (str): The path to the JSON file.
+        segment_embeddings (np.ndarray): The embedding of each segment.
+        quantile (float): The fraction of the adjacent pairs that are
+            considered boundaries.
+    Returns:
+        np.ndarray: A boolean array with a value per segment. The last
+            segment is always a boundary.
+    """
+    n_segments = len(segment_embeddings)
+    boundaries = np.ones(n_segments, dtype=bool)
+    if n_segments < 2:
+        return boundaries
+    norms = np.linalg.norm(segment_embeddings, axis=1, keepdims=True)
+    normalized = segment_embeddings / np.maximum(norms, 1e-12)
+    similarities = np.einsum('ij,ij->i', normalized[:-1], normalized[1:])
+    boundaries[:-1] = similarities <= np.quantile(similarities, quantile)
+    return boundaries
+
+
+def _get_boundary_chunk_indices(segment_lengths: Union[Sequence[int],
+                                                       np.ndarray],
+                                boundaries: np.ndarray,
+                                max_chunk_size: int,
+                                min_overlap_size: int
+                                ) -> List[Tuple[int, int]]:
+    """Gets the indices of chunks that end at boundaries.
+
+    The segments are grouped into units that end at a boundary, e.g.
+    sentences. The units are packed into chunks with
+    `_get_token_chunk_indices`, so the overlap is made of whole units. The
+    segments of a unit longer than `max_chunk_size` are packed one by one.
+
+    Args:
+        segment_lengths (Union[Sequence[int], np.ndarray]): The lengths of
+            the segments.
+        boundaries (np.ndarray): Whether a chunk may end after each segment.
         max_chunk_size (int): The maximum size of a chunk.
         min_overlap_size (int): The minimum size of the overlap between two
             chunks.
     Returns:
-        List[Dict[str, Union[str, List[str]]]]: A dictionary with the chunked
-            data.
-        """
-    with open(file_path, 'r') as file:
-        json_file = json.load(file)
-
-    # Replace \n with a space
-    _replace_newlines(json_file)
-
-    segment_lengths = [len(json_file['transcript'][segment]['text']) for
-                       segment in range(len(json_file['transcript']))]
-
-    # Split the transcript into chunks
-    chunks_indices = _get_chunk_indices(segment_lengths,
-                                        max_chunk_size,
-                                        min_overlap_size)
-
-    # Now that we have the chunk indices, we can create the chunks
-    # chunks = [{
-    #     'text': ' '.join(
-    #         [segment['text'] for segment in
-    #          json_file['transcript'][chunk_index[0]:chunk_index[1] + 1]]),
-    #     'start': json_file['transcript'][chunk_index[0]]['start'],
-    #     'duration': sum(
-    #         segment['duration'] for segment in
-    #         json_file['transcript'][chunk_index[0]:chunk_index[1] + 1]),
-    #     'url': json_file['url'],
-    #     'title': json_file['title']}
-    #     for chunk_index in chunks_indices]
+        List[Tuple[int, int]]: A list of tuples with the beginning and ending
+            indices of the chunks.
+    """
+    segment_lengths = np.asarray(segment_lengths, dtype=np.int64)
+    n_segments = len(segment_lengths)
+    if n_segments == 0:
+        return []
+    boundaries = np.array(boundaries, dtype=bool)
+    boundaries[-1] = True
+    unit_ends = np.flatnonzero(boundaries)
+    unit_starts = np.concatenate(([0], unit_ends[:-1] + 1))
+    prefix = np.zeros(n_segments + 1, dtype=np.int64)
+    np.cumsum(segment_lengths + 1, out=prefix[1:])
+
+    units = []
+    for start, end in zip(unit_starts.tolist(), unit_ends.tolist()):
+        if prefix[end + 1] - prefix[start] - 1 <= max_chunk_size:
+            units.append((start, end))
+        else:
+            # Without boundaries, e.g. in captions without punctuation, the
+            # segments are packed one by one.
+            units.extend((index, index) for index in range(start, end + 1))
+
+    unit_sizes = [prefix[end + 1] - prefix[start] - 1
+                  for start, end in units]
+    return [(units[first][0], units[last][1])
+            for first, last in _get_token_chunk_indices(unit_sizes,
+                                                        max_chunk_size,
+                                                        min_overlap_size,
+                                                        separator_length=1)]
+
+
+def iter_chunked_data(file_path: pathlib.Path,
+                      max_chunk_size: int,
+                      min_overlap_size: int,
+                      token_counter: Optional[TokenCounter] = None,
+                      boundary_detector: Optional[BoundaryDetector] = None
+                      ) -> Iterator[Dict[str, Union[str, float, int]]]:
+    """Yields the chunks of a raw transcript one at a time.
+
+    The chunks are the same as the ones of `create_chunked_data`. When the
+    sizes are measured in characters, the segments are chunked as they are
+    read with `_iter_chunk_segments`, so only the segments of the current
+    chunk are kept besides the transcript. The token counts and the
+    boundaries are computed over the whole transcript, so with a
+    `token_counter` or a `boundary_detector` the chunk indices, the joined
+    text and the cumulative durations are computed upfront.
+
+    Args:
+        file_path (str): The path to the JSON or compact (`.npz`) file.
+        max_chunk_size (int): The maximum size of a chunk.
+        min_overlap_size (int): The minimum size of the overlap between two
+            chunks.
+        token_counter (TokenCounter, optional): A function that returns the
+            number of tokens of each text. If given, the sizes are measured
+            in tokens and the segments are packed with
+            `_get_token_chunk_indices`, which needs the whole transcript.
+            Otherwise, the sizes are measured in characters.
+        boundary_detector (BoundaryDetector, optional): A function that
+            returns whether a chunk may end after each segment, e.g.
+            `find_sentence_boundaries`. If given, the chunks end at those
+            boundaries whenever they fit. It cannot be combined with a
+            `token_counter`.
+    Yields:
+        Dict[str, Union[str, float, int]]: A dictionary with the `text`,
+            `start`, `duration`, `url`, `title`, `thumbnail` and `index` of
+            each chunk.
+    Raises:
+        ValueError: If both a `token_counter` and a `boundary_detector` are
+            given.
+    """
+    if token_counter is not None and boundary_detector is not None:
+        raise ValueError("A boundary_detector cannot be combined with a "
+                         "token_counter.")
+    title, video_id, texts, starts, durations = _load_transcript_columns(
+        file_path
+    )
+
+    import pytube
 
     base_url = 'https://www.youtube.com/watch?v='
-    video = pytube.YouTube(base_url + json_file['video_id'])
+    video = pytube.YouTube(base_url + video_id)
     thumbnail_url = video.thumbnail_url
-    chunks = []
-    for i, chunk_index in enumerate(chunks_indices):
-        text_list = []
-        duration_sum = 0
-        start, end = chunk_index
-        for segment in json_file['transcript'][start:end + 1]:
-            text_list.append(segment['text'])
-            duration_sum += segment['duration']
-        timestamp = str(int(json_file['transcript'][chunk_index[0]]['start']))
-        chunks.append({
-            'text': ' '.join(text_list),
-            'start': json_file['transcript'][chunk_index[0]]['start'],
-            'duration': duration_sum,
-            'url': base_url + json_file['video_id'] + f'&t={timestamp}s',
-            'title': json_file['title'],
+
+    segments = _iter_segments(texts, starts.tolist(), durations.tolist())
+    if token_counter is None and boundary_detector is None:
+        chunks = _iter_chunk_segments(segments, max_chunk_size,
+                                      min_overlap_size)
+    else:
+        chunks = _iter_indexed_chunks(list(segments), max_chunk_size,
+                                      min_overlap_size, token_counter,
+                                      boundary_detector)
+
+    for i, (_, _, chunk_segments) in enumerate(chunks):
+        first, last = chunk_segments[0], chunk_segments[-1]
+        timestamp = str(int(first.start))
+        yield {
+            'text': ' '.join(segment.text for segment in chunk_segments),
+            'start': first.start,
+            'duration': last.elapsed + last.duration - first.elapsed,
+            'url': base_url + video_id + f'&t={timestamp}s',
+            'title': title,
             'thumbnail': thumbnail_url,
             'index': i
-        })
+        }
+
+
+def _iter_indexed_chunks(segments: List[_Segment],
+                         max_chunk_size: int,
+                         min_overlap_size: int,
+                         token_counter: Optional[TokenCounter] = None,
+                         boundary_detector: Optional[BoundaryDetector] = None
+                         ) -> Iterator[Tuple[int, int, List[_Segment]]]:
+    """Yields the chunks of a whole transcript like `_iter_chunk_segments`,
+    packing them in tokens or at boundaries."""
+    texts = [segment.text for segment in segments]
+    if boundary_detector is not None:
+        segment_lengths = np.fromiter((len(text) for text in texts),
+                                      dtype=np.int64, count=len(texts))
+        with instrumentation.span("ingest.find_boundaries"):
+            boundaries = boundary_detector(texts)
+        chunks_indices = _get_boundary_chunk_indices(segment_lengths,
+                                                     boundaries,
+                                                     max_chunk_size,
+                                                     min_overlap_size)
+    else:
+        assert token_counter is not None
+        with instrumentation.span("ingest.count_tokens"):
+            token_counts = token_counter(texts)
+            # The segments of a chunk are joined with a space, which some
+            # tokenizers count as a token
+            separator_length = token_counter([' '])[0]
+        chunks_indices = _get_token_chunk_indices(token_counts,
+                                                  max_chunk_size,
+                                                  min_overlap_size,
+                                                  separator_length)
+    for start, end in chunks_indices:
+        yield start, end, segments[start:end + 1]
+
+
+@instrumentation.timed("ingest.create_chunked_data")
+def create_chunked_data(file_path: pathlib.Path,
+                        max_chunk_size: int,
+                        min_overlap_size: int
+                        ) -> List[Dict[str, Union[str, float, int]]]:
+    """Creates chunked data from a raw transcript.
 
-    return chunks
+    Args:
+        file_path (str): The path to the JSON or compact (`.npz`) file.
+        max_chunk_size (int): The maximum size of a chunk.
+        min_overlap_size (int): The minimum size of the overlap between two
+            chunks.
+    Returns:
+        List[Dict[str, Union[str, float, int]]]: A dictionary per chunk
+            (see `iter_chunked_data`).
+        """
+    return list(iter_chunked_data(file_path,
+                                  max_chunk_size,
+                                  min_overlap_size))
@@ -0,0 +1,85 @@
+"""Per-video checkpoints of the embeddings of a retriever.
+
+`create_embeddings_pipeline` records every video it finishes in
+`manifest.json`, with the modification time of its raw transcript and its
+number of chunks. With `resume`, an interrupted run skips the videos that
+were completed with the same configuration and whose transcript did not
+change since.
+
+The manifest is rewritten atomically after each video, so a crash leaves
+either the previous or the new checkpoint, never a partial file.
+"""
+import json
+import os
+import pathlib
+import tempfile
+import time
+from typing import Any, Dict, Union
+
+PathLike = Union[str, os.PathLike]
+
+MANIFEST_FILE_NAME = "manifest.json"
+
+
+def write_json_atomically(path: PathLike, data: Any) -> None:
+    """Writes a JSON file to a temporary file and renames it, so readers
+    never see a partial file."""
+    path = pathlib.Path(path)
+    file_descriptor, temporary_path = tempfile.mkstemp(dir=path.parent,
+                                                       suffix=".json")
+    try:
+        with os.fdopen(file_descriptor, "w", encoding="utf-8") as file:
+            json.dump(data, file)
+        os.replace(temporary_path, path)
+    except BaseException:
+        os.unlink(temporary_path)
+        raise
+
+
+class EmbeddingManifest:
+    """The videos of a retriever that are already embedded.
+
+    Args:
+        retriever_directory (PathLike): The directory of the retriever.
+        config (Dict[str, Any]): The parameters that determine the chunks
+            and the embeddings. The checkpoints of a manifest with another
+            configuration are discarded.
+    """
+
+    def __init__(self, retriever_directory: PathLike, config: Dict[str, Any]):
+        self.retriever_directory = pathlib.Path(retriever_directory)
+        self.path = self.retriever_directory / MANIFEST_FILE_NAME
+        self.config = config
+        self.videos: Dict[str, Dict[str, Any]] = {}
+        if self.path.exists():
+            with open(self.path, "r", encoding="utf-8") as file:
+                manifest = json.load(file)
+            if manifest.get("config") == config:
+                self.videos = manifest.get("videos", {})
+
+    def is_completed(self, video_name: str, raw_path: pathlib.Path) -> bool:
+        """Returns whether a video was embedded from its current transcript
+        and its files are still there."""
+        entry = self.videos.get(video_name)
+        if entry is None or entry["raw_mtime"] != raw_path.stat().st_mtime:
+            return False
+        return all(
+            (self.retriever_directory / directory / f"{video_name}{suffix}"
+             ).exists()
+            for directory, suffix in (("chunked_data", ".json"),
+                                      ("embeddings", ".npy"))
+        )
+
+    def mark_completed(self, video_name: str, raw_path: pathlib.Path,
+                       n_chunks: int) -> None:
+        """Records that a video is embedded and saves the manifest."""
+        self.videos[video_name] = {"raw_mtime": raw_path.stat().st_mtime,
+                                   "n_chunks": n_chunks,
+                                   "completed": time.time()}
+        self.save()
+
+    def save(self) -> None:
+        """Writes the manifest."""
+        self.retriever_directory.mkdir(parents=True, exist_ok=True)
+        write_json_atomically(self.path, {"config": self.config,
+                                          "videos": self.videos})
@@ -0,0 +1,270 @@
+"""Client of the OpenAI embeddings endpoint for ingesting whole playlists.
+
+Embedding a playlist is dominated by the latency of the requests, not by the
+throughput of the API, so `OpenAIEmbeddingClient`:
+
+- Packs the texts into requests of up to `max_tokens_per_request` tokens.
+- Keeps up to `max_concurrent_requests` requests in flight.
+- Respects the requests-per-minute and tokens-per-minute limits of the
+  account with a token bucket per limit, waiting before a request would
+  exceed them.
+- Retries the requests rejected with 429 (or a server error) with an
+  exponential backoff, honoring the `Retry-After` header. The requests that
+  fail to connect, or whose connection is reset, are retried the same way.
+
+It sends the requests with the standard library and is a langchain
+`Embeddings`, so it can replace `langchain.embeddings.OpenAIEmbeddings`. The
+endpoint is read from `OPENAI_API_BASE`, which also allows testing it
+against a local server. As it imports langchain, this module is not imported
+by `ask_youtube_playlists.data_processing`.
+"""
+import concurrent.futures
+import json
+import os
+import random
+import threading
+import time
+import urllib.error
+import urllib.request
+from typing import List, Optional, Sequence, Tuple
+
+from langchain.embeddings.base import Embeddings
+
+from ask_youtube_playlists import instrumentation
+from .download_transcripts import TokenCounter
+
+OPENAI_API_BASE = "https://api.openai.com/v1"
+# Default limits of text-embedding-ada-002
+REQUESTS_PER_MINUTE = 3_000
+TOKENS_PER_MINUTE = 1_000_000
+MAX_TOKENS_PER_REQUEST = 8_191
+MAX_INPUTS_PER_REQUEST = 2_048
+# Status codes of the requests that are retried
+RETRY_STATUS_CODES = {429, 500, 502, 503, 504}
+
+
+class TokenBucket:
+    """Thread-safe token bucket that refills at a constant rate.
+
+    Args:
+        rate (float): The number of tokens added per second.
+        capacity (float): The maximum number of tokens in the bucket. The
+            bucket starts full.
+    """
+
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self._tokens = capacity
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _refill(self) -> None:
+        now = time.monotonic()
+        self._tokens = min(self.capacity,
+                           self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def acquire(self, amount: float) -> float:
+        """Waits until `amount` tokens are available and takes them.
+
+        An amount larger than the capacity waits for a full bucket, so a
+        single large request is not blocked forever.
+
+        Returns:
+            float: The number of seconds waited.
+        """
+        amount = min(amount, self.capacity)
+        waited = 0.0
+        while True:
+            with self._lock:
+                self._refill()
+                if self._tokens >= amount:
+                    self._tokens -= amount
+                    return waited
+                wait = (amount - self._tokens) / self.rate
+            time.sleep(wait)
+            waited += wait
+
+
+def pack_requests(token_counts: Sequence[int],
+                  max_tokens_per_request: int,
+                  max_inputs_per_request: int = MAX_INPUTS_PER_REQUEST
+                  ) -> List[Tuple[int, int]]:
+    """Groups consecutive texts into requests.
+
+    Args:
+        token_counts (Sequence[int]): The number of tokens of each text.
+        max_tokens_per_request (int): The maximum number of tokens of a
+            request. A longer text is sent on its own.
+        max_inputs_per_request (int): The maximum number of texts of a
+            request.
+
+    Returns:
+        List[Tuple[int, int]]: The `start` and `end` of the texts of each
+        request.
+    """
+    requests = []
+    start = 0
+    n_tokens = 0
+    for end, count in enumerate(token_counts):
+        is_full = end - start == max_inputs_per_request or \
+            n_tokens + count > max_tokens_per_request
+        if end > start and is_full:
+            requests.append((start, end))
+            start = end
+            n_tokens = 0
+        n_tokens += count
+    if start < len(token_counts):
+        requests.append((start, len(token_counts)))
+    return requests
+
+
+def _estimate_tokens(texts: List[str]) -> List[int]:
+    """Estimates the number of tokens of each text, about 4 characters per
+    token in English."""
+    return [len(text) // 4 + 1 for text in texts]
+
+
+class OpenAIEmbeddingClient(Embeddings):
+    """Concurrent and rate limited client of the OpenAI embeddings endpoint.
+
+    Args:
+        model (str): The embedding model. Defaults to
+            "text-embedding-ada-002".
+        api_key (str, optional): Defaults to the `OPENAI_API_KEY`
+            environment variable.
+        api_base (str, optional): Defaults to the `OPENAI_API_BASE`
+            environment variable or to the OpenAI API.
+        token_counter (TokenCounter, optional): Counts the tokens of each
+            text to pack the requests and to respect the tokens-per-minute
+            limit. Defaults to an estimate from the number of characters.
+        max_tokens_per_request (int): The maximum number of tokens of a
+            request. Defaults to 8191.
+        max_concurrent_requests (int): The maximum number of requests in
+            flight. Defaults to 8.
+        requests_per_minute (float): The requests-per-minute limit. Defaults
+            to 3000.
+        tokens_per_minute (float): The tokens-per-minute limit. Defaults to
+            1000000.
+        max_retries (int): The number of times a rejected or failed request
+            is retried. Defaults to 6.
+        initial_backoff (float): The seconds waited before the first retry.
+            It doubles with every retry, up to `max_backoff`. Defaults to 1.
+        max_backoff (float): Defaults to 60.
+        timeout (float): The timeout of each request in seconds. Defaults to
+            60.
+    """
+
+    def __init__(self,
+                 model: str = "text-embedding-ada-002",
+                 api_key: Optional[str] = None,
+                 api_base: Optional[str] = None,
+                 token_counter: Optional[TokenCounter] = None,
+                 max_tokens_per_request: int = MAX_TOKENS_PER_REQUEST,
+                 max_concurrent_requests: int = 8,
+                 requests_per_minute: float = REQUESTS_PER_MINUTE,
+                 tokens_per_minute: float = TOKENS_PER_MINUTE,
+                 max_retries: int = 6,
+                 initial_backoff: float = 1,
+                 max_backoff: float = 60,
+                 timeout: float = 60):
+        self.model = model
+        self.api_key = api_key or os.environ.get("OPENAI_API_KEY", "")
+        api_base = api_base or os.environ.get("OPENAI_API_BASE",
+                                              OPENAI_API_BASE)
+        self.api_base = api_base.rstrip("/")
+        self.token_counter = token_counter or _estimate_tokens
+        self.max_tokens_per_request = max_tokens_per_request
+        self.max_concurrent_requests = max_concurrent_requests
+        self.max_retries = max_retries
+        self.initial_backoff = initial_backoff
+        self.max_backoff = max_backoff
+        self.timeout = timeout
+        # Start with a tenth of the minute budget so that a burst at start-up
+        # does not exhaust it
+        self._request_bucket = TokenBucket(requests_per_minute / 60,
+                                           max(1.0, requests_per_minute / 10))
+        self._token_bucket = TokenBucket(tokens_per_minute / 60,
+                                         max(1.0, tokens_per_minute / 10))
+
+    def _post(self, texts: List[str]) -> List[List[float]]:
+        """Sends an embeddings request and returns the embedding of each
+        text, in order."""
+        request = urllib.request.Request(
+            f"{self.api_base}/embeddings",
+            data=json.dumps({"model": self.model,
+                             "input": texts}).encode("utf-8"),
+            headers={"Content-Type": "application/json",
+                     "Authorization": f"Bearer {self.api_key}"},
+        )
+        with urllib.request.urlopen(request, timeout=self.timeout) as response:
+            data = json.loads(response.read().decode("utf-8"))["data"]
+        data.sort(key=lambda x: x["index"])
+        return [item["embedding"] for item in data]
+
+    def _backoff(self, attempt: int, error: Exception) -> float:
+        headers = getattr(error, "headers", None)
+        retry_after = headers.get("Retry-After") if headers else None
+        if retry_after is not None:
+            try:
+                return float(retry_after)
+            except ValueError:
+                pass
+        backoff = min(self.max_backoff, self.initial_backoff * 2 ** attempt)
+        # Jitter, so that the requests rejected together are not retried
+        # together
+        return backoff * random.uniform(0.5, 1)
+
+    def _embed_request(self, texts: List[str], n_tokens: int
+                       ) -> List[List[float]]:
+        """Sends a request within the rate limits, retrying it if it is
+        rejected."""
+        for attempt in range(self.max_retries + 1):
+            waited = self._request_bucket.acquire(1)
+            waited += self._token_bucket.acquire(n_tokens)
+            instrumentation.increment("openai.rate_limit_wait", waited)
+            try:
+                with instrumentation.span("openai.request"):
+                    return self._post(texts)
+            except urllib.error.HTTPError as error:
+                if error.code not in RETRY_STATUS_CODES or \
+                        attempt == self.max_retries:
+                    raise
+                instrumentation.increment("openai.retries")
+                time.sleep(self._backoff(attempt, error))
+            except (urllib.error.URLError, ConnectionError) as error:
+                # The connection failed or was reset, e.g. by a proxy
+                if attempt == self.max_retries:
+                    raise
+                instrumentation.increment("openai.retries")
+                time.sleep(self._backoff(attempt, error))
+        raise AssertionError("Unreachable")
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        """Embeds the texts with concurrent requests.
+
+        Returns:
+            List[List[float]]: The embedding of each text, in order.
+        """
+        if not texts:
+            return []
+        token_counts = self.token_counter(list(texts))
+        requests = pack_requests(token_counts, self.max_tokens_per_request)
+        instrumentation.increment("openai.requests", len(requests))
+        embeddings: List[List[float]] = []
+        with concurrent.futures.ThreadPoolExecutor(
+                min(self.max_concurrent_requests, len(requests))
+        ) as executor:
+            futures = [
+                executor.submit(self._embed_request, list(texts[start:end]),
+                                sum(token_counts[start:end]))
+                for start, end in requests
+            ]
+            for future in futures:
+                embeddings.extend(future.result())
+        return embeddings
+
+    def embed_query(self, text: str) -> List[float]:
+        """Embeds a single text."""
+        return self.embed_documents([text])[0]
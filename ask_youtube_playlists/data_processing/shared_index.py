@@ -0,0 +1,140 @@
+"""Read-only embedding indexes shared by every process of a host.
+
+By default, each process that opens a retriever loads its own copy of the
+embeddings. Instead, the normalized embeddings of a retriever can be written
+once to `index/embeddings.npy` and memory-mapped read-only: the pages of the
+file are kept in the page cache of the OS and shared by every process that
+maps it, so N processes use one physical copy.
+
+Inside a process, `acquire_shared_index` keeps a single mapping per
+retriever with a reference count, and `release_shared_index` drops it when
+the last user releases it.
+
+The index file is rebuilt when it is older than the embeddings. It is written
+to a temporary file and renamed, so processes that start at the same time
+never map a partial file.
+"""
+import os
+import pathlib
+import tempfile
+import threading
+from typing import Dict, List, Union
+
+import numpy as np
+
+from ask_youtube_playlists import instrumentation
+
+PathLike = Union[str, os.PathLike]
+
+INDEX_DIRECTORY = "index"
+INDEX_FILE_NAME = "embeddings.npy"
+
+# Path of each index file -> [mapped array, number of references]
+_shared_indexes: Dict[pathlib.Path, List] = {}
+_shared_indexes_lock = threading.Lock()
+
+
+def get_index_path(retriever_directory: PathLike) -> pathlib.Path:
+    """Returns the path of the index file of a retriever."""
+    return pathlib.Path(retriever_directory).joinpath(INDEX_DIRECTORY,
+                                                      INDEX_FILE_NAME)
+
+
+def _get_embedding_paths(retriever_directory: PathLike
+                         ) -> List[pathlib.Path]:
+    embeddings_directory = pathlib.Path(retriever_directory) / "embeddings"
+    return sorted(embeddings_directory.glob("*.npy"))
+
+
+def is_index_outdated(retriever_directory: PathLike) -> bool:
+    """Returns whether the index file of a retriever is missing or older than
+    its embeddings."""
+    index_path = get_index_path(retriever_directory)
+    if not index_path.exists():
+        return True
+    index_mtime = index_path.stat().st_mtime
+    # Removing a video changes the modification time of the directory
+    embeddings_directory = pathlib.Path(retriever_directory) / "embeddings"
+    paths = [embeddings_directory] + \
+        _get_embedding_paths(retriever_directory)
+    return any(path.stat().st_mtime > index_mtime for path in paths)
+
+
+def build_index(retriever_directory: PathLike) -> pathlib.Path:
+    """Writes the normalized embeddings of every video of a retriever, in the
+    order of the videos, to its index file.
+
+    Returns:
+        pathlib.Path: The path of the index file.
+    """
+    index_path = get_index_path(retriever_directory)
+    index_path.parent.mkdir(exist_ok=True)
+    with instrumentation.span("shared_index.build"):
+        video_embeddings = [np.load(str(path)) for path in
+                            _get_embedding_paths(retriever_directory)]
+        video_embeddings = [embeddings for embeddings in video_embeddings
+                            if len(embeddings)]
+        if video_embeddings:
+            matrix = np.vstack(video_embeddings).astype(np.float32)
+        else:
+            matrix = np.empty((0, 0), dtype=np.float32)
+        norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+        norms[norms == 0] = 1
+        matrix /= norms
+
+        file_descriptor, temporary_path = tempfile.mkstemp(
+            dir=index_path.parent, suffix=".npy"
+        )
+        try:
+            with os.fdopen(file_descriptor, "wb") as file:
+                np.save(file, matrix)
+            os.replace(temporary_path, index_path)
+        except BaseException:
+            os.unlink(temporary_path)
+            raise
+    return index_path
+
+
+def acquire_shared_index(retriever_directory: PathLike) -> np.ndarray:
+    """Returns the read-only, memory-mapped index of a retriever.
+
+    The index file is built first if it is missing or outdated. Every call
+    must be paired with a `release_shared_index`.
+
+    Returns:
+        np.ndarray: The normalized embeddings of every document of the
+        retriever, with a row per document.
+    """
+    index_path = get_index_path(retriever_directory).resolve()
+    with _shared_indexes_lock:
+        entry = _shared_indexes.get(index_path)
+        if entry is None:
+            if is_index_outdated(retriever_directory):
+                build_index(retriever_directory)
+            matrix = np.load(str(index_path), mmap_mode="r")
+            entry = _shared_indexes[index_path] = [matrix, 0]
+        entry[1] += 1
+        return entry[0]
+
+
+def release_shared_index(retriever_directory: PathLike) -> None:
+    """Releases a reference to the index of a retriever, and forgets the
+    mapping when no reference is left."""
+    index_path = get_index_path(retriever_directory).resolve()
+    with _shared_indexes_lock:
+        entry = _shared_indexes.get(index_path)
+        if entry is None:
+            return
+        entry[1] -= 1
+        if entry[1] <= 0:
+            # The file is unmapped once the arrays that view it are
+            # garbage collected
+            del _shared_indexes[index_path]
+
+
+def get_shared_index_references() -> Dict[pathlib.Path, int]:
+    """Returns the number of references to each index mapped by this
+    process."""
+    with _shared_indexes_lock:
+        return {path: references
+                for path, (_, references) in _shared_indexes.items()}
@@ -31,3 +31,19 @@ def get_available_directories(data_directory: pathlib.Path) -> List[str]:
                            for directory in data_directory.iterdir()
                            if directory.is_dir()]
     return available_playlists
+
+
+def get_retriever_directory_name(embedding_model_name: str,
+                                 max_chunk_size: int,
+                                 min_overlap_size: int,
+                                 chunking_mode: str = "characters") -> str:
+    """Returns the name of the directory of a retriever.
+
+    The retrievers of a playlist are stored in
+    `data/<playlist>/<model>_<chunk_size>_<overlap>`. The retrievers whose
+    chunks are measured in tokens have a `_tokens` suffix.
+    """
+    name = f"{embedding_model_name}_{max_chunk_size}_{min_overlap_size}"
+    if chunking_mode != "characters":
+        name += f"_{chunking_mode}"
+    return name
@@ -0,0 +1,187 @@
+"""Persistent vector store for the chunks of a retriever, backed by Chroma.
+
+The chunks of a retriever can be stored in a Chroma collection inside the
+`chroma` folder of the retriever directory. Chroma persists the documents and
+their metadata with DuckDB and Parquet, and the embeddings in an HNSW index,
+so a retriever can answer questions without loading every embedding in
+memory.
+
+The embeddings pipeline inserts the chunks in batches, and each video is
+upserted on its own: its previous chunks are deleted first, so a video can be
+re-embedded without rebuilding the collection.
+
+`chromadb` is imported when a store is opened, so the in-memory backend does
+not need it.
+"""
+import os
+import pathlib
+from typing import (Any, Dict, List, Optional, Sequence, Tuple, Union,
+                    TYPE_CHECKING)
+
+import numpy as np
+
+from ask_youtube_playlists import instrumentation
+
+if TYPE_CHECKING:
+    from langchain.schema import Document
+
+PathLike = Union[str, os.PathLike]
+
+VECTOR_STORE_TYPES = ["in-memory", "chroma-db"]
+COLLECTION_NAME = "documents"
+# The metadata key with the name of the video of each chunk
+VIDEO_KEY = "video"
+
+
+def _missing_embeddings(texts: List[str]) -> List[List[float]]:
+    raise ValueError("The embeddings must be computed with the embedding "
+                     "model of the retriever and passed to the vector "
+                     "store.")
+
+
+class ChromaVectorStore:
+    """A persistent Chroma collection with the chunks of a retriever.
+
+    Args:
+        persist_directory (PathLike): The directory where Chroma stores the
+            collection.
+    """
+
+    def __init__(self, persist_directory: PathLike):
+        import chromadb
+        from chromadb.config import Settings
+
+        self.persist_directory = pathlib.Path(persist_directory)
+        self._client = chromadb.Client(Settings(
+            chroma_db_impl="duckdb+parquet",
+            persist_directory=str(self.persist_directory),
+            anonymized_telemetry=False,
+        ))
+        self._collection = self._client.get_or_create_collection(
+            COLLECTION_NAME,
+            metadata={"hnsw:space": "cosine"},
+            embedding_function=_missing_embeddings,
+        )
+
+    def count(self) -> int:
+        """Returns the number of chunks in the collection."""
+        return self._collection.count()
+
+    def delete_video(self, video_name: str) -> None:
+        """Deletes the chunks of a video, if any."""
+        self._collection.delete(where={VIDEO_KEY: video_name})
+
+    def add(self,
+            video_name: str,
+            chunks: Sequence[Dict[str, Any]],
+            embeddings: np.ndarray) -> None:
+        """Adds chunks of a video with their embeddings.
+
+        Args:
+            video_name (str): The name of the video, e.g. `Video_1`.
+            chunks (Sequence[Dict[str, Any]]): The chunks, as created by
+                `iter_chunked_data`.
+            embeddings (np.ndarray): The embedding of each chunk.
+        """
+        if not chunks:
+            return
+        with instrumentation.span("vector_store.add"):
+            self._collection.add(
+                ids=[f"{video_name}/{chunk['index']}" for chunk in chunks],
+                embeddings=np.asarray(embeddings, dtype=np.float32).tolist(),
+                documents=[str(chunk["text"]) for chunk in chunks],
+                metadatas=[{**{key: value for key, value in chunk.items()
+                               if key != "text"},
+                            VIDEO_KEY: video_name}
+                           for chunk in chunks],
+            )
+
+    def upsert_video(self,
+                     video_name: str,
+                     chunks: Sequence[Dict[str, Any]],
+                     embeddings: np.ndarray) -> None:
+        """Replaces the chunks of a video."""
+        self.delete_video(video_name)
+        self.add(video_name, chunks, embeddings)
+
+    def persist(self) -> None:
+        """Writes the collection and its index to the persist directory."""
+        self._client.persist()
+
+    def query(self,
+              question_embeddings: np.ndarray,
+              n_documents: int,
+              where: Optional[Dict[str, Any]] = None
+              ) -> List[List[Tuple["Document", float]]]:
+        """Returns the most similar chunks for each question.
+
+        Args:
+            question_embeddings (np.ndarray): A matrix with a row per question.
+            n_documents (int): The number of chunks to retrieve per question.
+            where (Dict[str, Any], optional): A Chroma metadata filter, e.g.
+                `{"title": "Episode 1"}` or `{"start": {"$gte": 600}}`.
+
+        Returns:
+            List[List[Tuple[Document, float]]]: For each question, the
+            documents and their cosine similarity, sorted in descending
+            order.
+        """
+        return [document_scores for document_scores, _ in
+                self._query(question_embeddings, n_documents, where)]
+
+    def query_with_embeddings(self,
+                              question_embeddings: np.ndarray,
+                              n_documents: int,
+                              where: Optional[Dict[str, Any]] = None
+                              ) -> List[Tuple[List[Tuple["Document", float]],
+                                              np.ndarray]]:
+        """Returns the same as `query`, with a matrix of the embeddings of
+        the chunks retrieved for each question, e.g. to diversify them."""
+        return self._query(question_embeddings, n_documents, where,
+                           include_embeddings=True)
+
+    def _query(self,
+               question_embeddings: np.ndarray,
+               n_documents: int,
+               where: Optional[Dict[str, Any]] = None,
+               include_embeddings: bool = False
+               ) -> List[Tuple[List[Tuple["Document", float]], np.ndarray]]:
+        from langchain.schema import Document
+
+        question_embeddings = np.atleast_2d(question_embeddings)
+        n_documents = min(n_documents, self.count())
+        if n_documents <= 0 or len(question_embeddings) == 0:
+            return [([], np.empty((0, 0), dtype=np.float32))
+                    for _ in question_embeddings]
+
+        include = ["documents", "metadatas", "distances"]
+        if include_embeddings:
+            include.append("embeddings")
+        with instrumentation.span("vector_store.query"):
+            response = self._collection.query(
+                query_embeddings=question_embeddings.astype(
+                    np.float32
+                ).tolist(),
+                n_results=n_documents,
+                where=where,
+                include=include,
+            )
+        all_embeddings = response.get("embeddings") or \
+            [None] * len(response["documents"])
+        results = []
+        for texts, metadatas, distances, embeddings in zip(
+                response["documents"], response["metadatas"],
+                response["distances"], all_embeddings):
+            document_scores = [
+                (Document(page_content=text,
+                          metadata={key: value
+                                    for key, value in metadata.items()
+                                    if key != VIDEO_KEY}),
+                 1 - distance)
+                for text, metadata, distance in zip(texts, metadatas,
+                                                    distances)
+            ]
+            matrix = np.array(embeddings if embeddings is not None else [],
+                              dtype=np.float32)
+            results.append((document_scores, matrix))
+        return results
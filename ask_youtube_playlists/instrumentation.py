@@ -0,0 +1,321 @@
+"""Lightweight timing spans and counters for the question answering flow.
+
+Instrumentation is disabled by default. While disabled, `span` returns a
+shared no-op context manager and functions decorated with `timed` are called
+directly, so the overhead is a single flag check. It can be enabled with
+`enable()` or by setting the `ASK_YOUTUBE_PLAYLISTS_INSTRUMENTATION`
+environment variable to "1".
+
+The collected metrics can be exported as structured logs (`log_metrics`) or
+in the Prometheus text exposition format (`to_prometheus_text` and
+`start_metrics_server`). A `SpanRecorder` collects the spans of a single
+request, which is what the question answering page uses to show a per-request
+breakdown even when global instrumentation is disabled.
+"""
+import contextlib
+import contextvars
+import functools
+import http.server
+import json
+import logging
+import os
+import threading
+import time
+from dataclasses import dataclass
+from typing import Any, Callable, Dict, List, Optional, TypeVar
+
+logger = logging.getLogger(__name__)
+
+F = TypeVar("F", bound=Callable[..., Any])
+
+ENVIRONMENT_VARIABLE = "ASK_YOUTUBE_PLAYLISTS_INSTRUMENTATION"
+METRICS_PREFIX = "ask_youtube_playlists"
+
+
+@dataclass
+class SpanRecord:
+    """A finished timing span.
+
+    Attributes:
+        name: The name of the span, e.g. `retriever.embed_query`.
+        start: The `time.perf_counter` value when the span started.
+        duration: The duration of the span in seconds.
+    """
+    name: str
+    start: float
+    duration: float
+
+
+@dataclass
+class TimingStats:
+    """Aggregated statistics of all the spans with the same name.
+
+    Attributes:
+        count: The number of finished spans.
+        total: The sum of their durations in seconds.
+        max: The longest duration in seconds.
+    """
+    count: int = 0
+    total: float = 0.0
+    max: float = 0.0
+
+    @property
+    def mean(self) -> float:
+        """Returns the mean duration in seconds."""
+        return self.total / self.count if self.count else 0.0
+
+
+class SpanRecorder:
+    """Collects the spans finished in the current context.
+
+    It can be used as a context manager or with `start` and `stop`, which is
+    convenient in Streamlit scripts where the recorded code is not inside a
+    single block.
+    """
+
+    def __init__(self):
+        self.spans: List[SpanRecord] = []
+        self._token: Optional[contextvars.Token] = None
+
+    def start(self) -> "SpanRecorder":
+        """Starts recording the spans of the current context."""
+        self._token = _RECORDER.set(self)
+        return self
+
+    def stop(self) -> None:
+        """Stops recording. The recorded spans are kept in `spans`."""
+        if self._token is not None:
+            _RECORDER.reset(self._token)
+            self._token = None
+
+    def __enter__(self) -> "SpanRecorder":
+        return self.start()
+
+    def __exit__(self, *exc_info) -> None:
+        self.stop()
+
+    def breakdown(self) -> List[Dict[str, Any]]:
+        """Returns the recorded spans as rows, in the order they started.
+
+        Each row contains the span `name`, its `start` offset in milliseconds
+        from the first recorded span and its `duration_ms`.
+        """
+        if not self.spans:
+            return []
+        spans = sorted(self.spans, key=lambda span: span.start)
+        origin = spans[0].start
+        return [{"name": span.name,
+                 "start_ms": round((span.start - origin) * 1000, 3),
+                 "duration_ms": round(span.duration * 1000, 3)}
+                for span in spans]
+
+
+_enabled = os.environ.get(ENVIRONMENT_VARIABLE, "0") == "1"
+_lock = threading.Lock()
+_timings: Dict[str, TimingStats] = {}
+_counters: Dict[str, float] = {}
+_RECORDER: contextvars.ContextVar[Optional[SpanRecorder]] = \
+    contextvars.ContextVar("span_recorder", default=None)
+
+
+def enable() -> None:
+    """Enables the global collection of spans and counters."""
+    global _enabled
+    _enabled = True
+
+
+def disable() -> None:
+    """Disables the global collection of spans and counters."""
+    global _enabled
+    _enabled = False
+
+
+def is_enabled() -> bool:
+    """Returns whether the global instrumentation is enabled."""
+    return _enabled
+
+
+def reset() -> None:
+    """Removes all the aggregated timings and counters."""
+    with _lock:
+        _timings.clear()
+        _counters.clear()
+
+
+def _record(name: str, start: float, duration: float) -> None:
+    """Aggregates a finished span and forwards it to the active recorder."""
+    recorder = _RECORDER.get()
+    if recorder is not None:
+        recorder.spans.append(SpanRecord(name, start, duration))
+    if not _enabled:
+        return
+    with _lock:
+        stats = _timings.get(name)
+        if stats is None:
+            stats = _timings[name] = TimingStats()
+        stats.count += 1
+        stats.total += duration
+        stats.max = max(stats.max, duration)
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug("span %s took %.3f ms", name, duration * 1000,
+                     extra={"span": name, "duration": duration})
+
+
+class _Span:
+    """Context manager that measures the time spent inside it."""
+    __slots__ = ("name", "start")
+
+    def __init__(self, name: str):
+        self.name = name
+        self.start = 0.0
+
+    def __enter__(self) -> "_Span":
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        _record(self.name, self.start, time.perf_counter() - self.start)
+
+
+_NULL_SPAN = contextlib.nullcontext()
+
+
+def span(name: str) -> contextlib.AbstractContextManager:
+    """Returns a context manager that times the code inside it.
+
+    Args:
+        name (str): The name of the span. Dots are used to group related
+            spans, e.g. `retriever.embed_query`.
+    """
+    if _enabled or _RECORDER.get() is not None:
+        return _Span(name)
+    return _NULL_SPAN
+
+
+def timed(name: str) -> Callable[[F], F]:
+    """Decorator that records a span each time the function is called.
+
+    Args:
+        name (str): The name of the span.
+    """
+    def decorator(func: F) -> F:
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if not _enabled and _RECORDER.get() is None:
+                return func(*args, **kwargs)
+            with _Span(name):
+                return func(*args, **kwargs)
+        return wrapper  # type: ignore
+    return decorator
+
+
+def increment(name: str, value: float = 1) -> None:
+    """Increments a counter. It is a no-op if instrumentation is disabled.
+
+    Args:
+        name (str): The name of the counter, e.g. `ingest.chunks`.
+        value (float): The amount to add. Defaults to 1.
+    """
+    if not _enabled:
+        return
+    with _lock:
+        _counters[name] = _counters.get(name, 0) + value
+
+
+def get_timings() -> Dict[str, TimingStats]:
+    """Returns a snapshot of the aggregated timings by span name."""
+    with _lock:
+        return {name: TimingStats(stats.count, stats.total, stats.max)
+                for name, stats in _timings.items()}
+
+
+def get_counters() -> Dict[str, float]:
+    """Returns a snapshot of the counters."""
+    with _lock:
+        return dict(_counters)
+
+
+def log_metrics(target_logger: Optional[logging.Logger] = None,
+                level: int = logging.INFO) -> None:
+    """Logs a snapshot of all the metrics as a single JSON record.
+
+    Args:
+        target_logger (logging.Logger, optional): The logger to use. Defaults
+            to the logger of this module.
+        level (int): The logging level. Defaults to `logging.INFO`.
+    """
+    target_logger = target_logger or logger
+    snapshot = {
+        "timings": {name: {"count": stats.count,
+                           "total_seconds": stats.total,
+                           "mean_seconds": stats.mean,
+                           "max_seconds": stats.max}
+                    for name, stats in get_timings().items()},
+        "counters": get_counters(),
+    }
+    target_logger.log(level, json.dumps(snapshot, sort_keys=True))
+
+
+def _escape_label(value: str) -> str:
+    return value.replace("\\", "\\\\").replace('"', '\\"')
+
+
+def to_prometheus_text(prefix: str = METRICS_PREFIX) -> str:
+    """Returns the metrics in the Prometheus text exposition format.
+
+    Spans are exported as a summary (`_count` and `_sum`) plus a gauge with
+    the maximum duration, and counters as a single counter family. The span
+    or counter name is stored in the `name` label.
+
+    Args:
+        prefix (str): The prefix of the metric names.
+    """
+    lines = [f"# TYPE {prefix}_span_seconds summary"]
+    timings = get_timings()
+    for name, stats in sorted(timings.items()):
+        label = f'{{name="{_escape_label(name)}"}}'
+        lines.append(f"{prefix}_span_seconds_count{label} {stats.count}")
+        lines.append(f"{prefix}_span_seconds_sum{label} {stats.total!r}")
+    lines.append(f"# TYPE {prefix}_span_seconds_max gauge")
+    for name, stats in sorted(timings.items()):
+        label = f'{{name="{_escape_label(name)}"}}'
+        lines.append(f"{prefix}_span_seconds_max{label} {stats.max!r}")
+    lines.append(f"# TYPE {prefix}_events_total counter")
+    for name, value in sorted(get_counters().items()):
+        label = f'{{name="{_escape_label(name)}"}}'
+        lines.append(f"{prefix}_events_total{label} {value!r}")
+    return "\n".join(lines) + "\n"
+
+
+class _MetricsHandler(http.server.BaseHTTPRequestHandler):
+    """Serves `to_prometheus_text` on every GET request."""
+
+    def do_GET(self):  # noqa: N802
+        body = to_prometheus_text().encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):  # pylint: disable=redefined-builtin
+        logger.debug(format, *args)
+
+
+def start_metrics_server(port: int,
+                         host: str = "127.0.0.1"
+                         ) -> http.server.ThreadingHTTPServer:
+    """Serves the metrics in a daemon thread and enables instrumentation.
+
+    Args:
+        port (int): The port to listen on. Use 0 to pick a free port.
+        host (str): The interface to bind. Defaults to localhost.
+
+    Returns:
+        ThreadingHTTPServer: The running server. Call `shutdown` to stop it.
+    """
+    enable()
+    server = http.server.ThreadingHTTPServer((host, port), _MetricsHandler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    return server
@@ -0,0 +1,277 @@
+"""Embedding jobs that run in the background and survive interruptions.
+
+`start_embedding_job` runs `create_embeddings_pipeline` in a background
+thread, so the caller (e.g. a Streamlit page) is not blocked. The job:
+
+- Resumes from the per-video checkpoints of the manifest of the retriever
+  (see `EmbeddingManifest`), so a job interrupted by a crash or a restart
+  only embeds the videos it had not completed.
+- Writes its status, progress and throughput to `job.json` in the retriever
+  directory after every video. Any process can poll it with
+  `read_job_status`, e.g. after a browser refresh.
+- Waits for one of the `max_concurrent_jobs` slots of the host before
+  loading the embedding model. The slots are lock files locked with
+  `flock`, shared by every process of the host and released by the OS if
+  the process dies.
+
+A second lock file in the retriever directory prevents two jobs from
+embedding the same retriever at once. Linux and macOS only.
+"""
+import json
+import logging
+import os
+import pathlib
+import tempfile
+import threading
+import time
+from typing import IO, Any, Dict, Optional, Union
+
+from ask_youtube_playlists.data_processing import create_embeddings_pipeline
+from ask_youtube_playlists.data_processing.manifest import (
+    write_json_atomically)
+from ask_youtube_playlists.reporting import Reporter
+
+logger = logging.getLogger(__name__)
+
+PathLike = Union[str, os.PathLike]
+
+JOB_STATUS_FILE_NAME = "job.json"
+JOB_LOCK_FILE_NAME = "job.lock"
+DEFAULT_MAX_CONCURRENT_JOBS = 1
+DEFAULT_SLOTS_DIRECTORY = pathlib.Path(tempfile.gettempdir()).joinpath(
+    "ask_youtube_playlists_jobs"
+)
+# Statuses of the jobs that hold the lock of their retriever
+ACTIVE_STATUSES = ("queued", "running")
+
+# Retriever directory -> the last job started for it by this process
+_jobs: Dict[pathlib.Path, "EmbeddingJob"] = {}
+_jobs_lock = threading.Lock()
+
+
+def _try_lock(path: pathlib.Path) -> Optional[IO]:
+    """Locks a file without blocking.
+
+    Returns:
+        IO: The open file, which holds the lock until it is closed, or None
+        if another open file holds it.
+    """
+    import fcntl
+
+    path.parent.mkdir(parents=True, exist_ok=True)
+    file = open(path, "a")
+    try:
+        fcntl.flock(file.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except OSError:
+        file.close()
+        return None
+    return file
+
+
+def read_job_status(retriever_directory: PathLike) -> Optional[Dict[str, Any]]:
+    """Returns the status of the last job of a retriever, or None if it never
+    had one.
+
+    A job that was queued or running when its process died is reported as
+    `interrupted`. Starting a new job resumes it.
+    """
+    retriever_directory = pathlib.Path(retriever_directory)
+    status_path = retriever_directory / JOB_STATUS_FILE_NAME
+    if not status_path.exists():
+        return None
+    with open(status_path, "r", encoding="utf-8") as file:
+        status = json.load(file)
+    if status["status"] in ACTIVE_STATUSES:
+        lock = _try_lock(retriever_directory / JOB_LOCK_FILE_NAME)
+        if lock is not None:
+            lock.close()
+            status["status"] = "interrupted"
+    return status
+
+
+class JobReporter(Reporter):
+    """Reporter that writes the progress of a job to its status file."""
+
+    def __init__(self, job: "EmbeddingJob"):
+        self.job = job
+
+    def progress(self, fraction: float, text: str = "") -> None:
+        self.job.update_status(current=text)
+
+    def warning(self, message: str) -> None:
+        logger.warning(message)
+        self.job.update_status(last_warning=message)
+
+    def checkpoint(self, item: str, done: int, total: int, size: int,
+                   skipped: bool = False) -> None:
+        status = self.job.status
+        chunks_done = status["chunks_done"] + (0 if skipped else size)
+        elapsed = time.time() - status["started"]
+        self.job.update_status(
+            videos_done=done,
+            videos_total=total,
+            videos_skipped=status["videos_skipped"] + int(skipped),
+            chunks_done=chunks_done,
+            chunks_per_second=chunks_done / elapsed if elapsed > 0 else 0.0,
+        )
+
+
+class EmbeddingJob:
+    """Runs `create_embeddings_pipeline` for a retriever in a background
+    thread. See the module documentation.
+
+    Args:
+        retriever_directory (PathLike): The directory of the retriever.
+        embedding_model_name (str): The embedding model.
+        max_chunk_size (int): See `create_embeddings_pipeline`.
+        min_overlap_size (int): See `create_embeddings_pipeline`.
+        max_concurrent_jobs (int): The maximum number of jobs that run at
+            once on the host. Defaults to 1.
+        slots_directory (PathLike, optional): Where the lock files of the
+            slots are. Every process of the host must use the same one.
+            Defaults to a directory in the temporary directory.
+        poll_interval (float): The seconds between two attempts to take a
+            slot. Defaults to 1.
+        **pipeline_kwargs: Additional arguments of
+            `create_embeddings_pipeline`, e.g. `chunking_mode`.
+    """
+
+    def __init__(self,
+                 retriever_directory: PathLike,
+                 embedding_model_name: str,
+                 max_chunk_size: int,
+                 min_overlap_size: int,
+                 max_concurrent_jobs: int = DEFAULT_MAX_CONCURRENT_JOBS,
+                 slots_directory: Optional[PathLike] = None,
+                 poll_interval: float = 1.0,
+                 **pipeline_kwargs):
+        self.retriever_directory = pathlib.Path(retriever_directory)
+        self.embedding_model_name = embedding_model_name
+        self.max_chunk_size = max_chunk_size
+        self.min_overlap_size = min_overlap_size
+        self.max_concurrent_jobs = max_concurrent_jobs
+        self.slots_directory = pathlib.Path(
+            slots_directory or DEFAULT_SLOTS_DIRECTORY
+        )
+        self.poll_interval = poll_interval
+        self.pipeline_kwargs = pipeline_kwargs
+        self.status: Dict[str, Any] = {
+            "status": "queued",
+            "pid": os.getpid(),
+            "embedding_model_name": embedding_model_name,
+            "created": time.time(),
+            "started": None,
+            "finished": None,
+            "updated": time.time(),
+            "videos_done": 0,
+            "videos_total": None,
+            "videos_skipped": 0,
+            "chunks_done": 0,
+            "chunks_per_second": 0.0,
+            "current": "",
+            "error": None,
+        }
+        self._job_lock: Optional[IO] = None
+        self._thread = threading.Thread(
+            target=self._run, daemon=True,
+            name=f"embedding-job-{self.retriever_directory.name}",
+        )
+
+    def update_status(self, **fields) -> None:
+        """Updates the status and writes it to the status file."""
+        self.status.update(fields, updated=time.time())
+        write_json_atomically(
+            self.retriever_directory / JOB_STATUS_FILE_NAME, self.status
+        )
+
+    def _acquire_slot(self) -> IO:
+        """Waits until one of the slots of the host is free and locks it."""
+        while True:
+            for slot in range(self.max_concurrent_jobs):
+                lock = _try_lock(self.slots_directory / f"slot_{slot}.lock")
+                if lock is not None:
+                    return lock
+            time.sleep(self.poll_interval)
+
+    def _run(self) -> None:
+        job_lock = self._job_lock
+        if job_lock is None:
+            return
+        try:
+            slot = self._acquire_slot()
+            try:
+                self.update_status(status="running", started=time.time())
+                create_embeddings_pipeline(
+                    self.retriever_directory,
+                    self.embedding_model_name,
+                    max_chunk_size=self.max_chunk_size,
+                    min_overlap_size=self.min_overlap_size,
+                    reporter=JobReporter(self),
+                    resume=True,
+                    **self.pipeline_kwargs,
+                )
+            finally:
+                slot.close()
+            self.update_status(status="completed", finished=time.time())
+        except Exception as error:
+            logger.exception("The embedding job of %s failed",
+                             self.retriever_directory)
+            self.update_status(status="failed", finished=time.time(),
+                               error=f"{type(error).__name__}: {error}")
+        finally:
+            job_lock.close()
+
+    def start(self) -> "EmbeddingJob":
+        """Starts the job in a background thread.
+
+        The lock of the retriever is taken and the `queued` status is written
+        before the thread starts, so a status read right after `start`
+        already reports the job.
+        """
+        self.retriever_directory.mkdir(parents=True, exist_ok=True)
+        lock_path = self.retriever_directory / JOB_LOCK_FILE_NAME
+        self._job_lock = _try_lock(lock_path)
+        if self._job_lock is None:
+            # The status file belongs to the job that holds the lock
+            self.status.update(status="failed",
+                               error="Another job is embedding this "
+                                     "retriever.")
+        else:
+            self.update_status(status="queued")
+        self._thread.start()
+        return self
+
+    def is_alive(self) -> bool:
+        """Returns whether the job is queued or running."""
+        return self._thread.is_alive()
+
+    def join(self, timeout: Optional[float] = None) -> None:
+        """Waits until the job finishes."""
+        self._thread.join(timeout)
+
+
+def start_embedding_job(retriever_directory: PathLike,
+                        embedding_model_name: str,
+                        max_chunk_size: int,
+                        min_overlap_size: int,
+                        **kwargs) -> EmbeddingJob:
+    """Starts an `EmbeddingJob`, unless this process is already running one
+    for the retriever, which is returned instead.
+
+    Args:
+        retriever_directory (PathLike): The directory of the retriever.
+        embedding_model_name (str): The embedding model.
+        max_chunk_size (int): See `create_embeddings_pipeline`.
+        min_overlap_size (int): See `create_embeddings_pipeline`.
+        **kwargs: Additional arguments of `EmbeddingJob`.
+    """
+    key = pathlib.Path(retriever_directory).resolve()
+    with _jobs_lock:
+        job = _jobs.get(key)
+        if job is None or not job.is_alive():
+            job = _jobs[key] = EmbeddingJob(retriever_directory,
+                                            embedding_model_name,
+                                            max_chunk_size,
+                                            min_overlap_size,
+                                            **kwargs).start()
+        return job
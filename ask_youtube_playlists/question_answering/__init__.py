@@ -2,7 +2,8 @@
 
 It consists of three components:
 1.- Retrieval: This component retrieves the most relevant documents for a given
-question.
+question. Optionally, a cross-encoder re-ranks a larger pool of retrieved
+documents, or maximal marginal relevance diversifies them.
 
 2.- Extractive: This component extracts the most relevant sentences from the
 retrieved documents.
@@ -11,8 +12,19 @@ retrieved documents.
 extracted sentences.
 """
 
-from .extractive import EXTRACTIVE_MODEL_NAMES, get_extractive_answer
+from .diversity import (collapse_adjacent,
+                        maximal_marginal_relevance)
+from .extractive import (EXTRACTIVE_MODEL_NAMES,
+                         get_extractive_answer,
+                         get_extractive_answers,
+                         search_extractive_answers)
 from .generative import (GENERATIVE_MODEL_NAMES,
                          get_generative_answer,
                          load_model)
-from .retriever import Retriever
+from .reranker import (RERANKER_MODEL_NAMES,
+                       get_cross_encoder_scorer,
+                       rerank)
+from .retriever import (DocumentInfo,
+                        Retriever,
+                        get_scoring_workers,
+                        set_scoring_workers)
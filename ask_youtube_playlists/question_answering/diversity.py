@@ -0,0 +1,224 @@
+"""Diversification of the retrieved documents.
+
+Consecutive chunks of a video share `min_overlap_size` characters, so the
+chunks most similar to a question are often neighbours with nearly the same
+text. Each of them costs a forward pass of the extractive model or the
+tokens of a prompt, without adding evidence.
+
+With maximal marginal relevance (MMR), the documents are selected one at a
+time among a larger set of candidates. Each one maximizes
+
+    mmr_lambda * relevance - (1 - mmr_lambda) * redundancy
+
+where the relevance is the similarity to the question and the redundancy the
+highest similarity to the documents already selected. A `mmr_lambda` of 1
+ranks by relevance only, and lower values favour diversity. Then the
+selected chunks that are adjacent or overlap in the same video are collapsed
+into a single document that spans their time range.
+"""
+import urllib.parse
+from typing import Any, Dict, List, Optional, Sequence, Tuple, TYPE_CHECKING
+
+import numpy as np
+
+if TYPE_CHECKING:
+    from ask_youtube_playlists.question_answering.retriever import (
+        DocumentInfo)
+
+# Number of candidates scored by MMR per document to retrieve
+MMR_CANDIDATE_FACTOR = 4
+# Characters added to the minimum overlap of the chunks for the whole
+# segments that the overlap is made of
+OVERLAP_MARGIN = 200
+
+
+def maximal_marginal_relevance(relevance: np.ndarray,
+                               candidate_embeddings: np.ndarray,
+                               k: int,
+                               mmr_lambda: float) -> np.ndarray:
+    """Selects `k` candidates with maximal marginal relevance.
+
+    The similarities between the candidates are computed with a single
+    matrix product, and each selection updates the redundancy of every
+    candidate at once.
+
+    Args:
+        relevance (np.ndarray): The similarity of each candidate to the
+            question.
+        candidate_embeddings (np.ndarray): The embeddings of the candidates,
+            with unit norm.
+        k (int): The number of candidates to select.
+        mmr_lambda (float): The weight of the relevance, between 0 and 1.
+
+    Returns:
+        np.ndarray: The positions of the selected candidates, in the order
+        they were selected.
+
+    Raises:
+        ValueError: If `mmr_lambda` is not between 0 and 1.
+    """
+    if not 0 <= mmr_lambda <= 1:
+        raise ValueError(f"mmr_lambda must be between 0 and 1. Got "
+                         f"{mmr_lambda}.")
+    k = min(k, len(relevance))
+    selected = np.empty(max(k, 0), dtype=np.int64)
+    if k <= 0:
+        return selected
+    similarities = candidate_embeddings @ candidate_embeddings.T
+    weighted_relevance = mmr_lambda * np.asarray(relevance, dtype=np.float32)
+    redundancy = np.zeros(len(relevance), dtype=np.float32)
+    is_selected = np.zeros(len(relevance), dtype=bool)
+    for step in range(k):
+        scores = weighted_relevance - (1 - mmr_lambda) * redundancy
+        scores[is_selected] = -np.inf
+        best = int(np.argmax(scores))
+        selected[step] = best
+        is_selected[best] = True
+        redundancy = similarities[best] if step == 0 else \
+            np.maximum(redundancy, similarities[best])
+    return selected
+
+
+def _get_span(metadata: Dict[str, Any]) -> Tuple[float, float]:
+    start = float(metadata.get("start", 0.0))
+    return start, start + float(metadata.get("duration", 0.0))
+
+
+def _get_video_key(document_info: "DocumentInfo", position: int) -> Any:
+    """Returns the key of the video of a chunk: its URL without the
+    timestamp, or else its playlist and title, or else its position, so that
+    it is never merged."""
+    metadata = document_info.document.metadata
+    if metadata.get("url"):
+        url = urllib.parse.urlsplit(metadata["url"])
+        query = [(key, value)
+                 for key, value in urllib.parse.parse_qsl(url.query)
+                 if key != "t"]
+        return url._replace(query=urllib.parse.urlencode(query),
+                            fragment="").geturl()
+    if "title" in metadata:
+        return document_info.playlist_name, metadata["title"]
+    return position
+
+
+def _are_adjacent(previous: Dict[str, Any], end: float,
+                  metadata: Dict[str, Any]) -> bool:
+    """Returns whether a chunk follows the chunks of a span that ends at
+    `end` and whose last chunk has the metadata `previous`.
+
+    The chunks of a deduplicated video are compared by their
+    `original_index`, so that two chunks are not adjacent if a duplicate was
+    removed between them.
+    """
+    for key in ("original_index", "index"):
+        if key in previous and key in metadata:
+            if metadata[key] - previous[key] <= 1:
+                return True
+            break
+    return "start" in metadata and metadata["start"] <= end
+
+
+def _get_overlap_size(text: str, next_text: str,
+                      max_overlap_size: Optional[int] = None) -> int:
+    """Returns the size of the longest suffix of a text, of at most
+    `max_overlap_size` characters, that is a prefix of the next text.
+
+    Only the positions of the first character of the next text are tried.
+    """
+    max_size = min(len(text), len(next_text))
+    if max_overlap_size is not None:
+        max_size = min(max_size, max_overlap_size)
+    position = len(text) - max_size
+    while next_text:
+        position = text.find(next_text[0], position)
+        if position == -1:
+            break
+        if next_text.startswith(text[position:]):
+            return len(text) - position
+        position += 1
+    return 0
+
+
+def _merge(document_infos: Sequence["DocumentInfo"],
+           max_overlap_size: Optional[int] = None) -> "DocumentInfo":
+    """Merges the consecutive chunks of a video into one document.
+
+    Each chunk is compared with the previous chunk only, so the cost of
+    finding an overlap does not grow with the merged text.
+    """
+    from langchain.schema import Document
+
+    first = document_infos[0]
+    if len(document_infos) == 1:
+        return first
+    previous_text = first.document.page_content
+    parts = [previous_text]
+    for document_info in document_infos[1:]:
+        next_text = document_info.document.page_content
+        size = _get_overlap_size(previous_text, next_text, max_overlap_size)
+        parts.append(next_text[size:] if size else f" {next_text}")
+        previous_text = next_text
+    text = "".join(parts)
+    metadata = dict(first.document.metadata)
+    if "start" in metadata:
+        start, _ = _get_span(metadata)
+        end = max(_get_span(document_info.document.metadata)[1]
+                  for document_info in document_infos)
+        metadata["duration"] = end - start
+    metadata["n_chunks"] = len(document_infos)
+    return first._replace(
+        document=Document(page_content=text, metadata=metadata),
+        score=max(document_info.score for document_info in document_infos),
+    )
+
+
+def collapse_adjacent(document_infos: Sequence["DocumentInfo"],
+                      max_overlap_size: Optional[int] = None
+                      ) -> List["DocumentInfo"]:
+    """Merges the documents that are consecutive or overlapping chunks of the
+    same video.
+
+    A merged document has the text of its chunks without their overlap, the
+    metadata of its first chunk with a `duration` that spans every chunk and
+    their number in `n_chunks`, and the highest score of its chunks. The
+    chunks are grouped by the URL of their video without the `t` timestamp,
+    or by playlist and title if they have no URL, and chunks with neither
+    are never merged.
+
+    Args:
+        document_infos (Sequence[DocumentInfo]): The documents.
+        max_overlap_size (int, optional): The most characters that two
+            consecutive chunks share, e.g. the `min_overlap_size` of the
+            chunks plus `OVERLAP_MARGIN`. Defaults to the size of the
+            chunks.
+
+    Returns:
+        List[DocumentInfo]: The documents, sorted in descending order by
+        score.
+    """
+    videos: Dict[Any, List["DocumentInfo"]] = {}
+    for position, document_info in enumerate(document_infos):
+        videos.setdefault(_get_video_key(document_info, position),
+                          []).append(document_info)
+
+    def get_position(document_info: "DocumentInfo") -> Tuple[float, int]:
+        metadata = document_info.document.metadata
+        return _get_span(metadata)[0], metadata.get("index", 0)
+
+    collapsed = []
+    for video_infos in videos.values():
+        video_infos.sort(key=get_position)
+        span = [video_infos[0]]
+        end = _get_span(video_infos[0].document.metadata)[1]
+        for document_info in video_infos[1:]:
+            metadata = document_info.document.metadata
+            if not _are_adjacent(span[-1].document.metadata, end, metadata):
+                collapsed.append(_merge(span, max_overlap_size))
+                span = []
+                end = -np.inf
+            span.append(document_info)
+            end = max(end, _get_span(metadata)[1])
+        collapsed.append(_merge(span, max_overlap_size))
+    collapsed.sort(key=lambda document_info: document_info.score,
+                   reverse=True)
+    return collapsed
@@ -1,18 +1,18 @@
 """Contains the functionality to perform extractive question answering."""
-import streamlit as st
-
 import functools
-from typing import Any, Tuple
+import time
+from typing import Any, Dict, Hashable, List, Optional, Sequence, Tuple
 
-from transformers import (AutoModelForQuestionAnswering,
-                          AutoTokenizer,
-                          pipeline)
+from ask_youtube_playlists import caching, instrumentation
 
 
 EXTRACTIVE_MODEL_NAMES = [
     "deepset/roberta-base-squad2",
 ]
 
+# The name under which the answers of the batched functions are cached
+_ANSWER_CACHE_FUNCTION = f"{__name__}.extractive_answer"
+
 
 @functools.lru_cache(maxsize=1)
 def _load_extractive_model(model_name: str = "deepset/roberta-base-squad2"
@@ -26,12 +26,28 @@ def _load_extractive_model(model_name: str = "deepset/roberta-base-squad2"
     Returns:
         AutoModelForQuestionAnswering, AutoTokenizer: The model and tokenizer.
     """
+    from transformers import AutoModelForQuestionAnswering, AutoTokenizer
+
     model = AutoModelForQuestionAnswering.from_pretrained(model_name)
     tokenizer = AutoTokenizer.from_pretrained(model_name)
     return model, tokenizer
 
 
-@st.cache_data
+@functools.lru_cache(maxsize=1)
+def _load_extractive_pipeline(model_name: str = "deepset/roberta-base-squad2"
+                              ) -> Any:
+    """Returns the question answering pipeline of the model.
+
+    Creating the pipeline is not free, so it is created once and reused.
+    """
+    from transformers import pipeline
+
+    model, tokenizer = _load_extractive_model(model_name)
+    return pipeline('question-answering', model=model, tokenizer=tokenizer)
+
+
+@instrumentation.timed("qa.extractive_answer")
+@caching.cache_data
 def get_extractive_answer(question: str,
                           context: str,
                           model_name: str = "deepset/roberta-base-squad2",
@@ -48,11 +64,140 @@ def get_extractive_answer(question: str,
         A dictionary with the 'answer' as a string, the 'score' as a float and
         the 'start' and 'end' as integers.
     """
-    model, tokenizer = _load_extractive_model(model_name)
+    with instrumentation.span("extractive.load_model"):
+        nlp = _load_extractive_pipeline(model_name)
     qa_input = {
         'question': question,
         'context': context
     }
-    nlp = pipeline('question-answering', model=model, tokenizer=tokenizer)
-    res = nlp(qa_input)
+    with instrumentation.span("extractive.inference"):
+        res = nlp(qa_input)
     return res
+
+
+def _answer_pairs(nlp: Any,
+                  questions_and_contexts: Sequence[Tuple[str, str]],
+                  model_name: str,
+                  batch_size: int) -> List[Dict[str, Any]]:
+    """Answers (question, context) pairs with the pipeline, except the ones
+    cached by the active backend, which are keyed by the question, the
+    context and the model."""
+    backend = caching.get_cache_backend()
+    keys = [(question, context, model_name)
+            for question, context in questions_and_contexts]
+    results = backend.get_many(_ANSWER_CACHE_FUNCTION, keys)
+    missing = [key for key in dict.fromkeys(keys) if key not in results]
+    if missing:
+        qa_inputs = [{'question': question, 'context': context}
+                     for question, context, _ in missing]
+        with instrumentation.span("extractive.inference"):
+            new_results = nlp(qa_inputs, batch_size=batch_size)
+        # The pipeline returns a single dictionary when it receives one input
+        if isinstance(new_results, dict):
+            new_results = [new_results]
+        computed: Dict[Hashable, Any] = dict(zip(missing, new_results))
+        backend.set_many(_ANSWER_CACHE_FUNCTION, computed)
+        results.update(computed)
+    return [results[key] for key in keys]
+
+
+@instrumentation.timed("qa.extractive_answers")
+def get_extractive_answers(questions_and_contexts: Sequence[Tuple[str, str]],
+                           model_name: str = "deepset/roberta-base-squad2",
+                           batch_size: int = 8,
+                           ) -> List[Dict[str, Any]]:
+    """Answers several (question, context) pairs in batches.
+
+    It is the batched version of `get_extractive_answer`, used when many
+    pairs are available at once, e.g. to answer a question over all the
+    retrieved documents or to serve concurrent requests.
+
+    Args:
+        questions_and_contexts (Sequence[Tuple[str, str]]): The pairs of
+            question and context.
+        model_name (str, optional): The model name. Defaults to
+            "deepset/roberta-base-squad2".
+        batch_size (int, optional): The number of pairs that go through the
+            model at once. Defaults to 8.
+
+    Returns:
+        A list with a dictionary per pair, in the same format returned by
+        `get_extractive_answer`. The answer of each pair is cached by the
+        active backend.
+    """
+    if not questions_and_contexts:
+        return []
+    with instrumentation.span("extractive.load_model"):
+        nlp = _load_extractive_pipeline(model_name)
+    return _answer_pairs(nlp, questions_and_contexts, model_name, batch_size)
+
+
+@instrumentation.timed("qa.extractive_search")
+def search_extractive_answers(question: str,
+                              contexts: Sequence[str],
+                              model_name: str = "deepset/roberta-base-squad2",
+                              batch_size: int = 4,
+                              score_threshold: Optional[float] = 0.5,
+                              time_budget: Optional[float] = None,
+                              ) -> List[Dict[str, Any]]:
+    """Answers a question over several contexts, stopping early once a
+    confident answer is found.
+
+    The contexts are processed in order, usually the order of the retriever,
+    in batches of `batch_size`. The search stops after a batch whose best
+    answer has a score of at least `score_threshold`, or before a batch that
+    is expected to exceed the `time_budget`, judging by the slowest batch so
+    far. The first batch is always processed.
+
+    Args:
+        question (str): The question.
+        contexts (Sequence[str]): The contexts, from the most to the least
+            relevant.
+        model_name (str, optional): The model name. Defaults to
+            "deepset/roberta-base-squad2".
+        batch_size (int, optional): The number of contexts that go through
+            the model at once. Defaults to 4.
+        score_threshold (float, optional): The score of an answer that stops
+            the search. Defaults to 0.5. If None, only the time budget stops
+            the search.
+        time_budget (float, optional): The maximum number of seconds spent
+            searching. Loading the model is not included. Defaults to no
+            limit.
+
+    Returns:
+        A list with the answers of the processed contexts, in the format
+        returned by `get_extractive_answer` plus the `context_index` of each
+        answer, sorted in descending order by score. The answer of each
+        context is cached by the active backend.
+    """
+    if not contexts:
+        return []
+    with instrumentation.span("extractive.load_model"):
+        nlp = _load_extractive_pipeline(model_name)
+
+    start = time.perf_counter()
+    slowest_batch = 0.0
+    answers: List[Dict[str, Any]] = []
+    for batch_start in range(0, len(contexts), batch_size):
+        if time_budget is not None and answers:
+            elapsed = time.perf_counter() - start
+            if elapsed + slowest_batch > time_budget:
+                instrumentation.increment("extractive.budget_exhausted")
+                break
+        batch = contexts[batch_start:batch_start + batch_size]
+        batch_time = time.perf_counter()
+        results = _answer_pairs(nlp,
+                                [(question, context) for context in batch],
+                                model_name, batch_size)
+        slowest_batch = max(slowest_batch, time.perf_counter() - batch_time)
+        answers.extend({**result, "context_index": batch_start + offset}
+                       for offset, result in enumerate(results))
+
+        best_score = max(result["score"] for result in results)
+        if score_threshold is not None and best_score >= score_threshold:
+            instrumentation.increment("extractive.early_stops")
+            break
+    instrumentation.increment("extractive.contexts_processed", len(answers))
+
+    answers.sort(key=lambda x: x["score"], reverse=True)
+    return answers
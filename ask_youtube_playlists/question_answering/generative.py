@@ -1,12 +1,28 @@
 """Contains the functionality to answer a question using generative
-models."""
-import streamlit as st
+models.
+
+By default, every retrieved document goes in a single prompt, which does not
+fit the context of small models once many documents are retrieved. With
+`map_reduce`, the documents are split in groups that fit the context of the
+model, each group is answered separately (map), and the partial answers are
+combined into the final answer (reduce). The texts are measured with the
+tokenizer of the model. The prompts of each step are generated
+concurrently: with asyncio for the OpenAI models, which only take one prompt
+per request, and in batches through the transformers pipeline for the local
+models. If the partial answers do not fit in one prompt either, they are
+reduced in groups again.
+"""
+import asyncio
+import functools
 from dataclasses import dataclass
-from typing import List, Dict, Union
+from typing import Callable, List, Dict, Sequence, Union, TYPE_CHECKING
+
+from ask_youtube_playlists import caching, instrumentation
 
-import langchain
-from langchain import llms
-from langchain.schema import Document
+if TYPE_CHECKING:
+    import langchain
+    from langchain import llms
+    from langchain.schema import Document
 
 
 @dataclass
@@ -16,6 +32,8 @@ class LLMSpec:
     Attributes:
         model_name (str): The name of the language model.
         model_type (str): The class or method used to load the language model.
+        max_tokens (int): The size of the context of the model, in tokens,
+            shared by the prompt and the answer.
     """
     model_name: str
     model_type: str
@@ -32,6 +50,18 @@ GENERATIVE_MODELS = [
 GENERATIVE_MODEL_NAMES = [model_spec.model_name
                           for model_spec in GENERATIVE_MODELS]
 
+# Minimum number of tokens left for the documents of a prompt
+MIN_CONTEXT_TOKENS = 32
+# Number of prompts generated at once by the local models
+LOCAL_BATCH_SIZE = 8
+# Maximum number of requests in flight to the OpenAI models
+MAX_CONCURRENT_REQUESTS = 16
+
+MAP_PROMPT_TEMPLATE = "{context}\n\nQuestion: {question}\n\nAnswer:"
+REDUCE_PROMPT_TEMPLATE = ("Answers to the question from different parts of "
+                          "the transcripts:\n\n{context}\n\nQuestion: "
+                          "{question}\n\nCombined answer:")
+
 
 def get_model_spec(model_name: str) -> LLMSpec:
     """Returns the language model specification.
@@ -56,7 +86,7 @@ def get_model_spec(model_name: str) -> LLMSpec:
 def load_model(model_name: str,
                temperature: float = 0.7,
                max_length: int = 1024,
-               ) -> llms.base.BaseLLM:
+               ) -> "llms.base.BaseLLM":
     """Loads the language model.
 
     Args:
@@ -70,6 +100,7 @@ def load_model(model_name: str,
     Returns:
         llms.base.BaseLLM: The language model.
     """
+    from langchain import llms
 
     model_spec = get_model_spec(model_name)
 
@@ -81,25 +112,36 @@ def load_model(model_name: str,
         )
         return llm
     if model_spec.model_type == "huggingface-pipeline":
+        # The `max_length` of the pipeline counts the prompt too, so the
+        # answer is bounded by `max_new_tokens` instead
         llm = llms.HuggingFacePipeline.from_model_id(  # type: ignore
             model_id=model_spec.model_name,
             task="text-generation",
-            model_kwargs={"temperature": temperature,
-                          "max_length": max_length}
+            model_kwargs={"temperature": temperature},
+            pipeline_kwargs={"max_new_tokens": max_length}
         )
+        # Batches of prompts are padded on the left, with the end of text
+        # token of the models that have no padding token, like gpt2
+        pipeline = llm.pipeline  # type: ignore
+        pipeline.tokenizer.padding_side = "left"
+        if pipeline.tokenizer.pad_token_id is None:
+            pipeline.tokenizer.pad_token_id = \
+                pipeline.model.config.eos_token_id
         return llm
     available_models = [model.model_name for model in GENERATIVE_MODELS]
     raise ValueError(f"Model type '{model_spec.model_type}' not available. "
                      f"Available models are: {available_models}")
 
 
-def _get_generative_prompt_template(retrieved_documents: List[Document],
-                                    ) -> langchain.PromptTemplate:
+def _get_generative_prompt_template(retrieved_documents: List["Document"],
+                                    ) -> "langchain.PromptTemplate":
     """Returns the template used to generate the answer.
 
     Returns:
         langchain.PromptTemplate: The template used to generate the answer.
     """
+    import langchain
+
     template_text = ""
     for document in reversed(retrieved_documents):
         template_text += f"{document.page_content}\n\n"
@@ -113,12 +155,205 @@ def _get_generative_prompt_template(retrieved_documents: List[Document],
     return template
 
 
-@st.cache_data
+@dataclass
+class Tokenizer:
+    """Class to count and truncate texts in the tokens of a language model.
+
+    Attributes:
+        encode (Callable[[str], List[int]]): Returns the tokens of a text,
+            without the special tokens.
+        decode (Callable[[List[int]], str]): Returns the text of tokens.
+    """
+    encode: Callable[[str], List[int]]
+    decode: Callable[[List[int]], str]
+
+    def count(self, text: str) -> int:
+        """Returns the number of tokens of a text."""
+        return len(self.encode(text))
+
+    def truncate(self, text: str, max_tokens: int) -> str:
+        """Returns the text of the first `max_tokens` tokens of a text."""
+        tokens = self.encode(text)
+        if len(tokens) <= max_tokens:
+            return text
+        return self.decode(tokens[:max_tokens])
+
+
+@functools.lru_cache(maxsize=None)
+def get_tokenizer(model_name: str) -> Tokenizer:
+    """Returns the tokenizer of the language model.
+
+    Args:
+        model_name (str): The name of the language model.
+
+    Raises:
+        ValueError: If the model type is not supported.
+    """
+    model_spec = get_model_spec(model_name)
+    if model_spec.model_type == "huggingface-pipeline":
+        from transformers import AutoTokenizer
+
+        tokenizer = AutoTokenizer.from_pretrained(model_spec.model_name)
+        return Tokenizer(
+            encode=lambda text: tokenizer.encode(
+                text, add_special_tokens=False, verbose=False
+            ),
+            decode=tokenizer.decode,
+        )
+    if model_spec.model_type == "openai-chat":
+        import tiktoken
+
+        encoding = tiktoken.encoding_for_model(model_spec.model_name)
+        return Tokenizer(encode=encoding.encode_ordinary,
+                         decode=encoding.decode)
+    raise ValueError(f"Model type '{model_spec.model_type}' not available.")
+
+
+def group_texts(texts: Sequence[str],
+                max_tokens: int,
+                max_text_tokens: int,
+                tokenizer: Tokenizer,
+                min_group_size: int = 1,
+                separator: str = "\n\n") -> List[List[str]]:
+    """Packs consecutive texts in groups of at most `max_tokens` tokens,
+    counting a separator after each text.
+
+    Args:
+        texts (Sequence[str]): The texts, in order.
+        max_tokens (int): The maximum number of tokens of a group.
+        max_text_tokens (int): The texts longer than this are truncated.
+        tokenizer (Tokenizer): The tokenizer of the language model.
+        min_group_size (int, optional): The minimum number of texts of each
+            group but the last, even if they exceed `max_tokens`. Defaults
+            to 1.
+        separator (str, optional): The text that joins the texts of a group.
+            Defaults to "\n\n".
+
+    Returns:
+        List[List[str]]: The groups, in order.
+    """
+    separator_tokens = tokenizer.count(separator)
+    groups: List[List[str]] = []
+    n_tokens = 0
+    for text in texts:
+        text = tokenizer.truncate(text, max_text_tokens)
+        text_tokens = tokenizer.count(text) + separator_tokens
+        is_full = n_tokens + text_tokens > max_tokens
+        if not groups or is_full and len(groups[-1]) >= min_group_size:
+            groups.append([])
+            n_tokens = 0
+        groups[-1].append(text)
+        n_tokens += text_tokens
+    return groups
+
+
+def generate_all(model: "llms.base.BaseLLM",
+                 prompts: List[str],
+                 model_type: str) -> List[str]:
+    """Generates the answer of each prompt concurrently.
+
+    The OpenAI chat models take a single prompt per request, so their
+    requests are sent concurrently with asyncio, up to
+    `MAX_CONCURRENT_REQUESTS` at once. The `generate` method of the local
+    models runs their pipeline on one prompt at a time, so the prompts are
+    given to the pipeline at once, in batches of `LOCAL_BATCH_SIZE`.
+
+    Returns:
+        List[str]: The answer of each prompt.
+    """
+    if model_type.startswith("openai"):
+        async def generate_concurrently() -> List[str]:
+            semaphore = asyncio.Semaphore(MAX_CONCURRENT_REQUESTS)
+
+            async def generate(prompt: str) -> str:
+                async with semaphore:
+                    result = await model.agenerate(prompts=[prompt])
+                return result.generations[0][0].text
+
+            return list(await asyncio.gather(*map(generate, prompts)))
+
+        return asyncio.run(generate_concurrently())
+    if model_type == "huggingface-pipeline":
+        pipeline = model.pipeline  # type: ignore
+        responses = pipeline(prompts, batch_size=LOCAL_BATCH_SIZE)
+        # Like the prompts, the texts generated by a text generation
+        # pipeline start with their prompt
+        return [response[0]["generated_text"][len(prompt):]
+                for prompt, response in zip(prompts, responses)]
+    result = model.generate(prompts=prompts)
+    return [generations[0].text for generations in result.generations]
+
+
+def _map_reduce_answer(question: str,
+                       relevant_documents: List["Document"],
+                       model: "llms.base.BaseLLM",
+                       model_spec: LLMSpec,
+                       max_length: int) -> str:
+    """Answers the question from groups of documents that fit the context
+    of the model, and combines the partial answers.
+
+    Raises:
+        ValueError: If the answer and the question leave less than
+            `MIN_CONTEXT_TOKENS` tokens for the documents in the context of
+            the model.
+    """
+    import langchain
+
+    tokenizer = get_tokenizer(model_spec.model_name)
+    # Every prompt has the instructions of its template and the question
+    overhead = max(tokenizer.count(template.format(context="",
+                                                   question=question))
+                   for template in (MAP_PROMPT_TEMPLATE,
+                                    REDUCE_PROMPT_TEMPLATE))
+    budget = model_spec.max_tokens - max_length - overhead
+    if budget < MIN_CONTEXT_TOKENS:
+        raise ValueError(f"The context of {model_spec.model_name} "
+                         f"({model_spec.max_tokens} tokens) is too small "
+                         f"for answers of {max_length} tokens.")
+    map_template = langchain.PromptTemplate(
+        template=MAP_PROMPT_TEMPLATE, input_variables=["context", "question"]
+    )
+    reduce_template = langchain.PromptTemplate(
+        template=REDUCE_PROMPT_TEMPLATE,
+        input_variables=["context", "question"]
+    )
+
+    # As in the single prompt, the most relevant documents go last
+    groups = group_texts([document.page_content
+                          for document in relevant_documents],
+                         budget, budget, tokenizer)
+    prompts = [map_template.format(context="\n\n".join(reversed(group)),
+                                   question=question)
+               for group in groups]
+    with instrumentation.span("generative.map"):
+        answers = generate_all(model, prompts, model_spec.model_type)
+    instrumentation.increment("generative.map_prompts", len(prompts))
+
+    while len(answers) > 1:
+        # Truncating the answers to half the budget, minus their separator,
+        # fits two of them in a group, and each group takes at least two, so
+        # every round halves their number
+        groups = group_texts([f"- {answer.strip()}" for answer in answers],
+                             budget, budget // 2 - 2, tokenizer,
+                             min_group_size=2)
+        prompts = [reduce_template.format(
+            context="\n\n".join(group),
+            question=question,
+        ) for group in groups]
+        with instrumentation.span("generative.reduce"):
+            answers = generate_all(model, prompts, model_spec.model_type)
+        instrumentation.increment("generative.reduce_prompts", len(prompts))
+    return answers[0] if answers else ""
+
+
+@instrumentation.timed("qa.generative_answer")
+@caching.cache_data
 def get_generative_answer(question: str,
-                          relevant_documents: List[Document],
+                          relevant_documents: List["Document"],
                           model_name: str,
-                          temperature: int,
-                          max_length: int) -> str:
+                          temperature: float,
+                          max_length: int,
+                          map_reduce: bool = False) -> str:
     """Returns the answer to the question as a string.
 
     Args:
@@ -127,14 +362,27 @@ def get_generative_answer(question: str,
         model_name (str): The name of the language model.
         temperature (float): The temperature used to generate the answer.
         max_length (int): The maximum length of the generated answer.
+        map_reduce (bool): Whether to answer groups of documents that fit
+            the context of the model concurrently and combine their answers,
+            instead of putting every document in one prompt. Defaults to
+            False.
 
     Returns:
         str: The answer to the question.
+
+    Raises:
+        ValueError: If `map_reduce` is set and the context of the model is
+            too small for the answer.
     """
-    model = load_model(model_name=model_name,
-                       temperature=temperature,
-                       max_length=max_length)
+    with instrumentation.span("generative.load_model"):
+        model = load_model(model_name=model_name,
+                           temperature=temperature,
+                           max_length=max_length)
+    if map_reduce:
+        return _map_reduce_answer(question, relevant_documents, model,
+                                  get_model_spec(model_name), max_length)
     template = _get_generative_prompt_template(relevant_documents)
     prompt = template.format(question=question)
-    answer = model.generate(prompts=[prompt])
+    with instrumentation.span("generative.generate"):
+        answer = model.generate(prompts=[prompt])
     return answer.generations[0][0].text
@@ -0,0 +1,144 @@
+"""Contains the functionality to re-rank the retrieved documents with a
+cross-encoder.
+
+The retriever scores the question and the documents independently (a
+bi-encoder), which is fast but coarse. A cross-encoder reads the question and
+a document together and scores their relevance much better, but it has to
+run once per pair. Retrieving a larger pool of candidates and re-ranking it
+with a small cross-encoder improves the top documents, so fewer of them need
+to go through the expensive extractive or generative models.
+
+Re-ranking is bounded by a latency budget: the candidates are scored in
+batches, in the order of the retriever, and the re-ranking stops before a
+batch that would not fit in the remaining budget. The candidates that were
+not scored keep the order and the score of the retriever, after the scored
+ones. As the two scores are not comparable, the `score_source` of the
+metadata of each document says which model gave its score, and the
+`retriever_score` keeps the score of the retriever.
+"""
+import functools
+import time
+from typing import Any, Callable, List, Optional, Sequence, Tuple
+
+from ask_youtube_playlists import instrumentation
+from .retriever import DocumentInfo
+
+RERANKER_MODEL_NAMES = [
+    "cross-encoder/ms-marco-MiniLM-L-6-v2",
+    "cross-encoder/ms-marco-TinyBERT-L-2-v2",
+]
+
+# Scores a batch of (question, document) pairs, the higher the more relevant
+PairScorer = Callable[[List[Tuple[str, str]]], Sequence[float]]
+
+
+@functools.lru_cache(maxsize=1)
+def _load_cross_encoder(
+        model_name: str = "cross-encoder/ms-marco-MiniLM-L-6-v2") -> Any:
+    """Loads the cross-encoder model.
+
+    Args:
+        model_name (str, optional): The model name. Defaults to
+            "cross-encoder/ms-marco-MiniLM-L-6-v2".
+
+    Returns:
+        CrossEncoder: The model.
+    """
+    from sentence_transformers import CrossEncoder
+
+    return CrossEncoder(model_name)
+
+
+def get_cross_encoder_scorer(
+        model_name: str = "cross-encoder/ms-marco-MiniLM-L-6-v2"
+) -> PairScorer:
+    """Returns a function that scores (question, document) pairs with a
+    cross-encoder."""
+    model = _load_cross_encoder(model_name)
+
+    def score(pairs: List[Tuple[str, str]]) -> Sequence[float]:
+        return model.predict(pairs, batch_size=len(pairs),
+                             show_progress_bar=False)
+
+    return score
+
+
+def _tag_score(document_info: DocumentInfo, score: float,
+               score_source: str) -> DocumentInfo:
+    """Returns the document with a new score and the metadata that says
+    where it comes from."""
+    from langchain.schema import Document
+
+    metadata = dict(document_info.document.metadata,
+                    score_source=score_source,
+                    retriever_score=float(document_info.score))
+    document = Document(page_content=document_info.document.page_content,
+                        metadata=metadata)
+    return document_info._replace(document=document, score=score)
+
+
+@instrumentation.timed("qa.rerank")
+def rerank(question: str,
+           document_infos: Sequence[DocumentInfo],
+           n_documents: int,
+           model_name: str = "cross-encoder/ms-marco-MiniLM-L-6-v2",
+           batch_size: int = 16,
+           latency_budget: Optional[float] = None,
+           scorer: Optional[PairScorer] = None) -> List[DocumentInfo]:
+    """Re-ranks the documents retrieved for a question with a cross-encoder.
+
+    Args:
+        question (str): The question.
+        document_infos (Sequence[DocumentInfo]): The candidates, sorted in
+            descending order by the score of the retriever. They are usually
+            a few times more than `n_documents`.
+        n_documents (int): The number of documents to return.
+        model_name (str, optional): The cross-encoder. Defaults to
+            "cross-encoder/ms-marco-MiniLM-L-6-v2". Ignored if a `scorer` is
+            given.
+        batch_size (int, optional): The number of candidates scored at once.
+            Defaults to 16.
+        latency_budget (float, optional): The maximum number of seconds spent
+            scoring. The scoring stops before a batch that is expected to
+            exceed it, judging by the slowest batch so far. Loading the model
+            is not included. Defaults to no limit.
+        scorer (PairScorer, optional): Scores the pairs instead of the
+            cross-encoder.
+
+    Returns:
+        List[DocumentInfo]: The `n_documents` best documents. The scored
+        candidates come first, sorted by the score of the cross-encoder,
+        which replaces the score of the retriever. The rest keep the order
+        and the score of the retriever. The metadata of each document has
+        the `score_source`, `"cross-encoder"` or `"retriever"`, and the
+        `retriever_score`.
+    """
+    if scorer is None:
+        scorer = get_cross_encoder_scorer(model_name)
+
+    start = time.perf_counter()
+    slowest_batch = 0.0
+    scored: List[DocumentInfo] = []
+    while len(scored) < len(document_infos):
+        if latency_budget is not None:
+            elapsed = time.perf_counter() - start
+            if elapsed + slowest_batch > latency_budget:
+                instrumentation.increment("reranker.budget_exhausted")
+                break
+        batch = document_infos[len(scored):len(scored) + batch_size]
+        batch_start = time.perf_counter()
+        with instrumentation.span("reranker.score"):
+            scores = scorer([(question, document_info.document.page_content)
+                             for document_info in batch])
+        slowest_batch = max(slowest_batch, time.perf_counter() - batch_start)
+        scored.extend(_tag_score(document_info, float(score),
+                                 "cross-encoder")
+                      for document_info, score in zip(batch, scores))
+    instrumentation.increment("reranker.pairs_scored", len(scored))
+
+    scored.sort(key=lambda x: x.score, reverse=True)
+    n_unscored = max(n_documents - len(scored), 0)
+    unscored = [_tag_score(document_info, document_info.score, "retriever")
+                for document_info in
+                document_infos[len(scored):len(scored) + n_unscored]]
+    return (scored + unscored)[:n_documents]
@@ -1,20 +1,117 @@
 """Contains the functionality used to retrieve the most relevant documents
 for a given question."""
+import concurrent.futures
+import os
 import pathlib
+import threading
 
-from typing import List, NamedTuple
+from typing import (Any, Callable, Dict, List, NamedTuple, Optional, Sequence,
+                    Tuple, TypeVar, TYPE_CHECKING)
 
 import numpy as np
 import yaml
 
-from langchain.schema import Document
-
+from ask_youtube_playlists import instrumentation
 from ask_youtube_playlists.data_processing import (
+    ChromaVectorStore,
+    ChunkStore,
+    acquire_shared_index,
     get_embedding_model,
-    get_documents_from_directory,
+    load_chunk_store,
     load_embeddings,
+    release_shared_index,
+    summarize_video_embeddings,
+)
+from ask_youtube_playlists.question_answering.diversity import (
+    MMR_CANDIDATE_FACTOR,
+    OVERLAP_MARGIN,
+    collapse_adjacent,
+    maximal_marginal_relevance,
 )
 
+if TYPE_CHECKING:
+    from langchain.embeddings import base
+    from langchain.schema import Document
+
+T = TypeVar("T")
+R = TypeVar("R")
+
+# Number of questions and documents scored at once by `Retriever.search`. A
+# block of scores takes QUESTION_BLOCK_SIZE * DOCUMENT_BLOCK_SIZE * 4 bytes.
+QUESTION_BLOCK_SIZE = 256
+DOCUMENT_BLOCK_SIZE = 16384
+# Embedding matrices are split in shards of at least MIN_SHARD_SIZE rows that
+# are scored in parallel by the scoring threads. NumPy releases the GIL in the
+# matrix products, so the shards use several cores.
+MIN_SHARD_SIZE = 65536
+
+_scoring_workers = os.cpu_count() or 1
+_scoring_executor: Optional[concurrent.futures.ThreadPoolExecutor] = None
+_scoring_executor_lock = threading.Lock()
+# Marks the scoring threads, which score their shards themselves instead of
+# waiting for other scoring threads
+_scoring_thread = threading.local()
+
+
+def get_scoring_workers() -> int:
+    """Returns the number of threads that score the shards of the embedding
+    matrices and the retrievers."""
+    return _scoring_workers
+
+
+def set_scoring_workers(n_workers: int) -> None:
+    """Sets the number of threads that score the shards of the embedding
+    matrices and the retrievers. Defaults to the number of cores.
+
+    Raises:
+        ValueError: If `n_workers` is less than 1.
+    """
+    global _scoring_workers, _scoring_executor
+    if n_workers < 1:
+        raise ValueError(f"The number of workers must be at least 1. Got "
+                         f"{n_workers}.")
+    with _scoring_executor_lock:
+        _scoring_workers = n_workers
+        old_executor = _scoring_executor
+        _scoring_executor = None
+    # Every submission goes through the lock, so nothing is submitted to the
+    # old executor after the swap. The shards already submitted still run.
+    if old_executor is not None:
+        old_executor.shutdown(wait=False)
+
+
+def _mark_scoring_thread() -> None:
+    _scoring_thread.active = True
+
+
+def _in_scoring_thread() -> bool:
+    """Returns whether the current thread is a scoring thread."""
+    return getattr(_scoring_thread, "active", False)
+
+
+def _submit_scoring(fn: Callable[..., Any], *args: Any
+                    ) -> concurrent.futures.Future:
+    """Submits a call to the scoring threads."""
+    global _scoring_executor
+    with _scoring_executor_lock:
+        if _scoring_executor is None:
+            _scoring_executor = concurrent.futures.ThreadPoolExecutor(
+                _scoring_workers, thread_name_prefix="scoring",
+                initializer=_mark_scoring_thread
+            )
+        return _scoring_executor.submit(fn, *args)
+
+
+def _map_scoring(fn: Callable[[T], R], items: Sequence[T]) -> List[R]:
+    """Calls `fn` on each item in the scoring threads and returns the results
+    in order. Runs the calls in the current thread if there is a single
+    item, a single scoring thread, or if it already is a scoring thread."""
+    if len(items) <= 1 or get_scoring_workers() <= 1 \
+            or _in_scoring_thread():
+        return [fn(item) for item in items]
+    futures = [_submit_scoring(fn, item) for item in items]
+    return [future.result() for future in futures]
+
 
 class DocumentInfo(NamedTuple):
     """Class to store information about a document.
@@ -22,40 +119,162 @@ class DocumentInfo(NamedTuple):
     Attributes:
         document: The document text or content.
         score: The relevance score of the document. The higher the
-            score, the more relevant the document is. It is in the range
-            [0, 1].
+            score, the more relevant the document is. It is the cosine
+            similarity between the question and the document, in the range
+            [-1, 1].
         playlist_name: The name of the playlist to which the document belongs.
     """
-    document: Document
+    document: "Document"
     score: float
     playlist_name: str
 
+    def to_dict(self) -> Dict[str, Any]:
+        """Returns a JSON-serializable dictionary with the text, metadata,
+        score and playlist of the document."""
+        return {"playlist_name": self.playlist_name,
+                "score": float(self.score),
+                "text": self.document.page_content,
+                "metadata": self.document.metadata}
+
+    @classmethod
+    def from_dict(cls, data: Dict[str, Any]) -> "DocumentInfo":
+        """Rebuilds a document info from the dictionary of `to_dict`."""
+        from langchain.schema import Document
+
+        return cls(document=Document(page_content=data["text"],
+                                     metadata=data["metadata"]),
+                   score=float(data["score"]),
+                   playlist_name=data["playlist_name"])
+
 
 class Retriever:
-    """Class to retrieve the most relevant documents for a given question."""
+    """Class to retrieve the most relevant documents for a given question.
+
+    The `vector_store` of `hyperparams.yaml` selects the backend. With
+    `in-memory` (the default), the embeddings of every document are loaded
+    in memory and scored exactly. With `chroma-db`, the questions are
+    answered by the persistent Chroma collection of the retriever, and the
+    documents and embeddings are only loaded if they are accessed.
+
+    The chunks are kept in a columnar `ChunkStore`, and a `Document` is only
+    built for each document that is returned.
+
+    With `mmr_lambda`, the documents are diversified with maximal marginal
+    relevance, and adjacent chunks of a video are collapsed into one
+    document (see `diversity`).
+
+    In memory, the search can also be done in two stages: the questions are
+    scored against a few vectors that summarize each video, and only the
+    chunks of the best `n_videos` videos are scored. See `search`.
+
+    With `memory_map`, the embeddings are not loaded. The retriever maps the
+    index file shared by every process of the host instead (see
+    `acquire_shared_index`), and releases it on `close`.
+
+    Args:
+        retriever_directory (pathlib.Path): The directory of the retriever.
+        config_filename (str): The name of the hyperparameters file.
+        memory_map (bool): Whether to map the shared index file instead of
+            loading the embeddings. Defaults to False.
+    """
 
+    @instrumentation.timed("retriever.init")
     def __init__(self,
                  retriever_directory: pathlib.Path,
-                 config_filename: str = "hyperparams.yaml"):
+                 config_filename: str = "hyperparams.yaml",
+                 memory_map: bool = False):
         self.retriever_directory = retriever_directory
+        self.memory_map = memory_map
 
         self.embedding_model_name = ""
         self.max_chunk_size = None
         self.min_overlap_size = None
+        self.chunking_mode = "characters"
+        self.vector_store_type = "in-memory"
         self._load_config(config_filename)
 
-        self.embedding_model = get_embedding_model(self.embedding_model_name)
+        self._embedding_model: Optional["base.Embeddings"] = None
+        self._chunks: Optional[ChunkStore] = None
+        self._video_embeddings: Optional[List[np.ndarray]] = None
+        self._embedding_matrix: Optional[np.ndarray] = None
+        # Row where the documents of each video start in the matrix, plus
+        # the total number of rows
+        self._video_offsets: Optional[np.ndarray] = None
+        self._summary_matrix: Optional[np.ndarray] = None
+        self._summary_videos: Optional[np.ndarray] = None
+        self._closed = False
+
+        self.vector_store: Optional[ChromaVectorStore] = None
+        if self.vector_store_type == "chroma-db":
+            self.vector_store = ChromaVectorStore(
+                retriever_directory / "chroma"
+            )
+        elif memory_map:
+            self._embedding_matrix = acquire_shared_index(retriever_directory)
+            self._chunks = load_chunk_store(retriever_directory)
+        else:
+            self._chunks = load_chunk_store(retriever_directory)
+            self._video_embeddings = load_embeddings(
+                retriever_directory / "embeddings"
+            )
+
+    def close(self) -> None:
+        """Releases the shared index, if it is mapped. The embeddings of a
+        closed retriever cannot be used anymore."""
+        if self.memory_map and not self._closed:
+            self._closed = True
+            self._embedding_matrix = None
+            self._video_offsets = None
+            self._summary_matrix = None
+            release_shared_index(self.retriever_directory)
+
+    def __enter__(self) -> "Retriever":
+        return self
+
+    def __exit__(self, *args) -> None:
+        self.close()
 
-        chunked_data_directory = retriever_directory / "chunked_data"
-        self.documents = get_documents_from_directory(chunked_data_directory)
+    @property
+    def chunks(self) -> ChunkStore:
+        """Returns the chunks of every video, loading them on first use."""
+        if self._chunks is None:
+            self._chunks = load_chunk_store(self.retriever_directory)
+        return self._chunks
 
-        embedding_directory = retriever_directory / "embeddings"
-        self.video_embeddings = load_embeddings(embedding_directory)
+    @property
+    def documents(self) -> List[List["Document"]]:
+        """Returns the documents of each video.
+
+        They are built from `chunks` on every access, so prefer `chunks` for
+        large retrievers.
+        """
+        return [self.chunks.video_documents(video)
+                for video in range(self.chunks.n_videos)]
+
+    @property
+    def video_embeddings(self) -> List[np.ndarray]:
+        """Returns the embeddings of the documents of each video."""
+        if self._video_embeddings is None:
+            self._video_embeddings = load_embeddings(
+                self.retriever_directory / "embeddings"
+            )
+        return self._video_embeddings
+
+    @property
+    def embedding_model(self) -> "base.Embeddings":
+        """Returns the embedding model, loading it on first use."""
+        if self._embedding_model is None:
+            self._embedding_model = get_embedding_model(
+                self.embedding_model_name
+            )
+        return self._embedding_model
 
     @property
     def total_number_of_documents(self) -> int:
         """Returns the total number of documents."""
-        return sum(len(video) for video in self.documents)
+        if self.vector_store is not None:
+            return self.vector_store.count()
+        return len(self.chunks)
 
     def _load_config(self, filename: str = "hyperparams.yaml"):
         """Loads the hyperparameters from a YAML file.
@@ -70,6 +289,19 @@ class Retriever:
         self.embedding_model_name = config["model_name"]
         self.max_chunk_size = config["max_chunk_size"]
         self.min_overlap_size = config["min_overlap_size"]
+        # Retrievers created before the chunking modes and the vector stores
+        # measure characters and keep their embeddings in memory
+        self.chunking_mode = config.get("chunking_mode", "characters")
+        self.vector_store_type = config.get("vector_store", "in-memory")
+
+    @property
+    def max_overlap_size(self) -> Optional[int]:
+        """The most characters that two consecutive chunks share, if the
+        chunks are measured in characters."""
+        if self.chunking_mode != "characters" or \
+                self.min_overlap_size is None:
+            return None
+        return self.min_overlap_size + OVERLAP_MARGIN
 
     @staticmethod
     def cosine_distance(question_embedding: np.ndarray,
@@ -88,49 +320,378 @@ class Retriever:
         denominator = question_embedding_norm * document_embedding_norm
         return np.dot(question_embedding, document_embedding) / denominator
 
-    def retrieve_from_playlist(self,
-                               question: str,
-                               n_documents: int) -> List[DocumentInfo]:
-        """Retrieves the most relevant documents with their relevance score.
+    def _build_index(self) -> None:
+        """Stacks the embeddings of every video in a single matrix of unit
+        vectors, with a row per chunk of `chunks`.
 
-        Args:
-            question (str): The question posed by the user.
-            n_documents (int): The number of documents to retrieve.
+        A memory-mapped matrix is already stacked, so only its number of
+        rows is checked.
         """
-        n_documents = min(n_documents, self.total_number_of_documents)
+        chunks = self.chunks
+        if self._embedding_matrix is None:
+            for video, n_embeddings in enumerate(
+                    len(embeddings) for embeddings in self.video_embeddings):
+                if video >= chunks.n_videos or \
+                        chunks.video_sizes[video] != n_embeddings:
+                    n_documents = chunks.video_sizes[video] \
+                        if video < chunks.n_videos else 0
+                    raise ValueError("The number of documents does not match "
+                                     "the number of embeddings. Documents: "
+                                     f"{n_documents}, embeddings: "
+                                     f"{n_embeddings}")
+        chunks.check_indexes()
+
+        if self._embedding_matrix is None:
+            # Videos without chunks, e.g. whose chunks were all duplicates,
+            # are saved as empty arrays without dimension
+            video_embeddings = [embeddings
+                                for embeddings in self.video_embeddings
+                                if len(embeddings)]
+            if video_embeddings:
+                matrix = np.vstack(video_embeddings).astype(np.float32)
+            else:
+                matrix = np.empty((0, 0), dtype=np.float32)
+            self._embedding_matrix = _normalize_rows(matrix)
+        if len(self._embedding_matrix) != len(chunks):
+            raise ValueError("The number of documents does not match the "
+                             "number of rows of the embeddings. Documents: "
+                             f"{len(chunks)}, rows: "
+                             f"{len(self._embedding_matrix)}")
+        self._video_offsets = chunks.video_offsets
+
+    @property
+    def embedding_matrix(self) -> np.ndarray:
+        """Returns the normalized embeddings of all the documents, with a row
+        per document.
 
+        Raises:
+            ValueError: If the retriever is closed.
+        """
+        if self._closed:
+            raise ValueError("The shared index of the retriever is closed.")
+        if self._video_offsets is None:
+            self._build_index()
+        return self._embedding_matrix  # type: ignore
+
+    def _get_document_infos(self,
+                            rows: np.ndarray,
+                            scores: np.ndarray,
+                            n_documents: int,
+                            mmr_lambda: Optional[float]
+                            ) -> List[DocumentInfo]:
+        """Builds the documents of the best candidate rows of a question.
+
+        With `mmr_lambda`, only the `n_documents` candidates selected by
+        maximal marginal relevance are kept, and the adjacent ones are
+        collapsed.
+        """
+        if mmr_lambda is not None:
+            selected = maximal_marginal_relevance(
+                scores, self.embedding_matrix[rows], n_documents, mmr_lambda
+            )
+            rows, scores = rows[selected], scores[selected]
         playlist_name = self.retriever_directory.parent.name
+        document_infos = [DocumentInfo(document=self.chunks.document(row),
+                                       score=float(score),
+                                       playlist_name=playlist_name)
+                          for row, score in zip(rows, scores)]
+        if mmr_lambda is None:
+            return document_infos
+        return collapse_adjacent(document_infos, self.max_overlap_size)
+
+    def _build_summaries(self) -> None:
+        """Stacks the vectors that summarize each video, computed when the
+        retriever was created or, for older retrievers, from the centroid of
+        the embeddings of the video."""
+        matrix = self.embedding_matrix
+        offsets: np.ndarray = self._video_offsets  # type: ignore
+        summaries = load_embeddings(self.retriever_directory / "summaries")
+        is_valid = len(summaries) == self.chunks.n_videos and all(
+            summary.ndim == 2 and summary.shape[1:] == matrix.shape[1:]
+            for summary in summaries
+        )
+        if not is_valid:
+            summaries = [summarize_video_embeddings(matrix[start:end])
+                         for start, end in zip(offsets[:-1], offsets[1:])]
+        summary_videos = [np.full(len(summary), video, dtype=np.int64)
+                          for video, summary in enumerate(summaries)]
+        if summaries:
+            self._summary_matrix = _normalize_rows(
+                np.vstack(summaries).astype(np.float32)
+            )
+            self._summary_videos = np.concatenate(summary_videos)
+        else:
+            self._summary_matrix = np.empty((0, 0), dtype=np.float32)
+            self._summary_videos = np.empty(0, dtype=np.int64)
+
+    def route(self,
+              question_embeddings: np.ndarray,
+              n_videos: int) -> np.ndarray:
+        """Returns the videos whose summaries are the most similar to each
+        question.
+
+        A video scores the similarity of its closest summary vector.
+
+        Args:
+            question_embeddings (np.ndarray): A matrix with a row per
+                question, with unit norm.
+            n_videos (int): The number of videos per question.
 
-        question_embedding = self.embedding_model.embed_query(question)
-        question_embedding = np.array(question_embedding)  # type: ignore
-
-        document_infos = []
-        for video_documents, video_embedding in zip(self.documents,
-                                                    self.video_embeddings):
-            iterator = zip(video_documents, video_embedding)
-            for i, (document, document_embedding) in enumerate(iterator):
-                if document.metadata["index"] != i:
-                    raise ValueError("The index of the document does not match"
-                                     " its position in the list."
-                                     f" Index: {document.metadata['index']},"
-                                     f" Position: {i}")
-
-                score = 1 - self.cosine_distance(
-                    question_embedding, document_embedding  # type: ignore
+        Returns:
+            np.ndarray: A matrix with the indices of the videos of each
+            question, from the most to the least similar.
+        """
+        if self._summary_matrix is None:
+            self._build_summaries()
+        summary_matrix: np.ndarray = self._summary_matrix  # type: ignore
+        summary_videos: np.ndarray = self._summary_videos  # type: ignore
+        video_scores = np.full((len(question_embeddings),
+                                self.chunks.n_videos),
+                               -np.inf, dtype=np.float32)
+        if len(summary_videos):
+            scores = question_embeddings @ summary_matrix.T
+            # The summary vectors of each video are contiguous
+            starts = np.flatnonzero(np.diff(summary_videos, prepend=-1))
+            video_scores[:, summary_videos[starts]] = \
+                np.maximum.reduceat(scores, starts, axis=1)
+        n_videos = min(n_videos, video_scores.shape[1])
+        return _top_k(video_scores, n_videos)[0]
+
+    def _routed_search(self,
+                       question_embeddings: np.ndarray,
+                       n_documents: int,
+                       n_videos: int,
+                       allowed_rows: Optional[np.ndarray],
+                       mmr_lambda: Optional[float] = None
+                       ) -> List[List[DocumentInfo]]:
+        """Scores the documents of the `n_videos` videos routed to each
+        question."""
+        matrix = self.embedding_matrix
+        offsets: np.ndarray = self._video_offsets  # type: ignore
+        is_allowed = None
+        if allowed_rows is not None:
+            is_allowed = np.zeros(len(matrix), dtype=bool)
+            is_allowed[allowed_rows] = True
+
+        with instrumentation.span("retriever.route"):
+            routed_videos = self.route(question_embeddings, n_videos)
+        results: List[List[DocumentInfo]] = []
+        n_scored = 0
+        with instrumentation.span("retriever.score"):
+            for question_embedding, videos in zip(question_embeddings,
+                                                  routed_videos):
+                rows = np.concatenate(
+                    [np.arange(offsets[video], offsets[video + 1])
+                     for video in videos] + [np.empty(0, dtype=np.int64)]
+                )
+                if is_allowed is not None:
+                    rows = rows[is_allowed[rows]]
+                n_scored += len(rows)
+                k = min(_get_n_candidates(n_documents, mmr_lambda),
+                        len(rows))
+                if k <= 0:
+                    results.append([])
+                    continue
+                scores = matrix[rows] @ question_embedding
+                indices, top_scores = _top_k(scores[None], k)
+                results.append(self._get_document_infos(
+                    rows[indices[0]], top_scores[0], n_documents, mmr_lambda
+                ))
+        instrumentation.increment("retriever.documents_scored", n_scored)
+        return results
+
+    def embed_questions(self, questions: Sequence[str]) -> np.ndarray:
+        """Embeds the questions with the embedding model of the retriever.
+
+        A single question is embedded with `embed_query`, while several
+        questions are embedded in one batch with `embed_documents`.
+
+        Returns:
+            np.ndarray: A matrix with a row per question.
+        """
+        with instrumentation.span("retriever.embed_questions"):
+            if len(questions) == 1:
+                embeddings = [self.embedding_model.embed_query(questions[0])]
+            else:
+                embeddings = self.embedding_model.embed_documents(
+                    list(questions)
                 )
-                document_info = DocumentInfo(document=document,
+        return np.array(embeddings, dtype=np.float32)
+
+    def search(self,
+               question_embeddings: np.ndarray,
+               n_documents: int,
+               where: Optional[Dict[str, Any]] = None,
+               n_videos: Optional[int] = None,
+               mmr_lambda: Optional[float] = None
+               ) -> List[List[DocumentInfo]]:
+        """Returns the most relevant documents for already embedded questions.
+
+        In memory, all the questions are scored against the documents with
+        matrix-matrix products. The products are computed in blocks of
+        `QUESTION_BLOCK_SIZE` questions and `DOCUMENT_BLOCK_SIZE` documents so
+        that the memory used is bounded regardless of the number of questions
+        and documents. Large matrices are split in shards that are scored in
+        parallel (see `set_scoring_workers`). With a Chroma vector store, the
+        HNSW index of the collection is queried instead.
+
+        With `n_videos`, the in-memory search is done in two stages. The
+        questions are first scored against the vectors that summarize each
+        video (see `summarize_video_embeddings`), and then only against the
+        documents of the `n_videos` most similar videos. The fewer videos,
+        the faster the search, but the more relevant documents may be missed
+        in videos that are not similar to the question as a whole.
+
+        With `mmr_lambda`, `MMR_CANDIDATE_FACTOR` times more candidates are
+        retrieved, and `n_documents` of them are selected with maximal
+        marginal relevance. Then the selected chunks that are adjacent in a
+        video are collapsed into one document, so fewer documents may be
+        returned.
+
+        Args:
+            question_embeddings (np.ndarray): A matrix with a row per question.
+            n_documents (int): The number of documents to retrieve for each
+                question.
+            where (Dict[str, Any], optional): A filter on the metadata of the
+                documents, e.g. `{"title": "Episode 1"}`. Chroma supports its
+                whole filter syntax, while the in-memory backend only
+                supports equality.
+            n_videos (int, optional): The number of videos searched for each
+                question. Defaults to every video. Ignored by Chroma, whose
+                index is already sublinear.
+            mmr_lambda (float, optional): The weight of the relevance
+                against the diversity of the documents, between 0 and 1.
+                Defaults to ranking by relevance only, without collapsing
+                adjacent chunks.
+
+        Returns:
+            List[List[DocumentInfo]]: The documents retrieved for each
+            question, sorted in descending order by relevance score.
+
+        Raises:
+            ValueError: If the in-memory backend receives a filter with
+                operators, or if `mmr_lambda` is not between 0 and 1.
+        """
+        playlist_name = self.retriever_directory.parent.name
+        question_embeddings = _normalize_rows(
+            np.atleast_2d(question_embeddings).astype(np.float32)
+        )
+        n_candidates = _get_n_candidates(n_documents, mmr_lambda)
+        if self.vector_store is not None and mmr_lambda is None:
+            with instrumentation.span("retriever.score"):
+                all_document_scores = self.vector_store.query(
+                    question_embeddings, n_candidates, where
+                )
+            return [[DocumentInfo(document=document, score=score,
+                                  playlist_name=playlist_name)
+                     for document, score in document_scores]
+                    for document_scores in all_document_scores]
+        if self.vector_store is not None:
+            # The embeddings of the candidates are only fetched for MMR
+            with instrumentation.span("retriever.score"):
+                store_results = self.vector_store.query_with_embeddings(
+                    question_embeddings, n_candidates, where
+                )
+            return [_diversify([DocumentInfo(document=document,
                                              score=score,
                                              playlist_name=playlist_name)
-                document_infos.append(document_info)
+                                for document, score in document_scores],
+                               _normalize_rows(embeddings), n_documents,
+                               mmr_lambda, self.max_overlap_size)
+                    for document_scores, embeddings in store_results]
+
+        matrix = self.embedding_matrix
+        chunks = self.chunks
+        rows = chunks.filter_rows(where) if where else None
+        if n_videos is not None and n_videos < chunks.n_videos:
+            return self._routed_search(question_embeddings, n_documents,
+                                       n_videos, rows, mmr_lambda)
+        if rows is not None:
+            matrix = matrix[rows]
+        n_candidates = min(n_candidates, len(matrix))
+
+        results = []
+        with instrumentation.span("retriever.score"):
+            for start in range(0, len(question_embeddings),
+                               QUESTION_BLOCK_SIZE):
+                block = question_embeddings[start:start + QUESTION_BLOCK_SIZE]
+                indices, scores = _sharded_top_k(block, matrix, n_candidates)
+                if rows is not None:
+                    indices = rows[indices]
+                for row_indices, row_scores in zip(indices, scores):
+                    results.append(self._get_document_infos(
+                        row_indices, row_scores, n_documents, mmr_lambda
+                    ))
+        instrumentation.increment("retriever.documents_scored",
+                                  len(question_embeddings) * len(matrix))
+        return results
+
+    @instrumentation.timed("retriever.retrieve_batch_from_playlist")
+    def retrieve_batch_from_playlist(self,
+                                     questions: Sequence[str],
+                                     n_documents: int,
+                                     where: Optional[Dict[str, Any]] = None,
+                                     n_videos: Optional[int] = None,
+                                     mmr_lambda: Optional[float] = None
+                                     ) -> List[List[DocumentInfo]]:
+        """Retrieves the most relevant documents for several questions.
+
+        The questions are embedded in a single batch and scored together.
+
+        Args:
+            questions (Sequence[str]): The questions posed by the user.
+            n_documents (int): The number of documents to retrieve for each
+                question.
+            where (Dict[str, Any], optional): A filter on the metadata of the
+                documents. See `search`.
+            n_videos (int, optional): The number of videos searched for each
+                question. See `search`.
+            mmr_lambda (float, optional): The weight of the relevance
+                against the diversity of the documents. See `search`.
+
+        Returns:
+            List[List[DocumentInfo]]: The documents retrieved for each
+            question.
+        """
+        if not questions:
+            return []
+        return self.search(self.embed_questions(questions), n_documents,
+                           where, n_videos, mmr_lambda)
+
+    @instrumentation.timed("retriever.retrieve_from_playlist")
+    def retrieve_from_playlist(self,
+                               question: str,
+                               n_documents: int,
+                               where: Optional[Dict[str, Any]] = None,
+                               n_videos: Optional[int] = None,
+                               mmr_lambda: Optional[float] = None
+                               ) -> List[DocumentInfo]:
+        """Retrieves the most relevant documents with their relevance score.
 
-        document_infos.sort(key=lambda x: x.score, reverse=True)
-        return document_infos[:n_documents]
+        Args:
+            question (str): The question posed by the user.
+            n_documents (int): The number of documents to retrieve.
+            where (Dict[str, Any], optional): A filter on the metadata of the
+                documents. See `search`.
+            n_videos (int, optional): The number of videos searched. See
+                `search`.
+            mmr_lambda (float, optional): The weight of the relevance
+                against the diversity of the documents. See `search`.
+        """
+        return self.retrieve_batch_from_playlist([question], n_documents,
+                                                 where, n_videos,
+                                                 mmr_lambda)[0]
 
     @classmethod
+    @instrumentation.timed("retriever.retrieve")
     def retrieve(cls,
                  retrievers: List['Retriever'],
                  question: str,
-                 n_documents: int) -> List[DocumentInfo]:
+                 n_documents: int,
+                 where: Optional[Dict[str, Any]] = None,
+                 n_videos: Optional[int] = None,
+                 mmr_lambda: Optional[float] = None
+                 ) -> List[DocumentInfo]:
         """Retrieves the most relevant documents with their score and
         the playlist they belong to.
 
@@ -146,17 +707,176 @@ class Retriever:
             retrievers (List[Retriever]): A list of retrievers.
             question (str): The question posed by the user.
             n_documents (int): The number of documents to retrieve.
+            where (Dict[str, Any], optional): A filter on the metadata of the
+                documents. See `search`.
+            n_videos (int, optional): The number of videos searched in each
+                retriever. See `search`.
+            mmr_lambda (float, optional): The weight of the relevance
+                against the diversity of the documents. See `search`.
 
         Returns:
             list: A list of named tuples, each containing the document, its
             score and the playlist it belongs to. The list is sorted in
             descending order by relevance score.
         """
-        document_infos = []
-        for retriever in retrievers:
-            document_infos.extend(retriever.retrieve_from_playlist(
-                question, n_documents
-            ))
+        return cls.retrieve_batch(retrievers, [question], n_documents,
+                                  where, n_videos, mmr_lambda)[0]
 
-        document_infos.sort(key=lambda x: x.score, reverse=True)
-        return document_infos[:n_documents]
+    @classmethod
+    @instrumentation.timed("retriever.retrieve_batch")
+    def retrieve_batch(cls,
+                       retrievers: List['Retriever'],
+                       questions: Sequence[str],
+                       n_documents: int,
+                       where: Optional[Dict[str, Any]] = None,
+                       n_videos: Optional[int] = None,
+                       mmr_lambda: Optional[float] = None
+                       ) -> List[List[DocumentInfo]]:
+        """Retrieves the most relevant documents for several questions from
+        several retrievers.
+
+        The questions are embedded once per embedding model, so retrievers
+        that share a model also share the question embeddings. Then the
+        retrievers are searched in parallel by the scoring threads.
+
+        Args:
+            retrievers (List[Retriever]): A list of retrievers.
+            questions (Sequence[str]): The questions.
+            n_documents (int): The number of documents to retrieve for each
+                question.
+            where (Dict[str, Any], optional): A filter on the metadata of the
+                documents. See `search`.
+            n_videos (int, optional): The number of videos searched in each
+                retriever. See `search`.
+            mmr_lambda (float, optional): The weight of the relevance
+                against the diversity of the documents. See `search`.
+
+        Returns:
+            List[List[DocumentInfo]]: For each question, the retrieved
+            documents sorted in descending order by relevance score.
+        """
+        question_embeddings: Dict[str, np.ndarray] = {}
+        results: List[List[DocumentInfo]] = [[] for _ in questions]
+        if not questions:
+            return results
+        for retriever in retrievers:
+            model_name = retriever.embedding_model_name
+            if model_name not in question_embeddings:
+                question_embeddings[model_name] = \
+                    retriever.embed_questions(questions)
+
+        def search(retriever: Retriever) -> List[List[DocumentInfo]]:
+            return retriever.search(
+                question_embeddings[retriever.embedding_model_name],
+                n_documents, where, n_videos, mmr_lambda
+            )
+
+        # The scoring threads score the shards of their retriever themselves
+        for retriever_results in _map_scoring(search, retrievers):
+            for document_infos, new_document_infos in zip(results,
+                                                          retriever_results):
+                document_infos.extend(new_document_infos)
+
+        for document_infos in results:
+            document_infos.sort(key=lambda x: x.score, reverse=True)
+            del document_infos[n_documents:]
+        return results
+
+
+def _get_n_candidates(n_documents: int, mmr_lambda: Optional[float]) -> int:
+    """Returns the number of candidates to score for `n_documents`."""
+    if mmr_lambda is None:
+        return n_documents
+    return MMR_CANDIDATE_FACTOR * n_documents
+
+
+def _diversify(document_infos: List[DocumentInfo],
+               embeddings: np.ndarray,
+               n_documents: int,
+               mmr_lambda: Optional[float],
+               max_overlap_size: Optional[int] = None) -> List[DocumentInfo]:
+    """Selects `n_documents` candidates with maximal marginal relevance and
+    collapses the adjacent ones, if `mmr_lambda` is given."""
+    if mmr_lambda is None:
+        return document_infos
+    selected = maximal_marginal_relevance(
+        np.array([document_info.score for document_info in document_infos]),
+        embeddings, n_documents, mmr_lambda
+    )
+    return collapse_adjacent([document_infos[position]
+                              for position in selected], max_overlap_size)
+
+
+def _normalize_rows(matrix: np.ndarray) -> np.ndarray:
+    """Scales the rows of a matrix to unit norm, leaving zero rows as is."""
+    norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+    norms[norms == 0] = 1
+    return matrix / norms
+
+
+def _top_k(scores: np.ndarray, k: int) -> Tuple[np.ndarray, np.ndarray]:
+    """Returns the indices and values of the `k` highest scores of each row,
+    sorted in descending order."""
+    if k < scores.shape[1]:
+        indices = np.argpartition(-scores, k - 1, axis=1)[:, :k]
+    else:
+        indices = np.broadcast_to(np.arange(scores.shape[1]), scores.shape)
+    top_scores = np.take_along_axis(scores, indices, axis=1)
+    order = np.argsort(-top_scores, axis=1, kind="stable")
+    return (np.take_along_axis(indices, order, axis=1),
+            np.take_along_axis(top_scores, order, axis=1))
+
+
+def _sharded_top_k(question_embeddings: np.ndarray,
+                   document_embeddings: np.ndarray,
+                   k: int) -> Tuple[np.ndarray, np.ndarray]:
+    """Returns the same as `_blocked_top_k`, scoring shards of the documents
+    in the scoring threads and merging their top `k`."""
+    n_shards = min(get_scoring_workers(),
+                   -(-len(document_embeddings) // MIN_SHARD_SIZE))
+    if n_shards <= 1 or k <= 0 or _in_scoring_thread():
+        return _blocked_top_k(question_embeddings, document_embeddings, k)
+
+    bounds = np.linspace(0, len(document_embeddings), n_shards + 1,
+                         dtype=np.int64)
+    futures = [_submit_scoring(_blocked_top_k, question_embeddings,
+                               document_embeddings[start:end], k)
+               for start, end in zip(bounds[:-1], bounds[1:])]
+    shard_results = [future.result() for future in futures]
+    candidate_indices = np.concatenate(
+        [indices + start
+         for (indices, _), start in zip(shard_results, bounds[:-1])],
+        axis=1
+    )
+    candidate_scores = np.concatenate([scores for _, scores in shard_results],
+                                      axis=1)
+    order, best_scores = _top_k(candidate_scores,
+                                min(k, candidate_scores.shape[1]))
+    return np.take_along_axis(candidate_indices, order, axis=1), best_scores
+
+
+def _blocked_top_k(question_embeddings: np.ndarray,
+                   document_embeddings: np.ndarray,
+                   k: int) -> Tuple[np.ndarray, np.ndarray]:
+    """Returns the indices and scores of the `k` documents with the highest
+    dot product with each question.
+
+    The documents are scored in blocks of `DOCUMENT_BLOCK_SIZE` rows, keeping
+    only the running top `k` of each question between blocks.
+    """
+    n_questions = len(question_embeddings)
+    best_indices = np.empty((n_questions, 0), dtype=np.int64)
+    best_scores = np.empty((n_questions, 0), dtype=np.float32)
+    if k <= 0:
+        return best_indices, best_scores
+    for start in range(0, len(document_embeddings), DOCUMENT_BLOCK_SIZE):
+        block = document_embeddings[start:start + DOCUMENT_BLOCK_SIZE]
+        scores = question_embeddings @ block.T
+        indices, scores = _top_k(scores, min(k, scores.shape[1]))
+        candidate_indices = np.concatenate([best_indices, indices + start],
+                                           axis=1)
+        candidate_scores = np.concatenate([best_scores, scores], axis=1)
+        order, best_scores = _top_k(candidate_scores,
+                                    min(k, candidate_scores.shape[1]))
+        best_indices = np.take_along_axis(candidate_indices, order, axis=1)
+    return best_indices, best_scores
@@ -0,0 +1,161 @@
+"""Progress and message reporting decoupled from the user interface.
+
+Long-running functions such as `download_playlist` or
+`create_embeddings_pipeline` report their progress and warnings through a
+`Reporter` instead of calling Streamlit directly. The web application passes
+a `StreamlitReporter`, while scripts and batch workers can use the
+`LoggingReporter` (the default), a `TqdmReporter` or the `NullReporter`.
+"""
+import logging
+from typing import Any, Optional
+
+logger = logging.getLogger(__name__)
+
+
+class Reporter:
+    """Base class of the reporters. It ignores every message."""
+
+    def progress(self, fraction: float, text: str = "") -> None:
+        """Reports the progress of the current task.
+
+        Args:
+            fraction (float): The completed fraction, in the range [0, 1].
+            text (str): A short description of the current step.
+        """
+
+    def info(self, message: str) -> None:
+        """Reports an informative message."""
+
+    def warning(self, message: str) -> None:
+        """Reports a recoverable problem, e.g. a video without transcript."""
+
+    def checkpoint(self, item: str, done: int, total: int, size: int,
+                   skipped: bool = False) -> None:
+        """Reports that an item of the current task is completed and saved.
+
+        Args:
+            item (str): The name of the item, e.g. a video.
+            done (int): The number of completed items, including this one.
+            total (int): The total number of items.
+            size (int): The amount of work of the item, e.g. its chunks.
+            skipped (bool): Whether the item was completed by a previous
+                run and skipped.
+        """
+
+
+class NullReporter(Reporter):
+    """Reporter that discards everything. Useful in benchmarks and tests."""
+
+
+class LoggingReporter(Reporter):
+    """Reporter that forwards everything to a `logging.Logger`.
+
+    Progress messages are logged at DEBUG level so that they do not flood the
+    logs of batch jobs.
+
+    Args:
+        target_logger (logging.Logger, optional): The logger to use. Defaults
+            to the logger of this module.
+    """
+
+    def __init__(self, target_logger: Optional[logging.Logger] = None):
+        self.logger = target_logger or logger
+
+    def progress(self, fraction: float, text: str = "") -> None:
+        self.logger.debug("%5.1f%% %s", fraction * 100, text)
+
+    def info(self, message: str) -> None:
+        self.logger.info(message)
+
+    def warning(self, message: str) -> None:
+        self.logger.warning(message)
+
+
+class TqdmReporter(Reporter):
+    """Reporter that shows the progress in a terminal with `tqdm`.
+
+    Args:
+        description (str): The description shown before the progress bar.
+    """
+
+    def __init__(self, description: str = ""):
+        self.description = description
+        self._bar: Any = None
+
+    def _get_bar(self):
+        if self._bar is None:
+            from tqdm.auto import tqdm
+            self._bar = tqdm(total=100, desc=self.description,
+                             bar_format="{l_bar}{bar}| {postfix}")
+        return self._bar
+
+    def progress(self, fraction: float, text: str = "") -> None:
+        progress_bar = self._get_bar()
+        progress_bar.n = round(fraction * 100, 1)
+        progress_bar.set_postfix_str(text, refresh=False)
+        progress_bar.refresh()
+        if fraction >= 1:
+            progress_bar.close()
+            self._bar = None
+
+    def info(self, message: str) -> None:
+        from tqdm.auto import tqdm
+        tqdm.write(message)
+
+    def warning(self, message: str) -> None:
+        from tqdm.auto import tqdm
+        tqdm.write(f"WARNING: {message}")
+
+
+class StreamlitReporter(Reporter):
+    """Reporter that uses a Streamlit progress bar and alert messages.
+
+    The progress bar is created the first time progress is reported, so
+    creating the reporter does not add anything to the page.
+    """
+
+    def __init__(self):
+        self._progress_bar: Any = None
+
+    def progress(self, fraction: float, text: str = "") -> None:
+        import streamlit as st
+        if self._progress_bar is None:
+            self._progress_bar = st.progress(0)
+        self._progress_bar.progress(fraction, text)
+
+    def info(self, message: str) -> None:
+        import streamlit as st
+        st.info(message)
+
+    def warning(self, message: str) -> None:
+        import streamlit as st
+        st.warning(message)
+
+
+_default_reporter: Reporter = LoggingReporter()
+
+
+def get_default_reporter() -> Reporter:
+    """Returns the reporter used when a function does not receive one."""
+    return _default_reporter
+
+
+def set_default_reporter(reporter: Reporter) -> None:
+    """Sets the reporter used when a function does not receive one."""
+    global _default_reporter
+    _default_reporter = reporter
+
+
+def resolve_reporter(reporter: Optional[Reporter] = None,
+                     use_st_progress_bar: bool = False) -> Reporter:
+    """Returns the reporter a function should use.
+
+    An explicit `reporter` always wins. Otherwise, the legacy
+    `use_st_progress_bar` flag selects a `StreamlitReporter`, and if it is not
+    set the default reporter is used.
+    """
+    if reporter is not None:
+        return reporter
+    if use_st_progress_bar:
+        return StreamlitReporter()
+    return get_default_reporter()
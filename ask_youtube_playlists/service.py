@@ -0,0 +1,457 @@
+"""Asynchronous HTTP service to retrieve documents and answer questions.
+
+The retrievers and models are loaded once at startup and warmed up, so that
+no request pays for loading them. Concurrent requests are coalesced into
+micro-batches: the questions that arrive within a small time window are
+embedded and scored together, and so are the (question, context) pairs of the
+extractive model.
+
+Endpoints:
+    GET  /health    The names of the loaded retrievers.
+    GET  /metrics   The metrics of `instrumentation` in Prometheus format.
+    POST /retrieve  {"question": str, "n_documents": int,
+                     "retrievers": [str] (optional, defaults to all)}
+    POST /answer    The same fields plus "mode" ("extractive" or
+                    "generative") and, for the generative mode, "model_name",
+                    "temperature", "max_length" and "map_reduce".
+
+The service is started with `ask-youtube-playlists serve`, and
+`QueryServiceClient` is a small synchronous client for it.
+"""
+import asyncio
+import concurrent.futures
+import functools
+import json
+import logging
+import pathlib
+import urllib.request
+from dataclasses import dataclass
+from typing import (Any, Callable, Dict, FrozenSet, List, Optional, Sequence,
+                    Set, Tuple)
+
+import numpy as np
+from aiohttp import web
+
+from ask_youtube_playlists import instrumentation
+from ask_youtube_playlists.question_answering import (DocumentInfo,
+                                                      Retriever,
+                                                      get_extractive_answers,
+                                                      get_generative_answer)
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_EXTRACTIVE_MODEL = "deepset/roberta-base-squad2"
+DEFAULT_MAX_BATCH_SIZE = 32
+DEFAULT_BATCH_WINDOW = 0.005
+
+
+class MicroBatcher:
+    """Coalesces concurrent calls into batches.
+
+    The items submitted within `max_wait` seconds of the first item of a batch
+    are processed together by `process_batch`, a blocking function that
+    receives a list of items and returns a list with a result per item.
+    Batches run in a dedicated thread, one at a time, so the model used by
+    `process_batch` is never called concurrently.
+
+    Args:
+        process_batch (Callable[[List[Any]], List[Any]]): The function that
+            processes a batch.
+        max_batch_size (int): A batch is processed as soon as it has this
+            number of items.
+        max_wait (float): The maximum time in seconds an item waits for other
+            items before its batch is processed.
+        name (str): The name used in the instrumentation counters.
+    """
+
+    def __init__(self,
+                 process_batch: Callable[[List[Any]], List[Any]],
+                 max_batch_size: int = DEFAULT_MAX_BATCH_SIZE,
+                 max_wait: float = DEFAULT_BATCH_WINDOW,
+                 name: str = "batcher"):
+        self.process_batch = process_batch
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait
+        self.name = name
+        self._pending: List[Tuple[Any, asyncio.Future]] = []
+        self._timer: Optional[asyncio.TimerHandle] = None
+        # The event loop only keeps weak references to the tasks, so the
+        # running batches are kept here until they finish
+        self._tasks: Set[asyncio.Task] = set()
+        self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+
+    async def submit(self, item: Any) -> Any:
+        """Adds an item to the current batch and waits for its result."""
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        self._pending.append((item, future))
+        if len(self._pending) >= self.max_batch_size:
+            self._flush()
+        elif self._timer is None:
+            self._timer = loop.call_later(self.max_wait, self._flush)
+        return await future
+
+    def _flush(self) -> None:
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        batch, self._pending = self._pending, []
+        if batch:
+            task = asyncio.ensure_future(self._run(batch))
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+
+    async def _run(self, batch: List[Tuple[Any, asyncio.Future]]) -> None:
+        loop = asyncio.get_running_loop()
+        items = [item for item, _ in batch]
+        instrumentation.increment(f"service.{self.name}.batches")
+        instrumentation.increment(f"service.{self.name}.items", len(items))
+        try:
+            results = await loop.run_in_executor(self._executor,
+                                                 self.process_batch,
+                                                 items)
+        except Exception as error:
+            for _, future in batch:
+                if not future.done():
+                    future.set_exception(error)
+            return
+        for (_, future), result in zip(batch, results):
+            # The request may have been cancelled while the batch was running
+            if not future.done():
+                future.set_result(result)
+
+    def close(self) -> None:
+        """Stops the thread that processes the batches."""
+        self._executor.shutdown(wait=False)
+
+
+@dataclass(frozen=True)
+class _RetrieveRequest:
+    question: str
+    n_documents: int
+    retriever_names: FrozenSet[str]
+
+
+class QueryService:
+    """Serves retrieval and question answering requests with micro-batching.
+
+    Args:
+        retrievers (Dict[str, Retriever]): The retrievers by name.
+        extractive_model_name (str, optional): The extractive model. If None,
+            the extractive mode is disabled.
+        max_batch_size (int): The maximum number of items per micro-batch.
+        batch_window (float): The maximum time in seconds a request waits for
+            others to form a batch.
+    """
+
+    def __init__(self,
+                 retrievers: Dict[str, Retriever],
+                 extractive_model_name: Optional[str] = (
+                     DEFAULT_EXTRACTIVE_MODEL),
+                 max_batch_size: int = DEFAULT_MAX_BATCH_SIZE,
+                 batch_window: float = DEFAULT_BATCH_WINDOW):
+        self.retrievers = retrievers
+        self.extractive_model_name = extractive_model_name
+
+        self._retrievers_by_model: Dict[str, Dict[str, Retriever]] = {}
+        for name, retriever in retrievers.items():
+            self._retrievers_by_model.setdefault(
+                retriever.embedding_model_name, {}
+            )[name] = retriever
+
+        self._retrieve_batchers = {
+            model_name: MicroBatcher(
+                functools.partial(self._retrieve_batch, model_name),
+                max_batch_size, batch_window, name="retrieve",
+            )
+            for model_name in self._retrievers_by_model
+        }
+        self._extractive_batcher = MicroBatcher(
+            self._extractive_batch, max_batch_size, batch_window,
+            name="extractive",
+        )
+
+    @classmethod
+    def from_directories(cls,
+                         retriever_directories: Sequence[pathlib.Path],
+                         memory_map: bool = False,
+                         **kwargs) -> "QueryService":
+        """Loads the retrievers of the directories. Each retriever is named
+        `<playlist>/<retriever directory>`.
+
+        With `memory_map`, the retrievers map the index files shared by
+        every process of the host instead of loading the embeddings.
+        """
+        retrievers = {f"{directory.parent.name}/{directory.name}":
+                      Retriever(directory, memory_map=memory_map)
+                      for directory in retriever_directories}
+        return cls(retrievers, **kwargs)
+
+    @instrumentation.timed("service.warm_up")
+    def warm_up(self) -> None:
+        """Loads the models and indexes, and runs each model once, so that
+        the first requests are as fast as the following ones."""
+        for retrievers in self._retrievers_by_model.values():
+            for retriever in retrievers.values():
+                _ = retriever.embedding_matrix
+            next(iter(retrievers.values())).embed_questions(["warm up"])
+        if self.extractive_model_name is not None:
+            get_extractive_answers([("What is this?", "This is a warm up.")],
+                                   self.extractive_model_name)
+
+    def close(self) -> None:
+        """Stops the threads of the micro-batchers and releases the shared
+        indexes of the retrievers."""
+        for batcher in self._retrieve_batchers.values():
+            batcher.close()
+        self._extractive_batcher.close()
+        for retriever in self.retrievers.values():
+            retriever.close()
+
+    def _retrieve_batch(self,
+                        model_name: str,
+                        requests: List[_RetrieveRequest]
+                        ) -> List[List[DocumentInfo]]:
+        """Embeds the questions of a batch at once and scores them against
+        the retrievers that use `model_name`."""
+        retrievers = self._retrievers_by_model[model_name]
+        question_embeddings = next(iter(retrievers.values())).embed_questions(
+            [request.question for request in requests]
+        )
+        n_documents = max(request.n_documents for request in requests)
+        results: List[List[DocumentInfo]] = [[] for _ in requests]
+        for name, retriever in retrievers.items():
+            rows = [i for i, request in enumerate(requests)
+                    if name in request.retriever_names]
+            if not rows:
+                continue
+            retrieved = retriever.search(question_embeddings[np.array(rows)],
+                                         n_documents)
+            for row, document_infos in zip(rows, retrieved):
+                results[row].extend(document_infos)
+        return results
+
+    def _extractive_batch(self,
+                          questions_and_contexts: List[Tuple[str, str]]
+                          ) -> List[Dict[str, Any]]:
+        assert self.extractive_model_name is not None
+        return get_extractive_answers(questions_and_contexts,
+                                      self.extractive_model_name,
+                                      batch_size=len(questions_and_contexts))
+
+    async def retrieve(self,
+                       question: str,
+                       n_documents: int,
+                       retriever_names: Optional[Sequence[str]] = None
+                       ) -> List[DocumentInfo]:
+        """Retrieves the most relevant documents for a question.
+
+        Args:
+            question (str): The question.
+            n_documents (int): The number of documents to retrieve.
+            retriever_names (Sequence[str], optional): The retrievers to use.
+                Defaults to all of them.
+
+        Raises:
+            KeyError: If a retriever name is unknown.
+        """
+        names = frozenset(retriever_names or self.retrievers)
+        unknown = names - set(self.retrievers)
+        if unknown:
+            raise KeyError(f"Unknown retrievers {sorted(unknown)}. The "
+                           f"available retrievers are "
+                           f"{sorted(self.retrievers)}.")
+        request = _RetrieveRequest(question, n_documents, names)
+        model_names = {self.retrievers[name].embedding_model_name
+                       for name in names}
+        partial_results = await asyncio.gather(*(
+            self._retrieve_batchers[model_name].submit(request)
+            for model_name in model_names
+        ))
+        document_infos = [document_info
+                          for result in partial_results
+                          for document_info in result]
+        document_infos.sort(key=lambda x: x.score, reverse=True)
+        return document_infos[:n_documents]
+
+    async def answer_extractive(self,
+                                question: str,
+                                document_infos: Sequence[DocumentInfo]
+                                ) -> List[Dict[str, Any]]:
+        """Extracts an answer from each document. The pairs of concurrent
+        requests are batched together.
+
+        Raises:
+            ValueError: If the extractive mode is disabled.
+        """
+        if self.extractive_model_name is None:
+            raise ValueError("The extractive mode is disabled.")
+        return await asyncio.gather(*(
+            self._extractive_batcher.submit(
+                (question, document_info.document.page_content)
+            )
+            for document_info in document_infos
+        ))
+
+    async def answer_generative(self,
+                                question: str,
+                                document_infos: Sequence[DocumentInfo],
+                                model_name: str,
+                                temperature: float,
+                                max_length: int,
+                                map_reduce: bool = False) -> str:
+        """Generates an answer from the documents in a worker thread. See
+        `get_generative_answer`."""
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(None, functools.partial(
+            get_generative_answer,
+            question,
+            [document_info.document for document_info in document_infos],
+            model_name=model_name,
+            temperature=temperature,
+            max_length=max_length,
+            map_reduce=map_reduce,
+        ))
+
+
+def _json_error(status: int, message: str) -> web.Response:
+    return web.json_response({"error": message}, status=status)
+
+
+def create_app(service: QueryService) -> web.Application:
+    """Returns the aiohttp application that exposes the service."""
+    routes = web.RouteTableDef()
+
+    @routes.get("/health")
+    async def health(request: web.Request) -> web.Response:
+        return web.json_response({"status": "ok",
+                                  "retrievers": sorted(service.retrievers)})
+
+    @routes.get("/metrics")
+    async def metrics(request: web.Request) -> web.Response:
+        return web.Response(text=instrumentation.to_prometheus_text(),
+                            content_type="text/plain")
+
+    async def _retrieve(payload: Dict[str, Any]) -> List[DocumentInfo]:
+        return await service.retrieve(payload["question"],
+                                      int(payload.get("n_documents", 5)),
+                                      payload.get("retrievers"))
+
+    @routes.post("/retrieve")
+    async def retrieve(request: web.Request) -> web.Response:
+        try:
+            payload = await request.json()
+            document_infos = await _retrieve(payload)
+        except (KeyError, TypeError, ValueError) as error:
+            return _json_error(400, str(error))
+        return web.json_response({"documents": [document_info.to_dict()
+                                                for document_info
+                                                in document_infos]})
+
+    @routes.post("/answer")
+    async def answer(request: web.Request) -> web.Response:
+        try:
+            payload = await request.json()
+            mode = payload.get("mode", "extractive")
+            if mode not in ("extractive", "generative"):
+                raise ValueError(f"Unknown mode {mode}.")
+            document_infos = await _retrieve(payload)
+            response: Dict[str, Any] = {
+                "documents": [document_info.to_dict()
+                              for document_info in document_infos]
+            }
+            if mode == "extractive":
+                response["answers"] = await service.answer_extractive(
+                    payload["question"], document_infos
+                )
+            else:
+                response["answer"] = await service.answer_generative(
+                    payload["question"],
+                    document_infos,
+                    model_name=payload.get("model_name", "gpt-3.5-turbo"),
+                    temperature=float(payload.get("temperature", 0.7)),
+                    max_length=int(payload.get("max_length", 256)),
+                    map_reduce=bool(payload.get("map_reduce", False)),
+                )
+        except (KeyError, TypeError, ValueError) as error:
+            return _json_error(400, str(error))
+        return web.json_response(response, dumps=functools.partial(
+            json.dumps, default=float
+        ))
+
+    async def on_shutdown(app: web.Application) -> None:
+        service.close()
+
+    app = web.Application()
+    app.add_routes(routes)
+    app.on_shutdown.append(on_shutdown)
+    return app
+
+
+def run_service(retriever_directories: Sequence[pathlib.Path],
+                host: str = "127.0.0.1",
+                port: int = 8080,
+                **kwargs) -> None:
+    """Loads and warms up the retrievers and models, and serves them until
+    the process is interrupted.
+
+    Args:
+        retriever_directories (Sequence[pathlib.Path]): The retrievers.
+        host (str): The interface to bind. Defaults to localhost.
+        port (int): The port. Defaults to 8080.
+        **kwargs: Additional arguments passed to
+            `QueryService.from_directories`.
+    """
+    service = QueryService.from_directories(retriever_directories, **kwargs)
+    logger.info("Warming up %d retrievers", len(service.retrievers))
+    service.warm_up()
+    web.run_app(create_app(service), host=host, port=port)
+
+
+class QueryServiceClient:
+    """Synchronous client of the query service, e.g. for Streamlit pages.
+
+    It only uses the standard library, so the pages do not need to load any
+    model.
+
+    Args:
+        base_url (str): The URL of the service, e.g. `http://127.0.0.1:8080`.
+        timeout (float): The timeout of each request in seconds.
+    """
+
+    def __init__(self, base_url: str, timeout: float = 60):
+        self.base_url = base_url.rstrip("/")
+        self.timeout = timeout
+
+    def _post(self, path: str, payload: Dict[str, Any]) -> Dict[str, Any]:
+        request = urllib.request.Request(
+            self.base_url + path,
+            data=json.dumps(payload).encode("utf-8"),
+            headers={"Content-Type": "application/json"},
+        )
+        with urllib.request.urlopen(request, timeout=self.timeout) as response:
+            return json.loads(response.read().decode("utf-8"))
+
+    def retrieve(self,
+                 question: str,
+                 n_documents: int = 5,
+                 retrievers: Optional[Sequence[str]] = None
+                 ) -> List[Dict[str, Any]]:
+        """Returns the retrieved documents as dictionaries (see
+        `DocumentInfo.to_dict`)."""
+        payload = {"question": question, "n_documents": n_documents,
+                   "retrievers": retrievers}
+        return self._post("/retrieve", payload)["documents"]
+
+    def answer(self,
+               question: str,
+               mode: str = "extractive",
+               n_documents: int = 5,
+               retrievers: Optional[Sequence[str]] = None,
+               **generation_params) -> Dict[str, Any]:
+        """Returns the retrieved `documents` and the `answers` (extractive
+        mode) or the `answer` (generative mode)."""
+        payload = {"question": question, "mode": mode,
+                   "n_documents": n_documents, "retrievers": retrievers,
+                   **generation_params}
+        return self._post("/answer", payload)
@@ -0,0 +1,343 @@
+"""Scatter-gather retrieval over retrievers served by other processes.
+
+A shard server loads one or more retriever directories and answers searches
+of already embedded questions, so it never loads an embedding model.
+`ShardedRetriever` is the coordinator: it embeds the questions once, sends
+them to every shard concurrently, and merges the top documents of the shards
+into the global top documents. It has the interface of `Retriever` that
+`Retriever.retrieve_batch` uses, so shards and local retrievers can be mixed.
+
+Each shard has a timeout. The shards that do not answer in time, or that
+fail, are skipped and the results of the others are returned, unless
+`allow_partial` is False.
+
+Endpoints of the shard server:
+    GET  /health  The embedding model and the retrievers of the shard.
+    POST /search  {"embeddings": [[float]], "n_documents": int,
+                   "model_name": str, "where": dict (optional),
+                   "n_videos": int (optional),
+                   "mmr_lambda": float (optional)}
+
+The shard servers are started with `ask-youtube-playlists shard-serve`.
+"""
+import asyncio
+import concurrent.futures
+import json
+import logging
+import pathlib
+import urllib.request
+from typing import Any, Dict, List, Optional, Sequence, TYPE_CHECKING
+
+import numpy as np
+
+from ask_youtube_playlists import instrumentation
+from ask_youtube_playlists.data_processing import get_embedding_model
+from ask_youtube_playlists.question_answering import DocumentInfo, Retriever
+from ask_youtube_playlists.question_answering.retriever import _map_scoring
+
+if TYPE_CHECKING:
+    from aiohttp import web
+    from langchain.embeddings import base
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_SHARD_TIMEOUT = 2.0
+
+
+def search_retrievers(retrievers: Sequence[Retriever],
+                      question_embeddings: np.ndarray,
+                      n_documents: int,
+                      where: Optional[Dict[str, Any]] = None,
+                      n_videos: Optional[int] = None,
+                      mmr_lambda: Optional[float] = None
+                      ) -> List[List[DocumentInfo]]:
+    """Searches several retrievers that share an embedding model in the
+    scoring threads and merges their top documents.
+
+    Returns:
+        List[List[DocumentInfo]]: For each question, the `n_documents` best
+        documents sorted in descending order by relevance score.
+    """
+    def search(retriever: Retriever) -> List[List[DocumentInfo]]:
+        return retriever.search(question_embeddings, n_documents, where,
+                                n_videos, mmr_lambda)
+
+    results: List[List[DocumentInfo]] = [[] for _ in question_embeddings]
+    for retrieved in _map_scoring(search, retrievers):
+        for document_infos, new_document_infos in zip(results, retrieved):
+            document_infos.extend(new_document_infos)
+    for document_infos in results:
+        document_infos.sort(key=lambda x: x.score, reverse=True)
+        del document_infos[n_documents:]
+    return results
+
+
+def create_shard_app(retrievers: Dict[str, Retriever]) -> "web.Application":
+    """Returns the aiohttp application of a shard server.
+
+    Args:
+        retrievers (Dict[str, Retriever]): The retrievers by name.
+    """
+    from aiohttp import web
+
+    retrievers_by_model: Dict[str, List[Retriever]] = {}
+    for retriever in retrievers.values():
+        retrievers_by_model.setdefault(retriever.embedding_model_name,
+                                       []).append(retriever)
+    routes = web.RouteTableDef()
+
+    @routes.get("/health")
+    async def health(request: web.Request) -> web.Response:
+        return web.json_response({
+            "status": "ok",
+            "retrievers": {name: retriever.embedding_model_name
+                           for name, retriever in retrievers.items()},
+        })
+
+    @routes.post("/search")
+    async def search(request: web.Request) -> web.Response:
+        try:
+            payload = await request.json()
+            model_retrievers = retrievers_by_model.get(payload["model_name"])
+            if model_retrievers is None:
+                raise ValueError(f"No retriever uses the embedding model "
+                                 f"{payload['model_name']}.")
+            question_embeddings = np.array(payload["embeddings"],
+                                           dtype=np.float32)
+            n_videos = payload.get("n_videos")
+            mmr_lambda = payload.get("mmr_lambda")
+            # Scoring is blocking, so it runs outside of the event loop
+            results = await asyncio.get_running_loop().run_in_executor(
+                None, search_retrievers, model_retrievers,
+                question_embeddings, int(payload["n_documents"]),
+                payload.get("where"),
+                None if n_videos is None else int(n_videos),
+                None if mmr_lambda is None else float(mmr_lambda),
+            )
+        except (KeyError, TypeError, ValueError) as error:
+            return web.json_response({"error": str(error)}, status=400)
+        return web.json_response({
+            "results": [[document_info.to_dict()
+                         for document_info in document_infos]
+                        for document_infos in results]
+        })
+
+    async def on_shutdown(app: web.Application) -> None:
+        for retriever in retrievers.values():
+            retriever.close()
+
+    app = web.Application()
+    app.add_routes(routes)
+    app.on_shutdown.append(on_shutdown)
+    return app
+
+
+def run_shard_server(retriever_directories: Sequence[pathlib.Path],
+                     host: str = "127.0.0.1",
+                     port: int = 8090,
+                     memory_map: bool = False) -> None:
+    """Loads the retrievers and serves them as a shard until the process is
+    interrupted.
+
+    Args:
+        retriever_directories (Sequence[pathlib.Path]): The retrievers.
+        host (str): The interface to bind. Defaults to localhost.
+        port (int): The port. Defaults to 8090.
+        memory_map (bool): Whether the retrievers map the index files shared
+            by every process of the host. Defaults to False.
+    """
+    from aiohttp import web
+
+    retrievers = {f"{directory.parent.name}/{directory.name}":
+                  Retriever(directory, memory_map=memory_map)
+                  for directory in retriever_directories}
+    # Search once, so that the first request does not pay for loading the
+    # index and building the first documents
+    for retriever in retrievers.values():
+        matrix = retriever.embedding_matrix
+        if len(matrix):
+            retriever.search(matrix[:1], 1)
+    logger.info("Serving %d retrievers on %s:%d", len(retrievers), host,
+                port)
+    web.run_app(create_shard_app(retrievers), host=host, port=port)
+
+
+class ShardedRetriever:
+    """Coordinator that retrieves documents from several shard servers.
+
+    Args:
+        shard_urls (Sequence[str]): The URLs of the shards, e.g.
+            `http://127.0.0.1:8090`.
+        timeout (float): The maximum number of seconds to wait for each
+            shard. Defaults to 2.
+        allow_partial (bool): Whether to return the results of the shards
+            that answered when others time out or fail. Defaults to True.
+        embedding_model_name (str, optional): The embedding model of the
+            shards. Defaults to the model reported by their `/health`
+            endpoints.
+
+    Raises:
+        ValueError: If the shards use different embedding models.
+    """
+
+    def __init__(self,
+                 shard_urls: Sequence[str],
+                 timeout: float = DEFAULT_SHARD_TIMEOUT,
+                 allow_partial: bool = True,
+                 embedding_model_name: Optional[str] = None):
+        if not shard_urls:
+            raise ValueError("At least one shard is needed.")
+        self.shard_urls = [url.rstrip("/") for url in shard_urls]
+        self.timeout = timeout
+        self.allow_partial = allow_partial
+        # The shards are queried concurrently, and the threads of the shards
+        # that time out keep running until their socket times out as well
+        self._executor = concurrent.futures.ThreadPoolExecutor(
+            2 * len(self.shard_urls), thread_name_prefix="shard"
+        )
+        self._embedding_model: Optional["base.Embeddings"] = None
+        if embedding_model_name is None:
+            embedding_model_name = self._get_embedding_model_name()
+        self.embedding_model_name = embedding_model_name
+
+    def _request(self, url: str, payload: Optional[Dict[str, Any]] = None
+                 ) -> Dict[str, Any]:
+        data = None if payload is None else json.dumps(payload).encode("utf-8")
+        request = urllib.request.Request(
+            url, data=data, headers={"Content-Type": "application/json"}
+        )
+        with urllib.request.urlopen(request, timeout=self.timeout) as response:
+            return json.loads(response.read().decode("utf-8"))
+
+    def _get_embedding_model_name(self) -> str:
+        model_names = set()
+        for url in self.shard_urls:
+            health = self._request(f"{url}/health")
+            model_names.update(health["retrievers"].values())
+        if len(model_names) != 1:
+            raise ValueError(f"The shards must share one embedding model, "
+                             f"but they use {sorted(model_names)}.")
+        return model_names.pop()
+
+    def close(self) -> None:
+        """Stops the threads that query the shards."""
+        self._executor.shutdown(wait=False)
+
+    def __enter__(self) -> "ShardedRetriever":
+        return self
+
+    def __exit__(self, *args) -> None:
+        self.close()
+
+    @property
+    def embedding_model(self) -> "base.Embeddings":
+        """Returns the embedding model, loading it on first use."""
+        if self._embedding_model is None:
+            self._embedding_model = get_embedding_model(
+                self.embedding_model_name
+            )
+        return self._embedding_model
+
+    def embed_questions(self, questions: Sequence[str]) -> np.ndarray:
+        """Embeds the questions with the embedding model of the shards.
+
+        Returns:
+            np.ndarray: A matrix with a row per question.
+        """
+        with instrumentation.span("retriever.embed_questions"):
+            if len(questions) == 1:
+                embeddings = [self.embedding_model.embed_query(questions[0])]
+            else:
+                embeddings = self.embedding_model.embed_documents(
+                    list(questions)
+                )
+        return np.array(embeddings, dtype=np.float32)
+
+    def _search_shard(self, url: str, payload: Dict[str, Any]
+                      ) -> List[List[DocumentInfo]]:
+        with instrumentation.span("sharding.shard_search"):
+            response = self._request(f"{url}/search", payload)
+        return [[DocumentInfo.from_dict(data) for data in document_infos]
+                for document_infos in response["results"]]
+
+    def search(self,
+               question_embeddings: np.ndarray,
+               n_documents: int,
+               where: Optional[Dict[str, Any]] = None,
+               n_videos: Optional[int] = None,
+               mmr_lambda: Optional[float] = None
+               ) -> List[List[DocumentInfo]]:
+        """Returns the most relevant documents of every shard for already
+        embedded questions.
+
+        Args:
+            question_embeddings (np.ndarray): A matrix with a row per question.
+            n_documents (int): The number of documents to retrieve for each
+                question.
+            where (Dict[str, Any], optional): A filter on the metadata of the
+                documents. See `Retriever.search`.
+            n_videos (int, optional): The number of videos searched in each
+                retriever of the shards. See `Retriever.search`.
+            mmr_lambda (float, optional): The weight of the relevance
+                against the diversity of the documents of each shard. See
+                `Retriever.search`.
+
+        Returns:
+            List[List[DocumentInfo]]: The documents retrieved for each
+            question, sorted in descending order by relevance score.
+
+        Raises:
+            RuntimeError: If no shard answers in time, or if a shard does not
+                and `allow_partial` is False.
+        """
+        question_embeddings = np.atleast_2d(question_embeddings)
+        payload = {"embeddings": question_embeddings.astype(float).tolist(),
+                   "n_documents": n_documents,
+                   "model_name": self.embedding_model_name,
+                   "where": where,
+                   "n_videos": n_videos,
+                   "mmr_lambda": mmr_lambda}
+        futures = {self._executor.submit(self._search_shard, url, payload): url
+                   for url in self.shard_urls}
+        done, not_done = concurrent.futures.wait(futures,
+                                                 timeout=self.timeout)
+
+        results: List[List[DocumentInfo]] = [[] for _ in question_embeddings]
+        failed_urls = [futures[future] for future in not_done]
+        for future in done:
+            try:
+                shard_results = future.result()
+            except (OSError, ValueError, KeyError) as error:
+                logger.warning("Shard %s failed: %s", futures[future], error)
+                failed_urls.append(futures[future])
+                continue
+            for document_infos, new_document_infos in zip(results,
+                                                          shard_results):
+                document_infos.extend(new_document_infos)
+        for future in not_done:
+            logger.warning("Shard %s timed out", futures[future])
+        instrumentation.increment("sharding.failed_shards", len(failed_urls))
+
+        if len(failed_urls) == len(self.shard_urls):
+            raise RuntimeError("No shard answered.")
+        if failed_urls and not self.allow_partial:
+            raise RuntimeError(f"Shards {sorted(failed_urls)} did not "
+                               f"answer.")
+        for document_infos in results:
+            document_infos.sort(key=lambda x: x.score, reverse=True)
+            del document_infos[n_documents:]
+        return results
+
+    def retrieve_batch_from_playlist(self,
+                                     questions: Sequence[str],
+                                     n_documents: int,
+                                     where: Optional[Dict[str, Any]] = None,
+                                     n_videos: Optional[int] = None,
+                                     mmr_lambda: Optional[float] = None
+                                     ) -> List[List[DocumentInfo]]:
+        """Retrieves the most relevant documents of every shard for several
+        questions. See `Retriever.retrieve_batch_from_playlist`."""
+        if not questions:
+            return []
+        return self.search(self.embed_questions(questions), n_documents,
+                           where, n_videos, mmr_lambda)
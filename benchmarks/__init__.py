@@ -0,0 +1 @@
+"""Benchmarks of the retrieval and ingest steps."""
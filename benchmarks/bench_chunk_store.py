@@ -0,0 +1,71 @@
+"""Compares the memory and the loading time of the chunks of a retriever as
+a `Document` per chunk and as a columnar `ChunkStore`.
+
+The memory is the size of the Python objects allocated while loading, as
+measured by `tracemalloc`.
+
+Usage (from the root of the repository)::
+
+    python -m benchmarks.bench_chunk_store --videos 200 --chunks 500
+"""
+import argparse
+import pathlib
+import tempfile
+import time
+import tracemalloc
+from typing import Any, Callable, Tuple
+
+from ask_youtube_playlists.data_processing import (
+    get_documents_from_directory,
+    load_chunk_store,
+)
+from benchmarks.synthetic import create_synthetic_retriever
+
+MB = 1024 * 1024
+
+
+def measure(load: Callable[[], Any]) -> Tuple[float, int]:
+    """Returns the seconds taken by `load` and the bytes held by its
+    result."""
+    tracemalloc.start()
+    start = time.perf_counter()
+    result = load()
+    elapsed = time.perf_counter() - start
+    memory, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del result
+    return elapsed, memory
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--videos", type=int, default=200)
+    parser.add_argument("--chunks", type=int, default=500,
+                        help="Chunks per video.")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        directory = pathlib.Path(tmp) / "playlist" / "retriever"
+        create_synthetic_retriever(directory, args.videos, args.chunks,
+                                   dimension=8)
+        # Import langchain outside of the measurements
+        get_documents_from_directory(directory / "chunked_data")
+
+        rows = [
+            ("documents", lambda: get_documents_from_directory(
+                directory / "chunked_data"
+            )),
+            ("chunk store (from JSON)",
+             lambda: load_chunk_store(directory, cache=False)),
+            ("chunk store (build cache)", lambda: load_chunk_store(directory)),
+            ("chunk store (cached)", lambda: load_chunk_store(directory)),
+        ]
+        print(f"{args.videos * args.chunks} chunks")
+        print(f"{'':<28}{'load (s)':>10}{'memory (MB)':>14}")
+        for name, load in rows:
+            elapsed, memory = measure(load)
+            print(f"{name:<28}{elapsed:>10.2f}{memory / MB:>14.1f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,73 @@
+"""Benchmarks scoring questions one by one against scoring them in batch,
+and the latency of a single question with several scoring threads.
+
+Usage (from the root of the repository)::
+
+    python -m benchmarks.bench_retrieval --videos 200 --chunks 500 \
+        --scoring-workers 1 2 4 8
+"""
+import argparse
+import pathlib
+import tempfile
+import time
+
+from ask_youtube_playlists.question_answering import (Retriever,
+                                                      set_scoring_workers)
+from benchmarks.synthetic import create_synthetic_retriever, sample_questions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--videos", type=int, default=100)
+    parser.add_argument("--chunks", type=int, default=500,
+                        help="Chunks per video.")
+    parser.add_argument("--questions", type=int, default=256)
+    parser.add_argument("-k", type=int, default=10)
+    parser.add_argument("--scoring-workers", type=int, nargs="+",
+                        default=[1],
+                        help="Numbers of scoring threads to compare.")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as directory:
+        retriever_directory = pathlib.Path(directory) / "playlist" / "model"
+        topics = create_synthetic_retriever(retriever_directory,
+                                            args.videos,
+                                            args.chunks)
+        retriever = Retriever(retriever_directory)
+        questions = sample_questions(topics, args.questions)
+
+        start = time.perf_counter()
+        retriever.embedding_matrix  # Builds the index
+        print(f"Index of {retriever.total_number_of_documents} chunks built "
+              f"in {time.perf_counter() - start:.2f}s")
+
+        start = time.perf_counter()
+        one_by_one = [retriever.search(question[None], args.k)[0]
+                      for question in questions]
+        loop_seconds = time.perf_counter() - start
+
+        start = time.perf_counter()
+        batched = retriever.search(questions, args.k)
+        batch_seconds = time.perf_counter() - start
+
+        latencies = {}
+        for n_workers in args.scoring_workers:
+            set_scoring_workers(n_workers)
+            start = time.perf_counter()
+            for question in questions[:32]:
+                retriever.search(question[None], args.k)
+            latencies[n_workers] = (time.perf_counter() - start) / 32
+
+    assert all(
+        [info.document for info in a] == [info.document for info in b]
+        for a, b in zip(one_by_one, batched)
+    )
+    print(f"One by one: {args.questions / loop_seconds:10.1f} questions/s")
+    print(f"Batched:    {args.questions / batch_seconds:10.1f} questions/s")
+    for n_workers, latency in latencies.items():
+        print(f"Latency with {n_workers:2d} scoring threads: "
+              f"{latency * 1000:8.2f} ms")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,88 @@
+"""Benchmarks the two-stage search, routed through the video summaries,
+against the exact search.
+
+For each number of routed videos, it reports the questions per second and the
+recall of the top k documents of the exact search.
+
+Usage (from the root of the repository)::
+
+    python -m benchmarks.bench_routing --videos 400 --chunks 250 \\
+        --n-videos 1 5 20 --summary-vectors 4
+"""
+import argparse
+import pathlib
+import tempfile
+import time
+
+import numpy as np
+
+from ask_youtube_playlists.data_processing import (load_embeddings,
+                                                   summarize_video_embeddings)
+from ask_youtube_playlists.question_answering import Retriever
+from benchmarks.synthetic import create_synthetic_retriever, sample_questions
+
+
+def _write_summaries(retriever_directory: pathlib.Path,
+                     n_vectors: int) -> None:
+    embeddings_directory = retriever_directory / "embeddings"
+    summaries_directory = retriever_directory / "summaries"
+    summaries_directory.mkdir()
+    paths = sorted(embeddings_directory.glob("*.npy"))
+    for path, embeddings in zip(paths, load_embeddings(embeddings_directory)):
+        np.save(str(summaries_directory / path.name),
+                summarize_video_embeddings(embeddings, n_vectors))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--videos", type=int, default=200)
+    parser.add_argument("--chunks", type=int, default=250,
+                        help="Chunks per video.")
+    parser.add_argument("--questions", type=int, default=256)
+    parser.add_argument("-k", type=int, default=10)
+    parser.add_argument("--n-videos", type=int, nargs="+",
+                        default=[1, 2, 5, 10, 20],
+                        help="Numbers of routed videos to compare.")
+    parser.add_argument("--summary-vectors", type=int, default=1,
+                        help="Vectors that summarize each video.")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as directory:
+        retriever_directory = pathlib.Path(directory) / "playlist" / "model"
+        topics = create_synthetic_retriever(retriever_directory,
+                                            args.videos,
+                                            args.chunks)
+        _write_summaries(retriever_directory, args.summary_vectors)
+        retriever = Retriever(retriever_directory)
+        questions = sample_questions(topics, args.questions)
+        retriever.embedding_matrix  # Builds the index
+
+        start = time.perf_counter()
+        exact = [retriever.search(question[None], args.k)[0]
+                 for question in questions]
+        exact_seconds = time.perf_counter() - start
+        print(f"{retriever.total_number_of_documents} chunks in "
+              f"{args.videos} videos, {args.summary_vectors} summary "
+              "vector(s) per video")
+        print(f"{'Videos':>8} {'Questions/s':>12} {'Recall':>8}")
+        print(f"{'all':>8} {args.questions / exact_seconds:12.1f} "
+              f"{1:8.3f}")
+
+        for n_videos in args.n_videos:
+            start = time.perf_counter()
+            routed = [retriever.search(question[None], args.k,
+                                       n_videos=n_videos)[0]
+                      for question in questions]
+            seconds = time.perf_counter() - start
+            recall = np.mean([
+                len({id(info.document) for info in a}.intersection(
+                    id(info.document) for info in b
+                )) / args.k
+                for a, b in zip(exact, routed)
+            ])
+            print(f"{n_videos:8d} {args.questions / seconds:12.1f} "
+                  f"{recall:8.3f}")
+
+
+if __name__ == "__main__":
+    main()
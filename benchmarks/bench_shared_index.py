@@ -0,0 +1,105 @@
+"""Measures the memory of several processes that open the same retriever,
+loading the embeddings in each process or mapping the shared index.
+
+Each process searches the retriever, so every page of the embeddings is
+touched, and reports its memory while all of them are alive: the resident
+memory (RSS), which counts the shared pages in full, the proportional memory
+(PSS), which divides them among the processes that map them, and the private
+memory. Linux only.
+
+Usage (from the root of the repository)::
+
+    python -m benchmarks.bench_shared_index --videos 200 --chunks 500 \\
+        --processes 1 2 4
+"""
+import argparse
+import multiprocessing
+import pathlib
+import tempfile
+from typing import Tuple
+
+from ask_youtube_playlists.data_processing import build_index
+from ask_youtube_playlists.question_answering import Retriever
+from benchmarks.synthetic import create_synthetic_retriever, sample_questions
+
+MB = 1024 * 1024
+
+
+def read_memory_usage() -> Tuple[int, int, int]:
+    """Returns the resident, proportional and private memory of the current
+    process in bytes."""
+    values = {}
+    with open("/proc/self/smaps_rollup") as file:
+        for line in file:
+            fields = line.split()
+            if len(fields) == 3 and fields[2] == "kB":
+                values[fields[0].rstrip(":")] = int(fields[1]) * 1024
+    private = values.get("Private_Clean", 0) + values.get("Private_Dirty", 0)
+    return values.get("Rss", 0), values.get("Pss", 0), private
+
+
+def _open_and_measure(retriever_directory, memory_map, questions,
+                      barrier, results):
+    retriever = Retriever(retriever_directory, memory_map=memory_map)
+    retriever.search(questions, 10)
+    barrier.wait()
+    results.put(read_memory_usage())
+    barrier.wait()
+    retriever.close()
+
+
+def _measure(retriever_directory: pathlib.Path,
+             memory_map: bool,
+             n_processes: int,
+             questions) -> Tuple[float, float, float]:
+    """Returns the mean RSS, PSS and private memory of the processes in
+    MB."""
+    context = multiprocessing.get_context("spawn")
+    barrier = context.Barrier(n_processes)
+    results = context.Queue()
+    processes = [
+        context.Process(target=_open_and_measure,
+                        args=(retriever_directory, memory_map, questions,
+                              barrier, results))
+        for _ in range(n_processes)
+    ]
+    for process in processes:
+        process.start()
+    usages = [results.get() for _ in processes]
+    for process in processes:
+        process.join()
+    return tuple(sum(usage[i] for usage in usages) / n_processes / MB
+                 for i in range(3))  # type: ignore
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--videos", type=int, default=100)
+    parser.add_argument("--chunks", type=int, default=500,
+                        help="Chunks per video.")
+    parser.add_argument("--processes", type=int, nargs="+",
+                        default=[1, 2, 4])
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as directory:
+        retriever_directory = pathlib.Path(directory) / "playlist" / "model"
+        topics = create_synthetic_retriever(retriever_directory,
+                                            args.videos,
+                                            args.chunks)
+        index_path = build_index(retriever_directory)
+        questions = sample_questions(topics, 8)
+        print(f"Index of {args.videos * args.chunks} chunks: "
+              f"{index_path.stat().st_size / MB:.1f} MB")
+        print(f"{'Mode':>10} {'Processes':>10} {'RSS':>8} {'PSS':>8} "
+              f"{'Private':>8}  (MB per process)")
+        for memory_map in (False, True):
+            mode = "mmap" if memory_map else "in-memory"
+            for n_processes in args.processes:
+                rss, pss, private = _measure(retriever_directory, memory_map,
+                                             n_processes, questions)
+                print(f"{mode:>10} {n_processes:10d} {rss:8.1f} {pss:8.1f} "
+                      f"{private:8.1f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,71 @@
+"""Creates synthetic retriever directories for the benchmarks.
+
+The embeddings of each video are drawn around a random topic vector, so that
+the chunks of a video are more similar to each other than to the chunks of
+other videos, as happens with real transcripts.
+"""
+import json
+import pathlib
+
+import numpy as np
+import yaml
+
+
+def create_synthetic_retriever(retriever_directory: pathlib.Path,
+                               n_videos: int,
+                               chunks_per_video: int,
+                               dimension: int = 384,
+                               seed: int = 0) -> np.ndarray:
+    """Writes a retriever directory with random documents and embeddings.
+
+    Args:
+        retriever_directory (pathlib.Path): Where to write the retriever. It
+            should be inside a playlist directory.
+        n_videos (int): The number of videos.
+        chunks_per_video (int): The number of chunks of each video.
+        dimension (int): The dimension of the embeddings.
+        seed (int): The seed of the random number generator.
+
+    Returns:
+        np.ndarray: The topic vectors of the videos, which can be used to
+        sample realistic questions.
+    """
+    rng = np.random.default_rng(seed)
+    chunked_data_directory = retriever_directory / "chunked_data"
+    embeddings_directory = retriever_directory / "embeddings"
+    chunked_data_directory.mkdir(parents=True, exist_ok=True)
+    embeddings_directory.mkdir(parents=True, exist_ok=True)
+
+    with open(retriever_directory / "hyperparams.yaml", "w") as file:
+        yaml.dump({"model_name": "msmarco-MiniLM-L-6-v3",
+                   "max_chunk_size": 320,
+                   "min_overlap_size": 64}, file)
+
+    topics = rng.normal(size=(n_videos, dimension)).astype(np.float32)
+    for video in range(n_videos):
+        file_name = f"Video_{video + 1}"
+        chunks = [{"text": f"Video {video + 1}, chunk {index}.",
+                   "start": float(index * 10),
+                   "duration": 10.0,
+                   "url": f"https://www.youtube.com/watch?v=video{video}"
+                          f"&t={index * 10}s",
+                   "title": f"Video {video + 1}",
+                   "thumbnail": "",
+                   "index": index}
+                  for index in range(chunks_per_video)]
+        with open(chunked_data_directory / f"{file_name}.json", "w") as file:
+            json.dump(chunks, file)
+        noise = rng.normal(size=(chunks_per_video, dimension))
+        embeddings = topics[video] + noise.astype(np.float32)
+        np.save(str(embeddings_directory / f"{file_name}.npy"), embeddings)
+    return topics
+
+
+def sample_questions(topics: np.ndarray,
+                     n_questions: int,
+                     seed: int = 1) -> np.ndarray:
+    """Samples question embeddings close to random video topics."""
+    rng = np.random.default_rng(seed)
+    chosen = rng.integers(0, len(topics), size=n_questions)
+    noise = rng.normal(size=(n_questions, topics.shape[1]))
+    return (topics[chosen] + noise).astype(np.float32)
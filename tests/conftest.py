@@ -0,0 +1,88 @@
+"""Fake embedding models shared by the tests.
+
+The tests that run the embeddings pipeline or search a retriever do not load
+a real model: they get one of these fakes from the fixtures below.
+"""
+from typing import Callable, List, Optional
+
+import numpy as np
+import pytest
+from langchain.embeddings.base import Embeddings
+
+from ask_youtube_playlists.data_processing import create_embeddings
+from ask_youtube_playlists.question_answering import Retriever
+
+
+class LengthEmbeddings(Embeddings):
+    """Embeds each text as `[len(text), 1.0]` and records the batches.
+
+    Args:
+        fail_on (str, optional): A batch with a text that starts with
+            `f"{fail_on} "`, e.g. a chunk of that video, raises a
+            RuntimeError.
+    """
+
+    def __init__(self, fail_on: Optional[str] = None):
+        self.fail_on = fail_on
+        self.batches: List[List[str]] = []
+
+    @property
+    def texts(self) -> List[str]:
+        """Returns the texts embedded so far, in order."""
+        return [text for batch in self.batches for text in batch]
+
+    def embed_documents(self, texts):
+        if self.fail_on is not None and \
+                any(text.startswith(f"{self.fail_on} ") for text in texts):
+            raise RuntimeError("Embedding failure")
+        self.batches.append(list(texts))
+        return [[len(text), 1.0] for text in texts]
+
+    def embed_query(self, text):
+        return self.embed_documents([text])[0]
+
+
+class LookupEmbeddings(Embeddings):
+    """Embeds a question `"<video>:<chunk>"` as the embedding of that chunk
+    of a retriever and records the batches."""
+
+    def __init__(self, retriever: Retriever):
+        self.retriever = retriever
+        self.batches: List[List[str]] = []
+
+    def _embed(self, text: str) -> np.ndarray:
+        video, chunk = map(int, text.split(":"))
+        return self.retriever.video_embeddings[video][chunk]
+
+    def embed_query(self, text):
+        self.batches.append([text])
+        return self._embed(text)
+
+    def embed_documents(self, texts):
+        self.batches.append(list(texts))
+        return [self._embed(text) for text in texts]
+
+
+@pytest.fixture
+def make_length_embeddings() -> Callable[..., LengthEmbeddings]:
+    """Returns a factory of `LengthEmbeddings`."""
+    return LengthEmbeddings
+
+
+@pytest.fixture
+def make_lookup_embeddings() -> Callable[[Retriever], LookupEmbeddings]:
+    """Returns a factory of `LookupEmbeddings`."""
+    return LookupEmbeddings
+
+
+@pytest.fixture
+def use_embedding_model(monkeypatch) -> Callable[[Embeddings], Embeddings]:
+    """Returns a function that makes the embeddings pipeline use a model
+    instead of loading one."""
+
+    def use(embedding_model: Embeddings) -> Embeddings:
+        monkeypatch.setattr(create_embeddings, "get_embedding_model",
+                            lambda name: embedding_model)
+        return embedding_model
+
+    return use
@@ -0,0 +1,219 @@
+import multiprocessing
+
+import pytest
+from langchain.schema import Document
+
+from ask_youtube_playlists import caching
+
+
+@pytest.fixture(autouse=True)
+def _restore_cache_backend():
+    backend = caching.get_cache_backend()
+    yield
+    caching.set_cache_backend(backend)
+
+
+def _make_counted_function():
+    calls = []
+
+    @caching.cache_data
+    def square(value, offset=0):
+        calls.append(value)
+        return value * value + offset
+
+    return square, calls
+
+
+def test_memory_cache_reuses_results():
+    caching.set_cache_backend(caching.MemoryCache(maxsize=2))
+    square, calls = _make_counted_function()
+
+    assert square(3) == 9
+    assert square(3) == 9
+    assert square(3, offset=1) == 10
+    assert calls == [3, 3]
+
+
+def test_memory_cache_evicts_least_recently_used():
+    caching.set_cache_backend(caching.MemoryCache(maxsize=2))
+    square, calls = _make_counted_function()
+
+    square(1)
+    square(2)
+    square(1)
+    square(3)  # Evicts 2
+    square(1)
+    square(2)
+    assert calls == [1, 2, 3, 2]
+
+
+def test_no_cache_calls_every_time():
+    caching.set_cache_backend(caching.NoCache())
+    square, calls = _make_counted_function()
+
+    square(2)
+    square(2)
+    assert calls == [2, 2]
+
+
+def test_unpicklable_arguments_are_not_cached():
+    caching.set_cache_backend(caching.MemoryCache())
+    square, calls = _make_counted_function()
+
+    unpicklable = lambda: None  # noqa: E731
+
+    @caching.cache_data
+    def call(func):
+        calls.append(func)
+        return 1
+
+    assert call(unpicklable) == 1
+    assert call(unpicklable) == 1
+    assert len(calls) == 2
+
+
+def _make_counted_answer_function():
+    calls = []
+
+    @caching.cache_data
+    def answer(question, documents, model_name="model", temperature=0.7):
+        calls.append(question)
+        return f"{question} {len(documents)} {temperature}"
+
+    return answer, calls
+
+
+def _documents(*texts):
+    return [Document(page_content=text,
+                     metadata={"url": "https://youtu.be/x", "index": i})
+            for i, text in enumerate(texts)]
+
+
+def test_sqlite_cache_is_keyed_by_bound_arguments_and_context(tmp_path):
+    caching.set_cache_backend(caching.SQLiteCache(tmp_path / "cache.db"))
+    answer, calls = _make_counted_answer_function()
+
+    answer("q", _documents("a", "b"))
+    answer("q", documents=_documents("a", "b"), temperature=0.7)
+    answer("q", _documents("a", "c"))
+    answer("q", _documents("a", "b"), temperature=0.2)
+    assert calls == ["q", "q", "q"]
+
+    backend = caching.get_cache_backend()
+    assert isinstance(backend, caching.SQLiteCache)
+    function_stats, = backend.stats().values()
+    assert function_stats == {"hits": 1, "misses": 3, "hit_rate": 0.25}
+
+
+def test_sqlite_cache_stores_none(tmp_path):
+    caching.set_cache_backend(caching.SQLiteCache(tmp_path / "cache.db"))
+    calls = []
+
+    @caching.cache_data
+    def no_answer(question):
+        calls.append(question)
+        return None
+
+    assert no_answer("q") is None
+    assert no_answer("q") is None
+    assert calls == ["q"]
+
+
+def test_batched_items_are_cached(tmp_path):
+    for backend in (caching.MemoryCache(),
+                    caching.SQLiteCache(tmp_path / "cache.db")):
+        backend.set_many("answer", {("q", "a"): None, ("q", "b"): 1})
+        assert backend.get_many("answer", [("q", "a"), ("q", "c")]) == \
+            {("q", "a"): None}
+    assert caching.NoCache().get_many("answer", [("q", "a")]) == {}
+
+
+def _answer_in_other_process(path):
+    caching.set_cache_backend(caching.SQLiteCache(path))
+    answer, calls = _make_counted_answer_function()
+    answer("q", _documents("a"))
+    return calls
+
+
+def test_sqlite_cache_persists_across_processes(tmp_path):
+    path = tmp_path / "cache.db"
+    caching.set_cache_backend(caching.SQLiteCache(path))
+    answer, calls = _make_counted_answer_function()
+    answer("q", _documents("a"))
+
+    with multiprocessing.get_context("spawn").Pool(1) as pool:
+        assert pool.apply(_answer_in_other_process, (path,)) == []
+
+
+def test_sqlite_cache_expires_entries(tmp_path, monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(caching.time, "time", lambda: now[0])
+    caching.set_cache_backend(caching.SQLiteCache(tmp_path / "cache.db",
+                                                  ttl=60))
+    answer, calls = _make_counted_answer_function()
+
+    answer("q", [])
+    now[0] += 30
+    answer("q", [])
+    now[0] += 61
+    answer("q", [])
+    assert calls == ["q", "q"]
+
+
+def test_sqlite_cache_evicts_least_recently_used(tmp_path, monkeypatch):
+    now = [1000.0]
+
+    def tick():
+        now[0] += 1
+        return now[0]
+
+    monkeypatch.setattr(caching.time, "time", tick)
+    caching.set_cache_backend(caching.SQLiteCache(tmp_path / "cache.db",
+                                                  max_entries=2,
+                                                  touch_interval=0))
+    answer, calls = _make_counted_answer_function()
+
+    answer("1", [])
+    answer("2", [])
+    answer("1", [])
+    answer("3", [])  # Evicts 2
+    answer("1", [])
+    answer("2", [])
+    assert calls == ["1", "2", "3", "2"]
+
+
+def test_sqlite_cache_lookups_do_not_write(tmp_path):
+    backend = caching.SQLiteCache(tmp_path / "cache.db",
+                                  stats_flush_interval=3600)
+    backend.set("answer", "key", 1)
+    connection = backend._connect()
+    n_changes = connection.total_changes
+
+    for _ in range(10):
+        assert backend.get("answer", "key") == 1
+        backend._count("answer", hit=True)
+    backend._count("answer", hit=False)
+    assert connection.total_changes == n_changes
+
+    assert backend.stats() == {"answer": {"hits": 10, "misses": 1,
+                                          "hit_rate": 10 / 11}}
+    assert connection.total_changes == n_changes + 1
+
+
+def test_sqlite_cache_evicts_in_batches(tmp_path):
+    backend = caching.SQLiteCache(tmp_path / "cache.db", max_entries=20)
+
+    def count_entries():
+        return backend._connect().execute(
+            "SELECT COUNT(*) FROM entries").fetchone()[0]
+
+    for i in range(22):
+        backend.set("answer", str(i), i)
+    assert count_entries() == 22
+    backend.set("answer", "22", 22)
+    assert count_entries() == 20
+    assert backend.get("answer", "22") == 22
+
+
+if __name__ == "__main__":
+    pytest.main()
@@ -0,0 +1,86 @@
+import os
+import pathlib
+import shutil
+
+import pytest
+
+from ask_youtube_playlists.data_processing import (
+    ChunkStore,
+    chunk_store,
+    get_documents_from_directory,
+    load_chunk_store,
+)
+
+RETRIEVER_DIRECTORY = pathlib.Path(__file__).parent.joinpath(
+    "data", "azure", "msmarco-MiniLM-L-6-v3_320_64"
+)
+
+
+@pytest.fixture
+def retriever_directory(tmp_path) -> pathlib.Path:
+    directory = tmp_path / "azure" / RETRIEVER_DIRECTORY.name
+    shutil.copytree(RETRIEVER_DIRECTORY, directory)
+    return directory
+
+
+def test_chunk_store_rebuilds_the_documents(retriever_directory):
+    expected = get_documents_from_directory(
+        retriever_directory / "chunked_data"
+    )
+    store = load_chunk_store(retriever_directory)
+
+    assert store.n_videos == len(expected)
+    assert list(store.video_sizes) == [len(video) for video in expected]
+    assert set(store.numeric_fields) == {"start", "duration", "index"}
+    _, titles = store.encoded_fields["title"]
+    assert len(titles) == len(expected)
+    for video, video_documents in enumerate(expected):
+        assert store.video_documents(video) == video_documents
+
+    # The cached columns are read back
+    assert not chunk_store.is_chunk_store_outdated(retriever_directory)
+    cached = load_chunk_store(retriever_directory)
+    assert cached.video_documents(1) == expected[1]
+
+
+def test_chunk_store_is_rebuilt_when_outdated(retriever_directory):
+    load_chunk_store(retriever_directory)
+    store_path = chunk_store.get_chunk_store_path(retriever_directory)
+
+    chunk_path = retriever_directory / "chunked_data" / "Video_2.json"
+    future = store_path.stat().st_mtime + 10
+    os.utime(chunk_path, (future, future))
+    assert chunk_store.is_chunk_store_outdated(retriever_directory)
+    chunk_path.unlink()
+    assert load_chunk_store(retriever_directory).n_videos == 1
+
+
+def test_chunk_store_keeps_missing_and_mixed_fields(tmp_path):
+    store = ChunkStore.from_videos([
+        [{"text": "á", "start": 0, "title": "A", "index": 0},
+         {"text": "b", "start": 1.5, "index": 1}],
+        [{"text": "c", "start": 2, "title": None, "index": 0}],
+    ])
+    store.save(tmp_path / "chunks.npz")
+    store = ChunkStore.load(tmp_path / "chunks.npz")
+
+    assert [store.text(row) for row in range(3)] == ["á", "b", "c"]
+    assert store.metadata(0) == {"start": 0.0, "title": "A", "index": 0}
+    assert store.metadata(1) == {"start": 1.5, "index": 1}
+    assert store.metadata(2) == {"start": 2.0, "title": None, "index": 0}
+    assert list(store.filter_rows({"title": "A"})) == [0]
+    assert list(store.filter_rows({"index": 0})) == [0, 2]
+    assert list(store.filter_rows({"speaker": "A"})) == []
+    with pytest.raises(ValueError):
+        store.filter_rows({"start": {"$gte": 1}})
+    store.check_indexes()
+
+
+def test_chunk_store_checks_indexes():
+    store = ChunkStore.from_videos([[{"text": "a", "index": 1}]])
+    with pytest.raises(ValueError):
+        store.check_indexes()
+
+
+if __name__ == "__main__":
+    pytest.main()
@@ -0,0 +1,76 @@
+import json
+import os
+
+import pytest
+
+from ask_youtube_playlists.cli import (_get_directory_name,
+                                       build_parser,
+                                       is_retriever_outdated,
+                                       read_questions)
+
+
+def test_read_questions_from_text(tmp_path):
+    questions_path = tmp_path / "questions.txt"
+    questions_path.write_text("What is Azure?\n\nHow do I deploy?\n")
+
+    records = read_questions(questions_path)
+    assert records == [{"question": "What is Azure?"},
+                       {"question": "How do I deploy?"}]
+
+
+def test_read_questions_from_jsonl(tmp_path):
+    questions_path = tmp_path / "questions.jsonl"
+    lines = [{"id": 1, "question": "What is Azure?"},
+             {"id": 2, "question": "How do I deploy?"}]
+    questions_path.write_text("\n".join(json.dumps(line) for line in lines))
+
+    assert read_questions(questions_path) == lines
+
+    questions_path.write_text(json.dumps({"id": 3}))
+    with pytest.raises(KeyError):
+        read_questions(questions_path)
+
+
+def test_is_retriever_outdated(tmp_path):
+    raw_directory = tmp_path / "playlist" / "raw"
+    raw_directory.mkdir(parents=True)
+    (raw_directory / "Video_1.json").write_text("{}")
+    retriever_directory = tmp_path / "playlist" / "model_320_64"
+    assert is_retriever_outdated(retriever_directory)
+
+    embeddings_directory = retriever_directory / "embeddings"
+    embeddings_directory.mkdir(parents=True)
+    embedding_path = embeddings_directory / "Video_1.npy"
+    embedding_path.write_bytes(b"")
+    raw_mtime = (raw_directory / "Video_1.json").stat().st_mtime
+    os.utime(embedding_path, (raw_mtime + 10, raw_mtime + 10))
+    assert not is_retriever_outdated(retriever_directory)
+
+    (raw_directory / "Video_2.json").write_text("{}")
+    assert is_retriever_outdated(retriever_directory)
+
+
+def test_parse_ask_arguments():
+    args = build_parser().parse_args([
+        "--workers", "4", "ask", "questions.txt",
+        "--retriever", "playlist_1/model_320_64",
+        "--retriever", "playlist_2/model_320_64",
+        "--mode", "extractive", "-k", "3",
+    ])
+    assert args.workers == 4
+    assert args.retriever == ["playlist_1/model_320_64",
+                              "playlist_2/model_320_64"]
+    assert args.mode == "extractive"
+    assert args.k == 3
+
+
+def test_directory_name_uses_the_capped_chunk_size():
+    args = build_parser().parse_args([
+        "embed", "--model", "msmarco-MiniLM-L-6-v3", "--chunk-size", "1000",
+        "--overlap", "32", "--chunking-mode", "tokens",
+    ])
+    assert _get_directory_name(args) == "msmarco-MiniLM-L-6-v3_510_32_tokens"
+
+
+if __name__ == "__main__":
+    pytest.main()
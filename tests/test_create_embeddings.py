@@ -0,0 +1,115 @@
+import json
+from typing import Iterator, List
+
+import numpy as np
+import pytest
+
+from ask_youtube_playlists.data_processing.create_embeddings import (
+    DocumentDict,
+    _embed_chunks,
+    _get_segment_embeddings,
+    summarize_video_embeddings,
+)
+from ask_youtube_playlists.data_processing.download_transcripts import (
+    _iter_chunk_segments,
+    _iter_segments,
+)
+
+
+def test__embed_chunks_embeds_in_batches(tmp_path, make_length_embeddings):
+    chunks: List[DocumentDict] = [
+        {"text": "a" * i, "start": float(i), "index": i} for i in range(1, 8)
+    ]
+    embedding_model = make_length_embeddings()
+    chunked_data_path = tmp_path / "chunked_data" / "Video_1.json"
+
+    embeddings = _embed_chunks(iter(chunks), embedding_model,
+                               chunked_data_path, batch_size=3)
+
+    assert [len(batch) for batch in embedding_model.batches] == [3, 3, 1]
+    np.testing.assert_array_equal(embeddings[:, 0], np.arange(1, 8))
+    assert chunked_data_path.read_text() == json.dumps(chunks)
+
+
+def test__embed_chunks_embeds_while_the_segments_are_read(
+        tmp_path, make_length_embeddings):
+    n_read = 0
+
+    def read_segments():
+        nonlocal n_read
+        for n_read in range(1, 1001):
+            yield "a" * 20
+
+    segments = _iter_segments(read_segments(), range(1000), [1.0] * 1000)
+    chunks: Iterator[DocumentDict] = (
+        {"text": " ".join(segment.text for segment in chunk_segments),
+         "index": i}
+        for i, (_, _, chunk_segments)
+        in enumerate(_iter_chunk_segments(segments, 55, 15))
+    )
+    n_read_per_batch: List[int] = []
+
+    _embed_chunks(chunks, make_length_embeddings(),
+                  tmp_path / "Video_1.json", batch_size=10,
+                  on_batch=lambda batch, embeddings: n_read_per_batch.append(
+                      n_read))
+
+    assert n_read_per_batch[0] < 20
+    assert len(n_read_per_batch) > 50
+
+
+def test__embed_chunks_without_chunks(tmp_path, make_length_embeddings):
+    chunked_data_path = tmp_path / "Video_1.json"
+    embeddings = _embed_chunks(iter([]), make_length_embeddings(),
+                               chunked_data_path)
+    assert len(embeddings) == 0
+    assert json.loads(chunked_data_path.read_text()) == []
+
+
+def test__get_segment_embeddings_are_cached(tmp_path,
+                                            make_length_embeddings):
+    raw_path = tmp_path / "raw" / "Video_1.json"
+    raw_path.parent.mkdir()
+    raw_path.write_text("{}")
+    cache_path = tmp_path / "segment_embeddings" / "model" / "Video_1.npy"
+    embedding_model = make_length_embeddings()
+    texts = ["a", "bb", "ccc"]
+
+    first = _get_segment_embeddings(texts, embedding_model, cache_path,
+                                    raw_path)
+    second = _get_segment_embeddings(texts, embedding_model, cache_path,
+                                     raw_path)
+
+    assert embedding_model.batches == [texts]
+    np.testing.assert_array_equal(first, second)
+    np.testing.assert_array_equal(first[:, 0], [1, 2, 3])
+
+    # A new transcript invalidates the cache
+    _get_segment_embeddings(texts + ["dddd"], embedding_model, cache_path,
+                            raw_path)
+    assert [len(batch) for batch in embedding_model.batches] == [3, 4]
+
+
+def test_summarize_video_embeddings():
+    rng = np.random.default_rng(0)
+    topics = np.eye(3, 8) * 10
+    embeddings = np.vstack([topic + rng.normal(size=(20, 8))
+                            for topic in topics])
+
+    centroid = summarize_video_embeddings(embeddings)
+    assert centroid.shape == (1, 8)
+    np.testing.assert_allclose(np.linalg.norm(centroid, axis=1), 1,
+                               rtol=1e-5)
+
+    summaries = summarize_video_embeddings(embeddings, n_vectors=3)
+    assert summaries.shape == (3, 8)
+    # Each topic is summarized by one of the vectors
+    assert sorted(np.argmax(summaries @ topics.T, axis=1)) == [0, 1, 2]
+
+    assert summarize_video_embeddings(embeddings[:2], n_vectors=3).shape \
+        == (2, 8)
+    assert summarize_video_embeddings(np.zeros((0, 8))).shape == (0, 8)
+
+
+if __name__ == "__main__":
+    pytest.main()
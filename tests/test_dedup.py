@@ -0,0 +1,160 @@
+import json
+import pathlib
+import shutil
+
+import numpy as np
+import pytest
+
+from ask_youtube_playlists.data_processing import (
+    create_embeddings,
+    load_chunk_store,
+)
+from ask_youtube_playlists.data_processing.dedup import (
+    ChunkDeduplicator,
+    DUPLICATES_FILE_NAME,
+    MinHasher,
+    choose_bands,
+    estimate_similarity,
+    get_shingles,
+)
+
+RAW_DIRECTORY = pathlib.Path(__file__).parent.joinpath("data", "azure", "raw")
+MODEL_NAME = "msmarco-MiniLM-L-6-v3"
+INTRO = ("welcome back to the show where we talk about the cloud every week "
+         "with the people who build it and do not forget to subscribe")
+WORDS = "alpha beta gamma delta epsilon zeta eta theta iota kappa".split()
+
+
+def _text(seed):
+    return " ".join(WORDS[(seed * 7 + i * i) % len(WORDS)] + str(i)
+                    for i in range(30))
+
+
+def test_minhash_estimates_the_jaccard_similarity():
+    first = get_shingles(_text(1))
+    second = get_shingles(_text(1) + " one more sentence at the end")
+    similarity = len(first & second) / len(first | second)
+
+    hasher = MinHasher(n_permutations=256)
+    estimate = estimate_similarity(hasher.signature(first),
+                                   hasher.signature(second))
+    assert estimate == pytest.approx(similarity, abs=0.1)
+    assert get_shingles("Hello, WORLD") == get_shingles("hello world")
+
+
+def test_choose_bands():
+    bands, rows = choose_bands(128, 0.8)
+    assert (bands, rows) == (16, 8)
+    # The pairs at the threshold are candidates with a high probability
+    assert 1 - (1 - 0.8 ** rows) ** bands > 0.9
+    assert choose_bands(128, 0.001) == (128, 1)
+
+
+def test_deduplicator_finds_the_pairs_at_the_threshold():
+    rng = np.random.default_rng(0)
+    n_found = 0
+    n_pairs = 0
+    for seed in range(100):
+        words = [f"word{seed}x{i}" for i in range(200)]
+        variant = list(words)
+        for position in rng.choice(200, size=4, replace=False):
+            variant[position] = f"other{position}"
+        first, second = " ".join(words), " ".join(variant)
+        first_shingles, second_shingles = get_shingles(first), \
+            get_shingles(second)
+        similarity = len(first_shingles & second_shingles) / \
+            len(first_shingles | second_shingles)
+        if similarity < 0.8:
+            continue
+        deduplicator = ChunkDeduplicator(threshold=0.8)
+        deduplicator.add("Video_1", 0, first)
+        n_pairs += 1
+        n_found += deduplicator.find_duplicate(second) is not None
+    assert n_pairs > 50
+    assert n_found / n_pairs > 0.9
+
+
+def test_deduplicator_checks_the_exact_similarity():
+    words = [f"word{i}" for i in range(200)]
+    shingles = get_shingles(" ".join(words))
+    deduplicator = ChunkDeduplicator(threshold=0.8)
+    deduplicator.add("Video_1", 0, " ".join(words))
+    n_below = 0
+    for step in range(5, 20):
+        variant = [word if i % step else "other"
+                   for i, word in enumerate(words)]
+        variant_shingles = get_shingles(" ".join(variant))
+        similarity = len(shingles & variant_shingles) / \
+            len(shingles | variant_shingles)
+        if similarity < 0.8:
+            # A candidate pair below the threshold is not a duplicate
+            n_below += 1
+            assert deduplicator.find_duplicate(" ".join(variant)) is None
+    assert n_below > 5
+
+
+def test_deduplicator_keeps_the_first_occurrence():
+    deduplicator = ChunkDeduplicator(threshold=0.8)
+    first = list(deduplicator.filter("Video_1", [
+        {"text": INTRO, "index": 0, "start": 0.0},
+        {"text": _text(1), "index": 1, "start": 30.0},
+    ]))
+    second = list(deduplicator.filter("Video_2", [
+        {"text": INTRO + " today", "index": 0, "start": 5.0},
+        {"text": _text(2), "index": 1, "start": 40.0},
+    ]))
+    assert [chunk["index"] for chunk in first] == [0, 1]
+    assert second == [{"text": _text(2), "index": 0, "original_index": 1,
+                       "start": 40.0}]
+    assert deduplicator.references == {
+        ("Video_1", 0): [{"start": 5.0, "video": "Video_2"}]
+    }
+    assert deduplicator.find_duplicate(_text(3)) is None
+
+
+@pytest.fixture
+def retriever_directory(tmp_path, monkeypatch, make_length_embeddings,
+                        use_embedding_model) -> pathlib.Path:
+    def fake_chunks(json_file_path, *args):
+        video = json_file_path.stem
+        yield {"text": INTRO, "index": 0, "start": 0.0, "title": video}
+        yield {"text": f"{video} {_text(int(video[-1]))}", "index": 1,
+               "start": 60.0, "title": video}
+
+    shutil.copytree(RAW_DIRECTORY, tmp_path / "azure" / "raw")
+    monkeypatch.setattr(create_embeddings, "iter_chunked_data", fake_chunks)
+    use_embedding_model(make_length_embeddings())
+    return tmp_path / "azure" / "retriever"
+
+
+def test_pipeline_stores_duplicates_once(retriever_directory):
+    create_embeddings.create_embeddings_pipeline(
+        retriever_directory, MODEL_NAME, 320, 64, dedup_threshold=0.8,
+    )
+    with open(retriever_directory / "chunked_data" / "Video_2.json") as file:
+        assert [chunk["start"] for chunk in json.load(file)] == [60.0]
+
+    store = load_chunk_store(retriever_directory)
+    assert len(store) == 3
+    assert store.metadata(0)["duplicates"] == [
+        {"start": 0.0, "title": "Video_2", "video": "Video_2"}
+    ]
+    assert "duplicates" not in store.metadata(1)
+
+    # Resuming keeps the back-references of the skipped videos
+    create_embeddings.create_embeddings_pipeline(
+        retriever_directory, MODEL_NAME, 320, 64, dedup_threshold=0.8,
+        resume=True,
+    )
+    assert load_chunk_store(retriever_directory).references == \
+        store.references
+
+    create_embeddings.create_embeddings_pipeline(
+        retriever_directory, MODEL_NAME, 320, 64,
+    )
+    assert not (retriever_directory / DUPLICATES_FILE_NAME).exists()
+    assert len(load_chunk_store(retriever_directory)) == 4
+
+
+if __name__ == "__main__":
+    pytest.main()
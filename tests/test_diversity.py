@@ -0,0 +1,102 @@
+import numpy as np
+import pytest
+from langchain.schema import Document
+
+from ask_youtube_playlists.question_answering import (
+    DocumentInfo,
+    collapse_adjacent,
+    maximal_marginal_relevance,
+)
+
+
+def _document_info(text, start, index, score, title="Episode 1"):
+    return DocumentInfo(
+        document=Document(page_content=text,
+                          metadata={"start": start, "duration": 10.0,
+                                    "index": index, "title": title}),
+        score=score,
+        playlist_name="playlist",
+    )
+
+
+def test_mmr_skips_near_duplicates():
+    embeddings = np.array([[1.0, 0.0], [0.99, 0.141], [0.6, 0.8]])
+    embeddings /= np.linalg.norm(embeddings, axis=1, keepdims=True)
+    relevance = np.array([0.9, 0.89, 0.7])
+
+    assert list(maximal_marginal_relevance(relevance, embeddings, 2,
+                                           1.0)) == [0, 1]
+    assert list(maximal_marginal_relevance(relevance, embeddings, 2,
+                                           0.5)) == [0, 2]
+    assert len(maximal_marginal_relevance(relevance, embeddings, 5,
+                                          0.5)) == 3
+    with pytest.raises(ValueError):
+        maximal_marginal_relevance(relevance, embeddings, 2, 1.5)
+
+
+def test_collapse_adjacent_merges_overlapping_chunks():
+    document_infos = [
+        _document_info("the second chunk ends here", 8.0, 1, 0.9),
+        _document_info("a first chunk and the second", 0.0, 0, 0.5),
+        _document_info("far away", 100.0, 7, 0.8),
+        _document_info("other video", 8.0, 1, 0.7, title="Episode 2"),
+    ]
+    collapsed = collapse_adjacent(document_infos)
+
+    assert [info.score for info in collapsed] == [0.9, 0.8, 0.7]
+    merged = collapsed[0].document
+    assert merged.page_content == "a first chunk and the second chunk ends " \
+                                  "here"
+    assert merged.metadata["start"] == 0.0
+    assert merged.metadata["duration"] == 18.0
+    assert merged.metadata["n_chunks"] == 2
+    assert collapsed[1].document.page_content == "far away"
+
+
+def test_collapse_adjacent_groups_the_chunks_by_video_url():
+    url = "https://www.youtube.com/watch?v={}&t={}s"
+    document_infos = [
+        _document_info("a first chunk", 0.0, 0, 0.9),
+        _document_info("chunk ends here", 8.0, 1, 0.5),
+        _document_info("same title, other video", 9.0, 1, 0.7),
+    ]
+    for document_info, (video_id, start) in zip(
+            document_infos, [("abc", 0), ("abc", 8), ("xyz", 9)]):
+        document_info.document.metadata["url"] = url.format(video_id, start)
+    collapsed = collapse_adjacent(document_infos)
+
+    assert len(collapsed) == 2
+    assert collapsed[0].document.metadata["n_chunks"] == 2
+    assert collapsed[1].document.page_content == "same title, other video"
+
+
+def test_collapse_adjacent_keeps_the_gap_of_a_removed_duplicate():
+    first = _document_info("before the intro", 0.0, 0, 0.9)
+    second = _document_info("after the intro", 60.0, 1, 0.8)
+    first.document.metadata["original_index"] = 0
+    second.document.metadata["original_index"] = 2
+
+    assert len(collapse_adjacent([first, second])) == 2
+    second.document.metadata["original_index"] = 1
+    assert len(collapse_adjacent([first, second])) == 1
+
+
+def test_collapse_adjacent_joins_the_chunks_of_a_long_span():
+    words = [f"word{i}" for i in range(1990)]
+    # Chunks of 40 words, that share their last 10 words with the next one
+    document_infos = [
+        _document_info(" ".join(words[start:start + 40]), float(start),
+                       index, 1.0)
+        for index, start in enumerate(range(0, 1951, 30))
+    ]
+    collapsed, = collapse_adjacent(document_infos, max_overlap_size=100)
+    assert collapsed.document.page_content == " ".join(words)
+
+    # An overlap longer than the limit is not removed
+    collapsed, = collapse_adjacent(document_infos[:2], max_overlap_size=10)
+    assert collapsed.document.page_content == \
+        " ".join(words[:40] + words[30:70])
+
+
+if __name__ == "__main__":
+    pytest.main()
@@ -1,7 +1,10 @@
 import pathlib
+import types
 import json
 
+import numpy as np
 import pytest
+import pytube
 
 from ask_youtube_playlists.data_processing.download_transcripts import (
     _get_playlist_info,
@@ -9,7 +12,18 @@ from ask_youtube_playlists.data_processing.download_transcripts import (
     download_playlist,
     _replace_newlines,
     create_chunked_data,
+    iter_chunked_data,
     _get_chunk_indices,
+    _iter_chunk_segments,
+    _iter_segments,
+    _get_token_chunk_indices,
+    _get_boundary_chunk_indices,
+    find_sentence_boundaries,
+    find_semantic_boundaries,
+    load_transcript,
+    save_transcript,
+    get_raw_transcript_paths,
+    migrate_raw_directory,
 )
 
 
@@ -64,7 +78,7 @@ def test_create_chunked_data():
         print(str2)
 
     for (i, chunk) in enumerate(chunked_data):
-        assert len(chunk["text"]) <= max_chunk_size
+        assert len(str(chunk["text"])) <= max_chunk_size
         if i > 0:
             assert find_overlap_len(chunked_data[i - 1]["text"],
                                     chunk["text"]) >= min_overlap_size
@@ -91,5 +105,235 @@ def test__get_chunk_indices():
         f"chunk_indices: {chunk_indices}"
 
 
+def _loop_chunk_indices(segment_lengths, max_chunk_size, min_overlap_size):
+    """Advances the window a segment at a time, as the chunking used to."""
+    chunk_indices = []
+    beginning_index = 0
+    ending_index = 0
+    chunk_size = 0
+    for index, segment_length in enumerate(segment_lengths):
+        if chunk_size + segment_length + 1 < max_chunk_size:
+            chunk_size += segment_length + 1
+            ending_index = index
+            continue
+        chunk_indices.append((beginning_index, ending_index))
+        while beginning_index < index:
+            first_length = segment_lengths[beginning_index] + 1
+            if chunk_size - first_length <= min_overlap_size:
+                break
+            chunk_size -= first_length
+            beginning_index += 1
+        if beginning_index == index:
+            # The window is empty, the overlap is the current segment
+            while chunk_size - (segment_length + 1) > min_overlap_size:
+                chunk_size -= segment_length + 1
+                beginning_index += 1
+        chunk_size += segment_length + 1
+        ending_index = index
+    chunk_indices.append((beginning_index, len(segment_lengths) - 1))
+    return chunk_indices
+
+
+def test__get_chunk_indices_matches_loop():
+    rng = np.random.default_rng(0)
+    for _ in range(2000):
+        segment_lengths = rng.integers(0, 40, size=rng.integers(0, 60))
+        max_chunk_size = int(rng.integers(1, 150))
+        min_overlap_size = int(rng.integers(0, 80))
+
+        expected = _loop_chunk_indices(segment_lengths.tolist(),
+                                       max_chunk_size,
+                                       min_overlap_size)
+        assert _get_chunk_indices(segment_lengths,
+                                  max_chunk_size,
+                                  min_overlap_size) == expected
+
+
+def test__iter_chunk_segments_matches__get_chunk_indices():
+    rng = np.random.default_rng(1)
+    for _ in range(500):
+        segment_lengths = rng.integers(0, 40, size=rng.integers(0, 60))
+        max_chunk_size = int(rng.integers(1, 150))
+        min_overlap_size = int(rng.integers(0, 80))
+        segments = _iter_segments(["a" * length
+                                   for length in segment_lengths],
+                                  range(len(segment_lengths)),
+                                  [1.0] * len(segment_lengths))
+
+        chunks = list(_iter_chunk_segments(segments, max_chunk_size,
+                                           min_overlap_size))
+        expected = _get_chunk_indices(segment_lengths, max_chunk_size,
+                                      min_overlap_size)
+        # An empty transcript has no chunk
+        assert [(start, end) for start, end, _ in chunks] == \
+            [(start, end) for start, end in expected if end >= start]
+        for start, end, chunk_segments in chunks:
+            starts = [segment.start for segment in chunk_segments]
+            assert starts == list(range(start, end + 1))
+
+
+def test__iter_chunk_segments_streams_the_segments():
+    n_read = 0
+
+    def read_segments():
+        nonlocal n_read
+        for n_read in range(1, 1001):
+            yield "a" * 20
+
+    # The segments can only be read once
+    segments = _iter_segments(read_segments(), range(1000), [1.0] * 1000)
+    chunks = _iter_chunk_segments(segments, 55, 15)
+    assert next(chunks)[:2] == (0, 1)
+    assert n_read == 3
+    start, end, chunk_segments = next(chunks)
+    assert len(chunk_segments) == end - start + 1 <= 2
+    assert n_read < 10
+    assert len(list(chunks)) > 900
+
+
+def test__get_token_chunk_indices():
+    token_counts = [10, 20, 10, 20, 10, 20, 10, 20, 10]
+    # First chunk: 0 (10), 1 (20), 2 (10) = 40 + 2 = 42 <= 55
+    # Shortest overlap with >= 15 tokens: 1 (20), 2 (10) = 30 + 1 = 31
+    # Second chunk: 1 (20), 2 (10), 3 (20) = 50 + 2 = 52 <= 55
+    chunk_indices = _get_token_chunk_indices(token_counts, 55, 15,
+                                             separator_length=1)
+    assert chunk_indices == [(0, 2), (1, 3), (3, 5), (5, 7), (7, 8)]
+
+    # With a limit of 30 tokens, an overlap of 15 tokens leaves no room for
+    # the next segment, so the overlap is shortened
+    assert _get_token_chunk_indices([10, 10, 10, 20], 30, 15) == \
+        [(0, 2), (2, 3)]
+
+    assert _get_token_chunk_indices([], 55, 15) == []
+    # A segment over the limit is a chunk on its own
+    assert _get_token_chunk_indices([5, 100, 5], 20, 0) == \
+        [(0, 0), (1, 1), (2, 2)]
+
+
+def test__get_token_chunk_indices_properties():
+    rng = np.random.default_rng(0)
+    for _ in range(200):
+        token_counts = rng.integers(1, 40, size=rng.integers(1, 80))
+        max_chunk_tokens = int(rng.integers(40, 200))
+        min_overlap_tokens = int(rng.integers(0, 30))
+        separator_length = int(rng.integers(0, 2))
+
+        chunk_indices = _get_token_chunk_indices(
+            token_counts, max_chunk_tokens, min_overlap_tokens,
+            separator_length
+        )
+
+        assert chunk_indices[0][0] == 0
+        assert chunk_indices[-1][1] == len(token_counts) - 1
+        for start, end in chunk_indices:
+            size = token_counts[start:end + 1].sum() + \
+                separator_length * (end - start)
+            assert size <= max_chunk_tokens
+        for (start, end), (next_start, next_end) in zip(chunk_indices,
+                                                        chunk_indices[1:]):
+            assert start < next_start <= end + 1
+            assert next_end > end
+            # The chunks are packed: the next segment did not fit
+            size = token_counts[start:end + 2].sum() + \
+                separator_length * (end + 1 - start)
+            assert size > max_chunk_tokens
+
+
+def test_find_sentence_boundaries():
+    texts = ["so today we are", "talking about sleep.", "Why does it",
+             "matter?\" I asked", "(a lot!)", "e.g. this"]
+    boundaries = find_sentence_boundaries(texts)
+    assert boundaries.tolist() == [False, True, False, False, True, False]
+
+
+def test_find_semantic_boundaries():
+    rng = np.random.default_rng(0)
+    topics = np.eye(4)[[0, 0, 0, 1, 1, 1, 2, 2, 2, 3]]
+    segment_embeddings = topics + rng.normal(scale=0.05, size=topics.shape)
+    boundaries = find_semantic_boundaries(segment_embeddings, quantile=0.3)
+    assert np.flatnonzero(boundaries).tolist() == [2, 5, 8, 9]
+
+
+def test__get_boundary_chunk_indices():
+    segment_lengths = [10, 20, 10, 20, 10, 20, 10, 20, 10]
+    boundaries = np.array([0, 1, 0, 1, 0, 0, 1, 0, 0], dtype=bool)
+    # Sentences: [0, 1] (31), [2, 3] (31), [4, 6] (42), [7, 8] (31)
+    # Each chunk overlaps the previous one by a whole sentence
+    chunk_indices = _get_boundary_chunk_indices(segment_lengths, boundaries,
+                                                80, 1)
+    assert chunk_indices == [(0, 3), (2, 6), (4, 8)]
+    # Two sentences of 31 and 42 characters do not fit in 70 characters
+    chunk_indices = _get_boundary_chunk_indices(segment_lengths, boundaries,
+                                                70, 1)
+    assert chunk_indices == [(0, 3), (4, 6), (7, 8)]
+
+    # A sentence longer than the chunk size is packed segment by segment
+    chunk_indices = _get_boundary_chunk_indices(segment_lengths,
+                                                np.zeros(9, dtype=bool),
+                                                55, 15)
+    assert chunk_indices == _get_token_chunk_indices(segment_lengths, 55,
+                                                     15, separator_length=1)
+
+
+def test_iter_chunked_data_counts_the_separator_tokens(monkeypatch):
+    # The thumbnail is not downloaded
+    monkeypatch.setattr(pytube, "YouTube",
+                        lambda url: types.SimpleNamespace(thumbnail_url=""))
+    json_path = pathlib.Path("tests/data3/raw/example_download.json")
+
+    # Every character is a token, so the spaces between the segments count
+    def count_characters(texts):
+        return [len(text) for text in texts]
+
+    chunks = list(iter_chunked_data(json_path, 200, 50,
+                                    token_counter=count_characters))
+    assert len(chunks) > 1
+    assert all(len(str(chunk["text"])) <= 200 for chunk in chunks)
+
+
+def test_iter_chunked_data_rejects_boundaries_with_tokens():
+    json_path = pathlib.Path("tests/data3/raw/example_download.json")
+    chunks = iter_chunked_data(json_path, 200, 50,
+                               token_counter=lambda texts: [1] * len(texts),
+                               boundary_detector=find_sentence_boundaries)
+    with pytest.raises(ValueError):
+        next(chunks)
+
+
+def test_compact_transcript_round_trip(tmp_path):
+    json_path = pathlib.Path("tests/data3/raw/example_download.json")
+    transcript_data = {key: value
+                       for key, value in load_transcript(json_path).items()
+                       if key in ("title", "video_id", "transcript")}
+    transcript_data["transcript"][0]["text"] = "caf\u00e9 \u2014 na\u00efve\n"
+
+    npz_path = tmp_path / "Video_1.npz"
+    save_transcript(transcript_data, npz_path)
+
+    assert load_transcript(npz_path) == transcript_data
+    assert npz_path.stat().st_size < json_path.stat().st_size / 3
+
+
+def test_migrate_raw_directory(tmp_path):
+    source = pathlib.Path("tests/data3/raw/example_download.json")
+    for i in (1, 2):
+        (tmp_path / f"Video_{i}.json").write_text(source.read_text())
+
+    new_paths = migrate_raw_directory(tmp_path)
+    assert [path.name for path in new_paths] == ["Video_1.npz", "Video_2.npz"]
+    assert get_raw_transcript_paths(tmp_path) == new_paths
+    assert (tmp_path / "Video_1.npz").stat().st_mtime == \
+        (tmp_path / "Video_1.json").stat().st_mtime
+    with open(source) as file:
+        expected = json.load(file)
+    assert load_transcript(new_paths[0])["transcript"] == \
+        expected["transcript"]
+
+    migrate_raw_directory(tmp_path, remove_json=True)
+    assert sorted(path.name for path in tmp_path.iterdir()) == \
+        ["Video_1.npz", "Video_2.npz"]
+
+
 if __name__ == "__main__":
     pytest.main(['-vv', 'test_download_transcripts.py'])
@@ -0,0 +1,93 @@
+import time
+from typing import List
+
+import pytest
+
+from ask_youtube_playlists import caching
+from ask_youtube_playlists.question_answering import extractive
+
+
+class _FakePipeline:
+    """Answers with the score written in each context and records the
+    batches."""
+
+    def __init__(self, delay: float = 0):
+        self.delay = delay
+        self.batches: List[List[str]] = []
+
+    def __call__(self, qa_inputs, batch_size):
+        self.batches.append([qa_input["context"] for qa_input in qa_inputs])
+        time.sleep(self.delay)
+        results = [{"answer": qa_input["context"],
+                    "score": float(qa_input["context"]),
+                    "start": 0,
+                    "end": len(qa_input["context"])}
+                   for qa_input in qa_inputs]
+        return results[0] if len(results) == 1 else results
+
+
+@pytest.fixture
+def pipeline(monkeypatch):
+    fake_pipeline = _FakePipeline()
+    monkeypatch.setattr(extractive, "_load_extractive_pipeline",
+                        lambda model_name: fake_pipeline)
+    monkeypatch.setattr(caching, "_backend", caching.MemoryCache())
+    return fake_pipeline
+
+
+def test_search_stops_at_a_confident_answer(pipeline):
+    contexts = ["0.1", "0.2", "0.3", "0.9", "0.4", "0.95", "0.1"]
+
+    answers = extractive.search_extractive_answers(
+        "question", contexts, batch_size=2, score_threshold=0.8
+    )
+
+    assert pipeline.batches == [["0.1", "0.2"], ["0.3", "0.9"]]
+    assert [answer["score"] for answer in answers] == [0.9, 0.3, 0.2, 0.1]
+    assert answers[0]["context_index"] == 3
+
+
+def test_search_reads_every_context_without_a_confident_answer(pipeline):
+    contexts = ["0.1", "0.2", "0.3"]
+
+    answers = extractive.search_extractive_answers(
+        "question", contexts, batch_size=2, score_threshold=0.8
+    )
+
+    assert len(pipeline.batches) == 2
+    assert [answer["context_index"] for answer in answers] == [2, 1, 0]
+
+
+def test_search_stops_when_the_budget_runs_out(pipeline):
+    pipeline.delay = 0.05
+    contexts = ["0.1"] * 8
+
+    answers = extractive.search_extractive_answers(
+        "question", contexts, batch_size=2, score_threshold=None,
+        time_budget=0.08
+    )
+
+    assert len(pipeline.batches) == 1
+    assert len(answers) == 2
+
+
+def test_answers_are_cached_per_context(pipeline, tmp_path):
+    caching.set_cache_backend(caching.SQLiteCache(tmp_path / "cache.db"))
+    extractive.search_extractive_answers("question", ["0.1", "0.2"],
+                                         score_threshold=None)
+
+    answers = extractive.get_extractive_answers(
+        [("question", "0.2"), ("question", "0.3"), ("other", "0.2")]
+    )
+
+    assert pipeline.batches == [["0.1", "0.2"], ["0.3", "0.2"]]
+    assert [answer["score"] for answer in answers] == [0.2, 0.3, 0.2]
+
+
+def test_search_without_contexts(pipeline):
+    assert extractive.search_extractive_answers("question", []) == []
+    assert pipeline.batches == []
+
+
+if __name__ == "__main__":
+    pytest.main()
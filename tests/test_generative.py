@@ -0,0 +1,210 @@
+import asyncio
+import time
+import types
+from typing import Any, List, Optional, Tuple
+
+import pytest
+from langchain import llms
+from langchain.llms.base import LLM
+from langchain.schema import Document
+
+from ask_youtube_playlists.question_answering import generative
+
+
+# Counts every byte of a text as a token
+_BYTE_TOKENIZER = generative.Tokenizer(
+    encode=lambda text: list(text.encode()),
+    decode=lambda tokens: bytes(tokens).decode(errors="ignore"),
+)
+
+
+class _StubLLM(LLM):
+    """Answers the map prompts with "partial" and the reduce prompts with
+    "final", followed by `answer_words` words, after `delay` seconds."""
+
+    delay: float = 0.0
+    answer_words: int = 0
+    prompts: List[str] = []
+    batch_sizes: List[int] = []
+    pipeline: Any = None
+
+    @property
+    def _llm_type(self) -> str:
+        return "stub"
+
+    def _answer(self, prompt: str) -> str:
+        self.prompts.append(prompt)
+        answer = "final" if prompt.endswith("Combined answer:") \
+            else "partial"
+        return answer + " filler" * self.answer_words
+
+    def _call(self, prompt, stop=None, run_manager=None, **kwargs) -> str:
+        time.sleep(self.delay)
+        return self._answer(prompt)
+
+    async def _acall(self, prompt, stop=None, run_manager=None,
+                     **kwargs) -> str:
+        await asyncio.sleep(self.delay)
+        return self._answer(prompt)
+
+    def _generate(self, prompts, stop=None, run_manager=None, **kwargs):
+        self.batch_sizes.append(len(prompts))
+        return super()._generate(prompts, stop, run_manager, **kwargs)
+
+
+class _StubPipeline:
+    """Text generation pipeline that answers like its LLM, up to
+    `max_new_tokens` bytes, and records the number of prompts and the batch
+    size of each call."""
+
+    task = "text-generation"
+
+    def __init__(self, llm: _StubLLM, max_new_tokens: Optional[int] = None):
+        self.llm = llm
+        self.max_new_tokens = max_new_tokens
+        self.calls: List[Tuple[int, int]] = []
+        self.tokenizer = types.SimpleNamespace(padding_side="right",
+                                               pad_token_id=None)
+        self.model = types.SimpleNamespace(
+            config=types.SimpleNamespace(eos_token_id=0)
+        )
+
+    def __call__(self, prompts, batch_size=1):
+        self.calls.append((len(prompts), batch_size))
+        answers = [self.llm._answer(prompt)[:self.max_new_tokens]
+                   for prompt in prompts]
+        return [[{"generated_text": prompt + answer}]
+                for prompt, answer in zip(prompts, answers)]
+
+
+def _documents(n_documents: int, size: int) -> List[Document]:
+    return [Document(page_content=f"{i} " + "word " * (size // 5),
+                     metadata={"index": i})
+            for i in range(n_documents)]
+
+
+@pytest.fixture
+def stub_llm(monkeypatch) -> _StubLLM:
+    llm = _StubLLM(prompts=[], batch_sizes=[])
+    llm.pipeline = _StubPipeline(llm)
+    monkeypatch.setattr(generative, "load_model", lambda **kwargs: llm)
+    monkeypatch.setattr(generative, "get_tokenizer",
+                        lambda model_name: _BYTE_TOKENIZER)
+    return llm
+
+
+def test_group_texts_fits_the_budget():
+    groups = generative.group_texts(["a" * 40, "b" * 40, "c" * 400], 100,
+                                    60, _BYTE_TOKENIZER)
+    assert groups == [["a" * 40, "b" * 40], ["c" * 60]]
+    assert generative.group_texts(["a" * 40] * 3, 50, 60, _BYTE_TOKENIZER,
+                                  min_group_size=2) == \
+        [["a" * 40] * 2, ["a" * 40]]
+
+
+def test_map_reduce_answers_openai_models_concurrently(stub_llm):
+    stub_llm.delay = 0.3
+    start = time.perf_counter()
+    answer = generative.get_generative_answer(
+        "What is Azure?", _documents(100, 500), model_name="gpt-3.5-turbo",
+        temperature=0.0, max_length=256, map_reduce=True,
+    )
+    elapsed = time.perf_counter() - start
+
+    assert answer == "final"
+    map_prompts = [prompt for prompt in stub_llm.prompts
+                   if not prompt.endswith("Combined answer:")]
+    assert len(map_prompts) > 10
+    assert all(_BYTE_TOKENIZER.count(prompt) + 256 <= 4096
+               for prompt in stub_llm.prompts)
+    # Every document is in a map prompt
+    assert all(any(f"\n{i} word" in f"\n{prompt}" for prompt in map_prompts)
+               for i in range(100))
+    # A map round and a reduce round, instead of one call per group
+    assert elapsed < 3 * stub_llm.delay
+    assert stub_llm.batch_sizes == []
+
+
+def test_map_reduce_batches_local_models(stub_llm):
+    answer = generative.get_generative_answer(
+        "What is Azure?", _documents(100, 400), model_name="gpt2",
+        temperature=0.0, max_length=256, map_reduce=True,
+    )
+
+    assert answer == "final"
+    # Each round goes through the pipeline at once, not prompt by prompt
+    calls = stub_llm.pipeline.calls
+    assert calls[0] == (100, generative.LOCAL_BATCH_SIZE)
+    assert len(calls) < sum(n_prompts for n_prompts, _ in calls)
+    assert stub_llm.batch_sizes == []
+    assert all(_BYTE_TOKENIZER.count(prompt) + 256 <= 1024
+               for prompt in stub_llm.prompts)
+
+
+def test_map_reduce_needs_room_for_the_documents(stub_llm):
+    with pytest.raises(ValueError):
+        generative.get_generative_answer(
+            "What is Azure?", _documents(3, 400), model_name="gpt2",
+            temperature=0.0, max_length=1000, map_reduce=True,
+        )
+
+
+def test_map_reduce_halves_the_answers_in_a_tiny_context(stub_llm,
+                                                         monkeypatch):
+    question = "What is Azure?"
+    overhead = len(generative.REDUCE_PROMPT_TEMPLATE.format(
+        context="", question=question))
+    max_tokens = 16 + overhead + generative.MIN_CONTEXT_TOKENS
+    monkeypatch.setattr(generative, "GENERATIVE_MODELS", [
+        generative.LLMSpec("tiny", "huggingface-pipeline", max_tokens),
+        generative.LLMSpec("tinier", "huggingface-pipeline", max_tokens - 1),
+    ])
+    stub_llm.answer_words = 20
+    answer = generative.get_generative_answer(
+        question, _documents(10, 400), model_name="tiny",
+        temperature=0.0, max_length=16, map_reduce=True,
+    )
+
+    assert answer.startswith("final")
+    n_prompts = [n_prompts for n_prompts, _ in stub_llm.pipeline.calls]
+    assert n_prompts == [10, 5, 3, 2, 1]
+    with pytest.raises(ValueError):
+        generative.get_generative_answer(
+            question, _documents(10, 400), model_name="tinier",
+            temperature=0.0, max_length=16, map_reduce=True,
+        )
+
+
+def test_map_reduce_budgets_the_new_tokens_of_local_models(monkeypatch):
+    llm = _StubLLM(prompts=[], batch_sizes=[], answer_words=100)
+    from_model_id_kwargs = {}
+
+    def from_model_id(**kwargs):
+        from_model_id_kwargs.update(kwargs)
+        llm.pipeline = _StubPipeline(
+            llm, kwargs["pipeline_kwargs"]["max_new_tokens"]
+        )
+        return llm
+
+    monkeypatch.setattr(llms.HuggingFacePipeline, "from_model_id",
+                        staticmethod(from_model_id))
+    monkeypatch.setattr(generative, "get_tokenizer",
+                        lambda model_name: _BYTE_TOKENIZER)
+    answer = generative.get_generative_answer(
+        "How long are the answers?", _documents(20, 400),
+        model_name="gpt2", temperature=0.0, max_length=128,
+        map_reduce=True,
+    )
+
+    # The pipeline generates `max_length` tokens after each prompt, which
+    # the budget leaves room for in the context of the model
+    assert "max_length" not in from_model_id_kwargs["model_kwargs"]
+    assert len(answer) == 128
+    assert llm.pipeline.tokenizer.padding_side == "left"
+    assert llm.prompts
+    assert all(_BYTE_TOKENIZER.count(prompt) + 128 <= 1024
+               for prompt in llm.prompts)
+
+
+if __name__ == "__main__":
+    pytest.main()
@@ -0,0 +1,53 @@
+import json
+import subprocess
+import sys
+
+import pytest
+
+HEAVY_MODULES = ["torch", "transformers", "langchain", "streamlit",
+                 "sentence_transformers", "pytube", "youtube_transcript_api"]
+
+# Generous budget: a cold import of the library without the heavy
+# dependencies takes a fraction of a second, while importing langchain or
+# streamlit alone takes several.
+IMPORT_TIME_BUDGET = 2.0
+
+_IMPORT_SCRIPT = """
+import json
+import sys
+import time
+
+start = time.perf_counter()
+import ask_youtube_playlists.data_processing
+import ask_youtube_playlists.question_answering
+elapsed = time.perf_counter() - start
+heavy_modules = {heavy_modules!r}
+print(json.dumps({{
+    "elapsed": elapsed,
+    "loaded": [name for name in heavy_modules if name in sys.modules],
+}}))
+"""
+
+
+def _cold_import() -> dict:
+    script = _IMPORT_SCRIPT.format(heavy_modules=HEAVY_MODULES)
+    output = subprocess.run([sys.executable, "-c", script],
+                            capture_output=True,
+                            text=True,
+                            check=True)
+    return json.loads(output.stdout.strip().splitlines()[-1])
+
+
+def test_import_does_not_load_heavy_dependencies():
+    result = _cold_import()
+    assert result["loaded"] == []
+
+
+def test_cold_import_time():
+    result = _cold_import()
+    assert result["elapsed"] < IMPORT_TIME_BUDGET, \
+        f"Importing the package took {result['elapsed']:.2f}s"
+
+
+if __name__ == "__main__":
+    pytest.main()
@@ -0,0 +1,86 @@
+import pytest
+
+from ask_youtube_playlists import instrumentation
+
+
+@pytest.fixture(autouse=True)
+def _clean_instrumentation():
+    was_enabled = instrumentation.is_enabled()
+    instrumentation.reset()
+    yield
+    instrumentation.reset()
+    if was_enabled:
+        instrumentation.enable()
+    else:
+        instrumentation.disable()
+
+
+def test_disabled_instrumentation_records_nothing():
+    instrumentation.disable()
+
+    @instrumentation.timed("test.function")
+    def add(a, b):
+        return a + b
+
+    with instrumentation.span("test.span"):
+        assert add(1, 2) == 3
+    instrumentation.increment("test.counter")
+
+    assert instrumentation.get_timings() == {}
+    assert instrumentation.get_counters() == {}
+
+
+def test_enabled_instrumentation_aggregates_spans_and_counters():
+    instrumentation.enable()
+
+    @instrumentation.timed("test.function")
+    def identity(value):
+        return value
+
+    for i in range(3):
+        assert identity(i) == i
+    with instrumentation.span("test.span"):
+        pass
+    instrumentation.increment("test.counter", 2)
+    instrumentation.increment("test.counter")
+
+    timings = instrumentation.get_timings()
+    assert timings["test.function"].count == 3
+    assert timings["test.span"].count == 1
+    assert timings["test.function"].max <= timings["test.function"].total
+    assert instrumentation.get_counters() == {"test.counter": 3}
+
+
+def test_span_recorder_works_while_disabled():
+    instrumentation.disable()
+
+    with instrumentation.SpanRecorder() as recorder:
+        with instrumentation.span("outer"):
+            with instrumentation.span("inner"):
+                pass
+
+    breakdown = recorder.breakdown()
+    assert [row["name"] for row in breakdown] == ["outer", "inner"]
+    assert breakdown[0]["start_ms"] == 0
+    assert instrumentation.get_timings() == {}
+
+    with instrumentation.span("after"):
+        pass
+    assert len(recorder.spans) == 2
+
+
+def test_to_prometheus_text():
+    instrumentation.enable()
+    with instrumentation.span("retriever.score"):
+        pass
+    instrumentation.increment("ingest.chunks", 5)
+
+    text = instrumentation.to_prometheus_text()
+    assert ('ask_youtube_playlists_span_seconds_count{name="retriever.score"}'
+            ' 1') in text
+    assert 'ask_youtube_playlists_events_total{name="ingest.chunks"} 5' in text
+    assert text.endswith("\n")
+
+
+if __name__ == "__main__":
+    pytest.main()
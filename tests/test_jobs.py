@@ -0,0 +1,201 @@
+import json
+import os
+import pathlib
+import shutil
+import threading
+
+import pytest
+
+from ask_youtube_playlists import jobs
+from ask_youtube_playlists.data_processing import create_embeddings
+from ask_youtube_playlists.reporting import Reporter
+
+RAW_DIRECTORY = pathlib.Path(__file__).parent.joinpath("data", "azure", "raw")
+MODEL_NAME = "msmarco-MiniLM-L-6-v3"
+
+
+def _fake_chunks(json_file_path, *args):
+    for index in range(3):
+        yield {"text": f"{json_file_path.stem} {index}", "index": index}
+
+
+class _RecordingReporter(Reporter):
+    def __init__(self):
+        self.checkpoints = []
+
+    def checkpoint(self, item, done, total, size, skipped=False):
+        self.checkpoints.append((item, done, total, size, skipped))
+
+
+@pytest.fixture
+def retriever_directory(tmp_path, monkeypatch) -> pathlib.Path:
+    shutil.copytree(RAW_DIRECTORY, tmp_path / "azure" / "raw")
+    monkeypatch.setattr(create_embeddings, "iter_chunked_data", _fake_chunks)
+    return tmp_path / "azure" / "retriever"
+
+
+def _run_pipeline(retriever_directory, use_embedding_model, embedding_model,
+                  resume=True):
+    use_embedding_model(embedding_model)
+    reporter = _RecordingReporter()
+    create_embeddings.create_embeddings_pipeline(
+        retriever_directory, MODEL_NAME, 320, 64, reporter=reporter,
+        resume=resume,
+    )
+    return reporter.checkpoints
+
+
+def test_pipeline_resumes_from_the_last_completed_video(
+        retriever_directory, make_length_embeddings, use_embedding_model):
+    with pytest.raises(RuntimeError):
+        _run_pipeline(retriever_directory, use_embedding_model,
+                      make_length_embeddings(fail_on="Video_2"))
+
+    embeddings = make_length_embeddings()
+    checkpoints = _run_pipeline(retriever_directory, use_embedding_model,
+                                embeddings)
+    assert checkpoints == [("Video_1", 1, 2, 3, True),
+                           ("Video_2", 2, 2, 3, False)]
+    assert embeddings.texts == ["Video_2 0", "Video_2 1", "Video_2 2"]
+
+    # A video whose transcript changed is embedded again
+    raw_path = retriever_directory.parent / "raw" / "Video_1.json"
+    mtime = raw_path.stat().st_mtime + 10
+    os.utime(raw_path, (mtime, mtime))
+    embeddings = make_length_embeddings()
+    _run_pipeline(retriever_directory, use_embedding_model, embeddings)
+    assert embeddings.texts == ["Video_1 0", "Video_1 1", "Video_1 2"]
+
+    # Without resume, every video is embedded
+    embeddings = make_length_embeddings()
+    _run_pipeline(retriever_directory, use_embedding_model, embeddings,
+                  resume=False)
+    assert len(embeddings.texts) == 6
+
+
+class _FakeVectorStore:
+    """Records the persisted videos."""
+
+    def __init__(self, directory):
+        self.videos = []
+        self.persisted = []
+
+    def delete_video(self, video):
+        pass
+
+    def add(self, video, chunks, embeddings):
+        self.videos.append(video)
+
+    def persist(self):
+        self.persisted.append(list(self.videos))
+
+
+def test_pipeline_records_the_videos_once_persisted(
+        retriever_directory, monkeypatch, make_length_embeddings,
+        use_embedding_model):
+    vector_stores = []
+
+    def make_vector_store(directory):
+        vector_stores.append(_FakeVectorStore(directory))
+        return vector_stores[-1]
+
+    monkeypatch.setattr(create_embeddings, "ChromaVectorStore",
+                        make_vector_store)
+    use_embedding_model(make_length_embeddings(fail_on="Video_2"))
+    with pytest.raises(RuntimeError):
+        create_embeddings.create_embeddings_pipeline(
+            retriever_directory, MODEL_NAME, 320, 64, reporter=Reporter(),
+            vector_store_type="chroma-db", resume=True,
+        )
+    # Video_1 was not persisted, so it is embedded again
+    assert vector_stores[0].persisted == []
+
+    embeddings = use_embedding_model(make_length_embeddings())
+    create_embeddings.create_embeddings_pipeline(
+        retriever_directory, MODEL_NAME, 320, 64, reporter=Reporter(),
+        vector_store_type="chroma-db", resume=True,
+    )
+    assert vector_stores[1].persisted == [["Video_1", "Video_2"]]
+    assert len(embeddings.texts) == 6
+    manifest = json.loads((retriever_directory / "manifest.json").read_text())
+    assert sorted(manifest["videos"]) == ["Video_1", "Video_2"]
+
+
+def test_embedding_job_reports_its_progress(retriever_directory, tmp_path,
+                                            make_length_embeddings,
+                                            use_embedding_model):
+    use_embedding_model(make_length_embeddings())
+    job = jobs.start_embedding_job(retriever_directory, MODEL_NAME, 320, 64,
+                                   slots_directory=tmp_path / "slots")
+    job.join(30)
+
+    status = jobs.read_job_status(retriever_directory)
+    assert status is not None
+    assert status["status"] == "completed"
+    assert status["videos_done"] == status["videos_total"] == 2
+    assert status["chunks_done"] == 6
+    assert status["chunks_per_second"] > 0
+
+
+def _read_status(retriever_directory):
+    status = jobs.read_job_status(retriever_directory)
+    return None if status is None else status["status"]
+
+
+def test_started_job_is_queued_at_once(tmp_path, monkeypatch):
+    monkeypatch.setattr(jobs, "create_embeddings_pipeline",
+                        lambda *args, **kwargs: None)
+    slot = jobs._try_lock(tmp_path / "slots" / "slot_0.lock")
+    job = jobs.EmbeddingJob(tmp_path / "retriever", MODEL_NAME, 320, 64,
+                            slots_directory=tmp_path / "slots",
+                            poll_interval=0.01)
+    try:
+        job.start()
+        assert _read_status(job.retriever_directory) == "queued"
+    finally:
+        assert slot is not None
+        slot.close()
+        job.join(30)
+    assert _read_status(job.retriever_directory) == "completed"
+
+
+def test_embedding_jobs_wait_for_a_slot(tmp_path, monkeypatch):
+    release = threading.Event()
+    started = []
+
+    def pipeline(retriever_directory, *args, **kwargs):
+        started.append(retriever_directory.name)
+        release.wait(30)
+
+    monkeypatch.setattr(jobs, "create_embeddings_pipeline", pipeline)
+    first, second = (
+        jobs.EmbeddingJob(tmp_path / "playlist" / name, MODEL_NAME, 320, 64,
+                          max_concurrent_jobs=1,
+                          slots_directory=tmp_path / "slots",
+                          poll_interval=0.01).start()
+        for name in ("first", "second")
+    )
+    try:
+        while not started:
+            first.join(0.01)
+        second.join(0.2)
+        statuses = [_read_status(job.retriever_directory)
+                    for job in (first, second)]
+        assert len(started) == 1
+        assert sorted(statuses) == ["queued", "running"]
+    finally:
+        release.set()
+        first.join(30)
+        second.join(30)
+    assert sorted(started) == ["first", "second"]
+
+
+def test_job_of_a_dead_process_is_interrupted(tmp_path):
+    with open(tmp_path / jobs.JOB_STATUS_FILE_NAME, "w") as file:
+        json.dump({"status": "running", "videos_done": 3}, file)
+    assert _read_status(tmp_path) == "interrupted"
+    assert jobs.read_job_status(tmp_path / "other") is None
+
+
+if __name__ == "__main__":
+    pytest.main()
@@ -0,0 +1,172 @@
+import http.server
+import json
+import threading
+import time
+import urllib.error
+from typing import List
+
+import pytest
+
+from ask_youtube_playlists.data_processing import openai_embeddings
+from ask_youtube_playlists.data_processing.openai_embeddings import (
+    OpenAIEmbeddingClient,
+    TokenBucket,
+    pack_requests,
+)
+
+
+class _FakeEmbeddingsServer(http.server.ThreadingHTTPServer):
+    """Embeds each text as `[len(text), position]`, rejects the first
+    `n_rejections` requests with 429 and records the requests."""
+
+    def __init__(self, n_rejections: int = 0, delay: float = 0.05):
+        super().__init__(("127.0.0.1", 0), _FakeEmbeddingsHandler)
+        self.n_rejections = n_rejections
+        self.delay = delay
+        self.inputs: List[List[str]] = []
+        self.in_flight = 0
+        self.max_in_flight = 0
+        self.lock = threading.Lock()
+
+    @property
+    def url(self) -> str:
+        return f"http://127.0.0.1:{self.server_address[1]}/v1"
+
+
+class _FakeEmbeddingsHandler(http.server.BaseHTTPRequestHandler):
+    server: _FakeEmbeddingsServer
+
+    def log_message(self, *args):
+        pass
+
+    def do_POST(self):
+        length = int(self.headers["Content-Length"])
+        payload = json.loads(self.rfile.read(length))
+        server = self.server
+        with server.lock:
+            if server.n_rejections > 0:
+                server.n_rejections -= 1
+                self.send_response(429)
+                self.send_header("Retry-After", "0.01")
+                self.end_headers()
+                return
+            server.inputs.append(payload["input"])
+            server.in_flight += 1
+            server.max_in_flight = max(server.max_in_flight,
+                                       server.in_flight)
+        time.sleep(server.delay)
+        data = [{"index": i, "embedding": [len(text), i]}
+                for i, text in enumerate(payload["input"])]
+        # The API does not guarantee the order of the embeddings
+        body = json.dumps({"data": data[::-1]}).encode("utf-8")
+        with server.lock:
+            server.in_flight -= 1
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+@pytest.fixture
+def server():
+    fake_server = _FakeEmbeddingsServer()
+    thread = threading.Thread(target=fake_server.serve_forever, daemon=True)
+    thread.start()
+    yield fake_server
+    fake_server.shutdown()
+    fake_server.server_close()
+
+
+def _count_words(texts):
+    return [len(text.split()) for text in texts]
+
+
+def test_pack_requests():
+    assert pack_requests([3, 3, 3, 5, 9, 1], 6) == \
+        [(0, 2), (2, 3), (3, 4), (4, 5), (5, 6)]
+    assert pack_requests([1] * 5, 100, max_inputs_per_request=2) == \
+        [(0, 2), (2, 4), (4, 5)]
+    assert pack_requests([], 10) == []
+
+
+def test_token_bucket_waits_for_tokens():
+    bucket = TokenBucket(rate=100, capacity=5)
+    assert bucket.acquire(5) == 0
+    start = time.monotonic()
+    bucket.acquire(5)
+    assert time.monotonic() - start == pytest.approx(0.05, abs=0.04)
+
+
+def test_client_sends_concurrent_packed_requests(server):
+    client = OpenAIEmbeddingClient(api_base=server.url, api_key="key",
+                                   token_counter=_count_words,
+                                   max_tokens_per_request=4,
+                                   max_concurrent_requests=4)
+    texts = [" ".join(["word"] * (i % 3 + 1)) for i in range(12)]
+
+    embeddings = client.embed_documents(texts)
+
+    assert [embedding[0] for embedding in embeddings] == \
+        [len(text) for text in texts]
+    assert all(sum(_count_words(inputs)) <= 4 for inputs in server.inputs)
+    assert sum(len(inputs) for inputs in server.inputs) == len(texts)
+    assert server.max_in_flight > 1
+    assert client.embed_query("word")[0] == 4
+
+
+def test_client_retries_rate_limited_requests(server):
+    server.n_rejections = 2
+    client = OpenAIEmbeddingClient(api_base=server.url, api_key="key",
+                                   max_concurrent_requests=1)
+
+    assert client.embed_documents(["a", "bb"]) == [[1, 0], [2, 1]]
+    assert server.n_rejections == 0
+
+
+def test_client_retries_failed_connections(server, monkeypatch):
+    client = OpenAIEmbeddingClient(api_base=server.url, api_key="key",
+                                   initial_backoff=0.01)
+    post = client._post
+    errors = [urllib.error.URLError("refused"),
+              ConnectionResetError("reset")]
+
+    def flaky_post(texts):
+        if errors:
+            raise errors.pop(0)
+        return post(texts)
+
+    monkeypatch.setattr(client, "_post", flaky_post)
+    assert client.embed_documents(["a"]) == [[1, 0]]
+    assert errors == []
+
+
+def test_client_gives_up_after_max_retries(server):
+    server.n_rejections = 3
+    client = OpenAIEmbeddingClient(api_base=server.url, api_key="key",
+                                   max_retries=2)
+
+    with pytest.raises(openai_embeddings.urllib.error.HTTPError):
+        client.embed_documents(["a"])
+
+
+def test_client_respects_requests_per_minute(server):
+    server.delay = 0
+    client = OpenAIEmbeddingClient(api_base=server.url, api_key="key",
+                                   token_counter=_count_words,
+                                   max_tokens_per_request=1,
+                                   requests_per_minute=600)
+
+    start = time.monotonic()
+    client.embed_documents(["a"] * 4)
+
+    # The bucket holds 60 requests, refilled at 10 per second
+    assert time.monotonic() - start < 0.5
+    client._request_bucket = TokenBucket(rate=10, capacity=1)
+    start = time.monotonic()
+    client.embed_documents(["a"] * 4)
+    assert time.monotonic() - start >= 0.25
+
+
+if __name__ == "__main__":
+    pytest.main()
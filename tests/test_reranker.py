@@ -0,0 +1,78 @@
+import time
+from typing import List, Tuple
+
+import pytest
+from langchain.schema import Document
+
+from ask_youtube_playlists.question_answering import DocumentInfo, rerank
+
+
+def _candidates(n: int) -> list:
+    """Returns candidates sorted by the retriever, whose text is the
+    relevance the fake cross-encoder gives them."""
+    return [DocumentInfo(document=Document(page_content=str(i % 7)),
+                         score=1 - i / n,
+                         playlist_name="playlist")
+            for i in range(n)]
+
+
+class _FakeScorer:
+    def __init__(self, delay: float = 0):
+        self.delay = delay
+        self.batches: List[List[Tuple[str, str]]] = []
+
+    def __call__(self, pairs):
+        self.batches.append(pairs)
+        time.sleep(self.delay)
+        return [float(text) for _, text in pairs]
+
+
+def test_rerank_sorts_by_cross_encoder_score():
+    candidates = _candidates(20)
+    scorer = _FakeScorer()
+
+    results = rerank("question", candidates, 5, batch_size=8,
+                     scorer=scorer)
+
+    assert [len(batch) for batch in scorer.batches] == [8, 8, 4]
+    assert [result.score for result in results] == [6, 6, 5, 5, 5]
+    assert results[0].document.page_content == "6"
+    assert results[0].document.metadata == {
+        "score_source": "cross-encoder",
+        "retriever_score": candidates[6].score,
+    }
+    assert all(result.playlist_name == "playlist" for result in results)
+
+
+def test_rerank_falls_back_to_retriever_order_without_budget():
+    candidates = _candidates(10)
+    scorer = _FakeScorer()
+
+    results = rerank("question", candidates, 3, scorer=scorer,
+                     latency_budget=0)
+
+    assert scorer.batches == []
+    assert [result.score for result in results] == \
+        [candidate.score for candidate in candidates[:3]]
+    assert all(result.document.metadata["score_source"] == "retriever"
+               for result in results)
+
+
+def test_rerank_stops_when_the_budget_runs_out():
+    candidates = _candidates(12)
+    scorer = _FakeScorer(delay=0.05)
+
+    results = rerank("question", candidates, 12, batch_size=4,
+                     scorer=scorer, latency_budget=0.08)
+
+    # The second batch would not fit in the budget after the first one
+    assert len(scorer.batches) == 1
+    assert [result.score for result in results[:4]] == [3, 2, 1, 0]
+    assert [result.document.metadata["score_source"]
+            for result in results] == ["cross-encoder"] * 4 + ["retriever"] * 8
+    assert [result.score for result in results[4:]] == \
+        [candidate.score for candidate in candidates[4:]]
+
+
+if __name__ == "__main__":
+    pytest.main()
@@ -0,0 +1,349 @@
+import json
+import pathlib
+import shutil
+import threading
+from typing import Dict, List, Tuple
+
+import numpy as np
+import pytest
+import yaml
+
+from ask_youtube_playlists.data_processing import ChromaVectorStore
+from ask_youtube_playlists.question_answering import Retriever
+from ask_youtube_playlists.question_answering import (
+    retriever as retriever_module
+)
+
+RETRIEVER_DIRECTORY = pathlib.Path(__file__).parent.joinpath(
+    "data", "azure", "msmarco-MiniLM-L-6-v3_320_64"
+)
+
+
+@pytest.fixture(scope="module")
+def retriever() -> Retriever:
+    return Retriever(RETRIEVER_DIRECTORY)
+
+
+def _brute_force_top_k(retriever: Retriever,
+                       question_embedding: np.ndarray,
+                       k: int) -> list:
+    """Scores every document with a Python loop, like the original
+    implementation."""
+    scores = []
+    for video_documents, video_embeddings in zip(retriever.documents,
+                                                 retriever.video_embeddings):
+        for document, embedding in zip(video_documents, video_embeddings):
+            score = Retriever.cosine_distance(question_embedding, embedding)
+            scores.append((score, document.page_content))
+    scores.sort(key=lambda x: x[0], reverse=True)
+    return scores[:k]
+
+
+def test_retriever_loads_documents_and_embeddings(retriever):
+    assert retriever.embedding_model_name == "msmarco-MiniLM-L-6-v3"
+    assert retriever.total_number_of_documents == \
+        len(retriever.embedding_matrix)
+    norms = np.linalg.norm(retriever.embedding_matrix, axis=1)
+    np.testing.assert_allclose(norms, 1, rtol=1e-5)
+
+
+def test_search_returns_the_document_itself_first(retriever):
+    question_embeddings = retriever.video_embeddings[1][[0, 5]]
+    results = retriever.search(question_embeddings, n_documents=3)
+
+    assert len(results) == 2
+    assert results[0][0].document.metadata["index"] == 0
+    assert results[1][0].document.metadata["index"] == 5
+    assert results[0][0].score == pytest.approx(1, abs=1e-5)
+    assert results[0][0].playlist_name == "azure"
+    for document_infos in results:
+        scores = [document_info.score for document_info in document_infos]
+        assert scores == sorted(scores, reverse=True)
+
+
+def test_blocked_search_matches_brute_force(retriever, monkeypatch):
+    monkeypatch.setattr(retriever_module, "QUESTION_BLOCK_SIZE", 3)
+    monkeypatch.setattr(retriever_module, "DOCUMENT_BLOCK_SIZE", 7)
+    rng = np.random.default_rng(0)
+    question_embeddings = rng.normal(
+        size=(10, retriever.embedding_matrix.shape[1])
+    )
+    k = 9
+
+    results = retriever.search(question_embeddings, n_documents=k)
+
+    for question_embedding, document_infos in zip(question_embeddings,
+                                                  results):
+        expected = _brute_force_top_k(retriever, question_embedding, k)
+        assert [info.document.page_content for info in document_infos] == \
+            [text for _, text in expected]
+        np.testing.assert_allclose([info.score for info in document_infos],
+                                   [score for score, _ in expected],
+                                   rtol=1e-4)
+
+
+def test_search_returns_at_most_all_documents(retriever):
+    question_embedding = retriever.video_embeddings[0][:1]
+    results = retriever.search(question_embedding, n_documents=10_000)
+    assert len(results[0]) == retriever.total_number_of_documents
+
+
+def test_search_filters_by_metadata(retriever):
+    title = retriever.documents[1][0].metadata["title"]
+    question_embedding = retriever.video_embeddings[0][:1]
+
+    results = retriever.search(question_embedding, n_documents=10_000,
+                               where={"title": title})
+
+    assert len(results[0]) == len(retriever.documents[1])
+    assert all(document_info.document.metadata["title"] == title
+               for document_info in results[0])
+    with pytest.raises(ValueError):
+        retriever.search(question_embedding, n_documents=3,
+                         where={"start": {"$gte": 60}})
+
+
+def _mixed_question(retriever: Retriever) -> np.ndarray:
+    """Returns a question between a chunk of each video."""
+    return retriever.video_embeddings[1][[3]] + \
+        retriever.video_embeddings[0][[10]]
+
+
+def test_mmr_search_returns_distinct_time_spans(retriever):
+    question_embeddings = _mixed_question(retriever)
+    plain = retriever.search(question_embeddings, n_documents=4)[0]
+    diverse = retriever.search(question_embeddings, n_documents=4,
+                               mmr_lambda=0.5)[0]
+
+    # Without diversity, the neighbours of the chunk overlap with it
+    spans = [(metadata["title"], metadata["start"],
+              metadata["start"] + metadata["duration"])
+             for metadata in (info.document.metadata for info in plain)]
+    best_title, best_start, best_end = spans[0]
+    assert any(title == best_title and start < best_end and best_start < end
+               for title, start, end in spans[1:])
+
+    assert 1 <= len(diverse) <= 4
+    assert diverse[0].score == plain[0].score
+    assert sum(info.document.metadata.get("n_chunks", 1)
+               for info in diverse) == 4
+    by_video: Dict[str, List[Tuple[float, float]]] = {}
+    for info in diverse:
+        metadata = info.document.metadata
+        by_video.setdefault(metadata["title"], []).append(
+            (metadata["start"], metadata["start"] + metadata["duration"])
+        )
+    for video_spans in by_video.values():
+        video_spans.sort()
+        for (_, end), (start, _) in zip(video_spans, video_spans[1:]):
+            assert start > end
+
+
+def test_routed_search_only_scores_the_closest_videos(retriever):
+    question_embeddings = retriever.video_embeddings[1][[0, 5]]
+    normalized = retriever_module._normalize_rows(question_embeddings)
+
+    np.testing.assert_array_equal(retriever.route(normalized, 1), [[1], [1]])
+    results = retriever.search(question_embeddings, n_documents=3,
+                               n_videos=1)
+    title = retriever.documents[1][0].metadata["title"]
+    for chunk, document_infos in zip((0, 5), results):
+        assert document_infos[0].document.metadata["index"] == chunk
+        assert all(document_info.document.metadata["title"] == title
+                   for document_info in document_infos)
+
+    exact = retriever.search(question_embeddings, n_documents=3)
+    assert retriever.search(question_embeddings, n_documents=3,
+                            n_videos=2) == exact
+
+
+@pytest.fixture
+def scoring_workers():
+    n_workers = retriever_module.get_scoring_workers()
+    yield retriever_module.set_scoring_workers
+    retriever_module.set_scoring_workers(n_workers)
+
+
+def test_sharded_search_matches_serial_search(retriever, monkeypatch,
+                                              scoring_workers):
+    question_embeddings = retriever.video_embeddings[0][:4]
+    expected = retriever.search(question_embeddings, n_documents=8)
+
+    monkeypatch.setattr(retriever_module, "MIN_SHARD_SIZE", 7)
+    monkeypatch.setattr(retriever_module, "DOCUMENT_BLOCK_SIZE", 5)
+    scoring_workers(3)
+    results = retriever.search(question_embeddings, n_documents=8)
+
+    for document_infos, expected_infos in zip(results, expected):
+        assert [info.document for info in document_infos] == \
+            [info.document for info in expected_infos]
+        np.testing.assert_allclose([info.score for info in document_infos],
+                                   [info.score for info in expected_infos],
+                                   rtol=1e-5)
+    with pytest.raises(ValueError):
+        scoring_workers(0)
+
+
+def test_sharded_search_while_the_workers_change(retriever, monkeypatch,
+                                                 scoring_workers):
+    question_embeddings = retriever.video_embeddings[0][:4]
+    monkeypatch.setattr(retriever_module, "MIN_SHARD_SIZE", 7)
+    scoring_workers(3)
+    done = threading.Event()
+
+    def change_workers():
+        while not done.is_set():
+            scoring_workers(2)
+            scoring_workers(3)
+
+    thread = threading.Thread(target=change_workers)
+    thread.start()
+    try:
+        for _ in range(200):
+            retriever.search(question_embeddings, n_documents=8)
+    finally:
+        done.set()
+        thread.join()
+
+
+def test_retrieve_batch_searches_retrievers_in_parallel(
+        scoring_workers, make_lookup_embeddings):
+    retrievers = [Retriever(RETRIEVER_DIRECTORY) for _ in range(3)]
+    for retriever in retrievers:
+        retriever._embedding_model = make_lookup_embeddings(retriever)
+    scoring_workers(1)
+    expected = Retriever.retrieve_batch(retrievers, ["0:1", "1:2"], 4)
+
+    scoring_workers(3)
+    results = Retriever.retrieve_batch(retrievers, ["0:1", "1:2"], 4)
+
+    assert [[info.score for info in infos] for infos in results] == \
+        [[info.score for info in infos] for infos in expected]
+    assert results[1][0].document.metadata["index"] == 2
+
+
+def test_retrieve_batch_searches_retrievers_in_the_scoring_threads(
+        scoring_workers, make_lookup_embeddings, monkeypatch):
+    retrievers = [Retriever(RETRIEVER_DIRECTORY) for _ in range(3)]
+    for retriever in retrievers:
+        retriever._embedding_model = make_lookup_embeddings(retriever)
+    expected = Retriever.retrieve_batch(retrievers, ["0:1", "1:2"], 4)
+
+    thread_names = []
+    search = Retriever.search
+
+    def recording_search(self, *args, **kwargs):
+        thread_names.append(threading.current_thread().name)
+        return search(self, *args, **kwargs)
+
+    monkeypatch.setattr(Retriever, "search", recording_search)
+    # The shards of the retrievers would wait for the busy scoring threads
+    monkeypatch.setattr(retriever_module, "MIN_SHARD_SIZE", 7)
+    scoring_workers(2)
+    results = Retriever.retrieve_batch(retrievers, ["0:1", "1:2"], 4)
+
+    assert [[info.score for info in infos] for infos in results] == \
+        [[info.score for info in infos] for infos in expected]
+    assert len(thread_names) == 3
+    assert all(name.startswith("scoring") for name in thread_names)
+
+
+@pytest.fixture(scope="module")
+def chroma_retriever_directory(tmp_path_factory) -> pathlib.Path:
+    """Copies the retriever of the fixtures and stores its chunks in a
+    Chroma collection."""
+    pytest.importorskip("chromadb")
+    directory = tmp_path_factory.mktemp("azure") / RETRIEVER_DIRECTORY.name
+    shutil.copytree(RETRIEVER_DIRECTORY, directory)
+    with open(directory / "hyperparams.yaml", "r") as file:
+        config = yaml.safe_load(file)
+    config["vector_store"] = "chroma-db"
+    with open(directory / "hyperparams.yaml", "w") as file:
+        yaml.dump(config, file)
+
+    vector_store = ChromaVectorStore(directory / "chroma")
+    for video_name in ("Video_1", "Video_2"):
+        with open(directory / "chunked_data" / f"{video_name}.json") as file:
+            chunks = json.load(file)
+        embeddings = np.load(directory / "embeddings" / f"{video_name}.npy")
+        vector_store.upsert_video(video_name, chunks, embeddings)
+    # Upserting a video again replaces its chunks
+    vector_store.upsert_video(video_name, chunks, embeddings)
+    vector_store.persist()
+    return directory
+
+
+def test_chroma_search_matches_in_memory_search(retriever,
+                                                chroma_retriever_directory):
+    chroma_retriever = Retriever(chroma_retriever_directory)
+    question_embeddings = retriever.video_embeddings[1][[0, 5]]
+
+    assert chroma_retriever.vector_store_type == "chroma-db"
+    assert chroma_retriever.total_number_of_documents == \
+        retriever.total_number_of_documents
+    assert chroma_retriever._chunks is None
+
+    expected = retriever.search(question_embeddings, n_documents=5)
+    results = chroma_retriever.search(question_embeddings, n_documents=5)
+    for document_infos, expected_infos in zip(results, expected):
+        assert [info.document.page_content for info in document_infos] == \
+            [info.document.page_content for info in expected_infos]
+        assert [info.document.metadata for info in document_infos] == \
+            [info.document.metadata for info in expected_infos]
+        np.testing.assert_allclose([info.score for info in document_infos],
+                                   [info.score for info in expected_infos],
+                                   rtol=1e-4)
+
+
+def test_chroma_search_only_fetches_the_embeddings_for_mmr(
+        retriever, chroma_retriever_directory, monkeypatch):
+    chroma_retriever = Retriever(chroma_retriever_directory)
+    vector_store = chroma_retriever.vector_store
+    assert vector_store is not None
+    includes: List[List[str]] = []
+    collection_type = type(vector_store._collection)
+    query = collection_type.query
+
+    def recording_query(collection, *args, **kwargs):
+        includes.append(kwargs["include"])
+        return query(collection, *args, **kwargs)
+
+    # The collection is a pydantic model, so its class is patched
+    monkeypatch.setattr(collection_type, "query", recording_query)
+    question_embedding = retriever.video_embeddings[0][:1]
+    chroma_retriever.search(question_embedding, n_documents=4)
+    chroma_retriever.search(question_embedding, n_documents=4,
+                            mmr_lambda=0.5)
+
+    assert ["embeddings" in include for include in includes] == \
+        [False, True]
+
+
+def test_chroma_search_diversifies_like_in_memory_search(
+        retriever, chroma_retriever_directory):
+    chroma_retriever = Retriever(chroma_retriever_directory)
+    question_embedding = _mixed_question(retriever)
+
+    expected = retriever.search(question_embedding, n_documents=4,
+                                mmr_lambda=0.5)
+    results = chroma_retriever.search(question_embedding, n_documents=4,
+                                      mmr_lambda=0.5)
+    assert [info.document.page_content for info in results[0]] == \
+        [info.document.page_content for info in expected[0]]
+
+
+def test_chroma_search_supports_filters(retriever,
+                                        chroma_retriever_directory):
+    chroma_retriever = Retriever(chroma_retriever_directory)
+    question_embedding = retriever.video_embeddings[0][:1]
+
+    results = chroma_retriever.search(question_embedding, n_documents=5,
+                                      where={"start": {"$gte": 60}})
+
+    assert len(results[0]) == 5
+    assert all(document_info.document.metadata["start"] >= 60
+               for document_info in results[0])
+
+
+if __name__ == "__main__":
+    pytest.main()
@@ -0,0 +1,87 @@
+import asyncio
+import pathlib
+from typing import List
+
+import pytest
+from aiohttp.test_utils import TestClient, TestServer
+
+from ask_youtube_playlists.question_answering import Retriever
+from ask_youtube_playlists.service import (MicroBatcher, QueryService,
+                                           create_app)
+
+RETRIEVER_DIRECTORY = pathlib.Path(__file__).parent.joinpath(
+    "data", "azure", "msmarco-MiniLM-L-6-v3_320_64"
+)
+
+
+def test_micro_batcher_coalesces_concurrent_items():
+    batches: List[List[int]] = []
+
+    def process_batch(items):
+        batches.append(items)
+        return [item * 2 for item in items]
+
+    async def run():
+        batcher = MicroBatcher(process_batch, max_batch_size=4, max_wait=0.05)
+        try:
+            return await asyncio.gather(*(batcher.submit(i)
+                                          for i in range(6)))
+        finally:
+            batcher.close()
+
+    assert asyncio.run(run()) == [0, 2, 4, 6, 8, 10]
+    assert batches == [[0, 1, 2, 3], [4, 5]]
+
+
+def test_micro_batcher_propagates_errors():
+    def process_batch(items):
+        raise RuntimeError("Model failure")
+
+    async def run():
+        batcher = MicroBatcher(process_batch)
+        try:
+            await batcher.submit(1)
+        finally:
+            batcher.close()
+
+    with pytest.raises(RuntimeError):
+        asyncio.run(run())
+
+
+def test_retrieve_endpoint_batches_questions(make_lookup_embeddings):
+    retriever = Retriever(RETRIEVER_DIRECTORY)
+    embeddings = make_lookup_embeddings(retriever)
+    retriever._embedding_model = embeddings
+    service = QueryService({"azure/model": retriever},
+                           extractive_model_name=None, batch_window=0.05)
+
+    async def run():
+        async with TestClient(TestServer(create_app(service))) as client:
+            health = await (await client.get("/health")).json()
+            assert health["retrievers"] == ["azure/model"]
+
+            responses = await asyncio.gather(*(
+                client.post("/retrieve", json={"question": f"1:{chunk}",
+                                               "n_documents": 2})
+                for chunk in (0, 5)
+            ))
+            results = [await response.json() for response in responses]
+
+            bad_response = await client.post(
+                "/retrieve", json={"question": "1:0", "retrievers": ["x"]}
+            )
+            assert bad_response.status == 400
+        return results
+
+    results = asyncio.run(run())
+
+    assert embeddings.batches == [["1:0", "1:5"]]
+    for chunk, result in zip((0, 5), results):
+        documents = result["documents"]
+        assert len(documents) == 2
+        assert documents[0]["metadata"]["index"] == chunk
+        assert documents[0]["score"] == pytest.approx(1, abs=1e-5)
+
+
+if __name__ == "__main__":
+    pytest.main()
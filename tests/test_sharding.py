@@ -0,0 +1,146 @@
+import pathlib
+import shutil
+import socket
+import subprocess
+import sys
+import threading
+import time
+import urllib.request
+
+import pytest
+
+from ask_youtube_playlists.question_answering import Retriever
+from ask_youtube_playlists.question_answering import retriever as \
+    retriever_module
+from ask_youtube_playlists.sharding import ShardedRetriever, search_retrievers
+
+RETRIEVER_DIRECTORY = pathlib.Path(__file__).parent.joinpath(
+    "data", "azure", "msmarco-MiniLM-L-6-v3_320_64"
+)
+
+
+def _free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def _wait_until_ready(url: str, process: subprocess.Popen) -> None:
+    deadline = time.monotonic() + 60
+    while time.monotonic() < deadline:
+        assert process.poll() is None, "The shard server exited"
+        try:
+            urllib.request.urlopen(f"{url}/health", timeout=1).close()
+            return
+        except OSError:
+            time.sleep(0.2)
+    raise TimeoutError(f"The shard server {url} did not start")
+
+
+@pytest.fixture(scope="module")
+def shard_urls(tmp_path_factory):
+    """Splits the videos of the retriever of the fixtures in two retrievers
+    and serves each from its own shard process."""
+    tmp_path = tmp_path_factory.mktemp("shards")
+    processes = []
+    urls = []
+    for video in ("Video_1", "Video_2"):
+        directory = tmp_path / video / RETRIEVER_DIRECTORY.name
+        shutil.copytree(RETRIEVER_DIRECTORY, directory)
+        for other in directory.glob("*/Video_*"):
+            if other.stem != video:
+                other.unlink()
+        port = _free_port()
+        processes.append(subprocess.Popen(
+            [sys.executable, "-m", "ask_youtube_playlists.cli",
+             "shard-serve", "--retriever", str(directory),
+             "--port", str(port)],
+        ))
+        urls.append(f"http://127.0.0.1:{port}")
+    try:
+        for url, process in zip(urls, processes):
+            _wait_until_ready(url, process)
+        yield urls
+    finally:
+        for process in processes:
+            process.terminate()
+            process.wait()
+
+
+@pytest.fixture
+def hanging_url():
+    """A server that accepts connections but never answers."""
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        sock.listen()
+        yield f"http://127.0.0.1:{sock.getsockname()[1]}"
+
+
+def _summarize(results):
+    return [[(info.document.metadata["url"], info.document.metadata["index"],
+              round(info.score, 4)) for info in document_infos]
+            for document_infos in results]
+
+
+def test_search_retrievers_scores_the_retrievers_in_parallel(monkeypatch):
+    retrievers = [Retriever(RETRIEVER_DIRECTORY) for _ in range(3)]
+    question_embeddings = retrievers[0].video_embeddings[1][[0, 5]]
+    expected = retrievers[0].search(question_embeddings, n_documents=4)
+
+    thread_names = []
+    search = Retriever.search
+
+    def recording_search(self, *args, **kwargs):
+        thread_names.append(threading.current_thread().name)
+        return search(self, *args, **kwargs)
+
+    monkeypatch.setattr(Retriever, "search", recording_search)
+    n_workers = retriever_module.get_scoring_workers()
+    retriever_module.set_scoring_workers(3)
+    try:
+        results = search_retrievers(retrievers, question_embeddings, 4)
+    finally:
+        retriever_module.set_scoring_workers(n_workers)
+
+    assert [[info.score for info in infos] for infos in results] == \
+        [sorted([info.score for info in infos] * 3, reverse=True)[:4]
+         for infos in expected]
+    assert len(thread_names) == 3
+    assert all(name.startswith("scoring") for name in thread_names)
+
+
+def test_sharded_search_matches_local_search(shard_urls):
+    retriever = Retriever(RETRIEVER_DIRECTORY)
+    question_embeddings = retriever.video_embeddings[1][[0, 5]]
+    expected = retriever.search(question_embeddings, n_documents=6)
+
+    with ShardedRetriever(shard_urls) as sharded:
+        assert sharded.embedding_model_name == \
+            retriever.embedding_model_name
+        results = sharded.search(question_embeddings, n_documents=6)
+
+    assert _summarize(results) == _summarize(expected)
+    assert {info.playlist_name for info in results[0]} <= \
+        {"Video_1", "Video_2"}
+
+
+def test_sharded_search_skips_shards_that_time_out(shard_urls, hanging_url):
+    retriever = Retriever(RETRIEVER_DIRECTORY)
+    question_embeddings = retriever.video_embeddings[1][[0]]
+    expected = retriever.search(question_embeddings, n_documents=3)
+
+    with ShardedRetriever(shard_urls + [hanging_url], timeout=0.5,
+                          embedding_model_name="msmarco-MiniLM-L-6-v3"
+                          ) as sharded:
+        start = time.perf_counter()
+        results = sharded.search(question_embeddings, n_documents=3)
+        assert time.perf_counter() - start < 2
+        assert _summarize(results) == _summarize(expected)
+
+        sharded.allow_partial = False
+        with pytest.raises(RuntimeError):
+            sharded.search(question_embeddings, n_documents=3)
+
+
+if __name__ == "__main__":
+    pytest.main()
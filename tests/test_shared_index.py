@@ -0,0 +1,79 @@
+import os
+import pathlib
+import shutil
+
+import numpy as np
+import pytest
+
+from ask_youtube_playlists.data_processing import shared_index
+from ask_youtube_playlists.question_answering import Retriever
+
+RETRIEVER_DIRECTORY = pathlib.Path(__file__).parent.joinpath(
+    "data", "azure", "msmarco-MiniLM-L-6-v3_320_64"
+)
+
+
+@pytest.fixture
+def retriever_directory(tmp_path) -> pathlib.Path:
+    directory = tmp_path / "azure" / RETRIEVER_DIRECTORY.name
+    shutil.copytree(RETRIEVER_DIRECTORY, directory)
+    return directory
+
+
+def test_shared_index_is_reference_counted(retriever_directory):
+    index_path = shared_index.get_index_path(retriever_directory).resolve()
+
+    first = shared_index.acquire_shared_index(retriever_directory)
+    second = shared_index.acquire_shared_index(retriever_directory)
+
+    assert first is second
+    assert isinstance(first, np.memmap)
+    assert not first.flags.writeable
+    np.testing.assert_allclose(np.linalg.norm(first, axis=1), 1, rtol=1e-5)
+    assert shared_index.get_shared_index_references()[index_path] == 2
+    shared_index.release_shared_index(retriever_directory)
+    assert shared_index.get_shared_index_references()[index_path] == 1
+    shared_index.release_shared_index(retriever_directory)
+    assert index_path not in shared_index.get_shared_index_references()
+
+
+def test_shared_index_is_rebuilt_when_outdated(retriever_directory):
+    assert shared_index.is_index_outdated(retriever_directory)
+    index_path = shared_index.build_index(retriever_directory)
+    assert not shared_index.is_index_outdated(retriever_directory)
+
+    embeddings_path = retriever_directory / "embeddings" / "Video_1.npy"
+    future = index_path.stat().st_mtime + 10
+    os.utime(embeddings_path, (future, future))
+    assert shared_index.is_index_outdated(retriever_directory)
+
+
+def test_memory_mapped_retriever_matches_in_memory_retriever(
+        retriever_directory):
+    retriever = Retriever(retriever_directory)
+    question_embeddings = retriever.video_embeddings[1][[0, 5]]
+    expected = retriever.search(question_embeddings, n_documents=4)
+
+    with Retriever(retriever_directory, memory_map=True) as mapped:
+        results = mapped.search(question_embeddings, n_documents=4)
+        routed = mapped.search(question_embeddings, n_documents=4,
+                               n_videos=1)
+        assert mapped._video_embeddings is None
+        assert isinstance(mapped.embedding_matrix, np.memmap)
+        assert mapped.total_number_of_documents == \
+            retriever.total_number_of_documents
+
+    assert shared_index.get_shared_index_references() == {}
+    with pytest.raises(ValueError):
+        mapped.search(question_embeddings, n_documents=4)
+    for document_infos, expected_infos in zip(results, expected):
+        assert [info.document for info in document_infos] == \
+            [info.document for info in expected_infos]
+        np.testing.assert_allclose([info.score for info in document_infos],
+                                   [info.score for info in expected_infos],
+                                   rtol=1e-5)
+    assert routed[0][0].document == expected[0][0].document
+
+
+if __name__ == "__main__":
+    pytest.main()
@@ -5,6 +5,7 @@ from ask_youtube_playlists.data_processing import (download_playlist,
                                                    is_youtube_playlist,
                                                    get_available_directories
                                                    )
+from ask_youtube_playlists.reporting import StreamlitReporter
 
 
 def get_data_directory() -> pathlib.Path:
@@ -82,7 +83,7 @@ def main():
 
                 download_playlist(youtube_link,
                                   raw_path,
-                                  use_st_progress_bar=True,
+                                  reporter=StreamlitReporter(),
                                   )
                 st.session_state["loaded_playlist_names"].append(playlist_name)
                 st.experimental_rerun()
@@ -1,10 +1,15 @@
+import os
 import pathlib
+import time
+
 import streamlit as st
 import dotenv
 
-from ask_youtube_playlists.data_processing import (EMBEDDING_MODELS_NAMES,
-                                                   create_embeddings_pipeline,
-                                                   )
+from ask_youtube_playlists.data_processing import (
+    EMBEDDING_MODELS_NAMES,
+    get_retriever_directory_name,
+)
+from ask_youtube_playlists.jobs import read_job_status, start_embedding_job
 
 st.set_page_config(
     page_title="Create Embeddings",
@@ -27,6 +32,12 @@ def get_data_directory() -> pathlib.Path:
 
 st.title("Extractive Question Answering")
 
+# Seconds between two refreshes of the status of a running job
+POLL_INTERVAL = 2
+
+# `st.rerun` replaces `st.experimental_rerun` from Streamlit 1.27 onwards
+rerun = getattr(st, "rerun", None) or getattr(st, "experimental_rerun")
+
 # ---------------------------------------------------------------------
 with st.sidebar:
     st.markdown("""
@@ -59,6 +70,34 @@ with st.sidebar:
 # --------------------------------------------------------------------
 
 
+def show_job_status(retriever_dir: pathlib.Path) -> None:
+    """Shows the status of the embedding job of a retriever and, while it
+    runs, refreshes the page to poll it."""
+    status = read_job_status(retriever_dir)
+    if status is None:
+        return
+    videos_total = status["videos_total"]
+    if status["status"] in ("queued", "running"):
+        if status["status"] == "queued":
+            st.info("Waiting for another embedding job to finish...")
+        elif videos_total:
+            st.progress(status["videos_done"] / videos_total,
+                        f"{status['videos_done']}/{videos_total} videos, "
+                        f"{status['chunks_per_second']:.1f} chunks/s")
+        else:
+            st.progress(0.0, "Loading the embedding model...")
+        time.sleep(POLL_INTERVAL)
+        rerun()
+    elif status["status"] == "completed":
+        st.success(f"Embedded {videos_total} videos "
+                   f"({status['videos_skipped']} from a previous run).")
+    elif status["status"] == "interrupted":
+        st.warning(f"The job was interrupted after {status['videos_done']} "
+                   f"videos. Create the embeddings again to resume it.")
+    else:
+        st.error(f"The job failed: {status['error']}")
+
+
 def main():
     if "loaded_playlist_names" not in st.session_state:
         st.session_state["loaded_playlist_names"] = []
@@ -69,20 +108,31 @@ def main():
         playlist_name = st.selectbox("Select Loaded Playlist",
                                      playlist_list)
 
+        embedding_dir_name = get_retriever_directory_name(
+            embedding_model_name, chunk_size, overlap
+        )
+
+        data_directory_parent = get_data_directory().parent
+        data_directory = data_directory_parent / "data"
+
+        # The select boxes have options, so they always return one
+        assert playlist_name is not None
+        assert embedding_model_name is not None
+        playlist_dir = data_directory / playlist_name
+        retriever_dir = playlist_dir / embedding_dir_name
         if st.button("Create Embeddings"):
-            embedding_dir_name = f"{embedding_model_name}_" \
-                                 f"{chunk_size}_{overlap}"
-
-            data_directory_parent = get_data_directory().parent
-            data_directory = data_directory_parent / "data"
-
-            playlist_dir = data_directory / playlist_name  # type: ignore
-            retriever_dir = playlist_dir / embedding_dir_name
-            create_embeddings_pipeline(retriever_dir,
-                                       embedding_model_name,  # type: ignore
-                                       max_chunk_size=chunk_size,
-                                       min_overlap_size=overlap,
-                                       use_st_progress_bar=True)
+            # The job runs in the background and resumes from the videos
+            # embedded by previous runs, so refreshing the page loses nothing
+            start_embedding_job(
+                retriever_dir,
+                embedding_model_name,
+                max_chunk_size=chunk_size,
+                min_overlap_size=overlap,
+                max_concurrent_jobs=int(
+                    os.environ.get("EMBEDDING_JOBS_PER_HOST", 1)
+                ),
+            )
+        show_job_status(retriever_dir)
     else:
         st.error("No playlists loaded. Please load a playlist first.")
 
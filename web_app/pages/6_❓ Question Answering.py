@@ -1,14 +1,19 @@
+import os
 import pathlib
 import streamlit as st
 
 import dotenv
 
+from ask_youtube_playlists import caching, instrumentation
 from ask_youtube_playlists.data_processing import get_available_directories
 from ask_youtube_playlists.question_answering import (
     get_extractive_answer,
     get_generative_answer,
+    rerank,
+    search_extractive_answers,
     EXTRACTIVE_MODEL_NAMES,
     GENERATIVE_MODEL_NAMES,
+    RERANKER_MODEL_NAMES,
     Retriever,
 )
 
@@ -20,6 +25,20 @@ st.set_page_config(
 # Load OPENAI_API_KEY from .env file
 dotenv.load_dotenv()
 
+# Share the answers between sessions with Streamlit's cache, or between
+# restarts and replicas with a SQLite file set in ANSWER_CACHE_PATH
+answer_cache_path = os.environ.get("ANSWER_CACHE_PATH")
+if answer_cache_path:
+    if not isinstance(caching.get_cache_backend(), caching.SQLiteCache):
+        answer_cache_ttl = os.environ.get("ANSWER_CACHE_TTL_HOURS")
+        caching.set_cache_backend(caching.SQLiteCache(
+            answer_cache_path,
+            ttl=(float(answer_cache_ttl) * 3600 if answer_cache_ttl
+                 else None),
+        ))
+elif not isinstance(caching.get_cache_backend(), caching.StreamlitCache):
+    caching.set_cache_backend(caching.StreamlitCache())
+
 
 def get_data_directory() -> pathlib.Path:
     """Returns the path to the data directory."""
@@ -78,10 +97,13 @@ with st.sidebar:
         generative_model = st.selectbox("Select a Generative Model",
                                         generative_models,
                                         key="generative_model")
+        # The select box has options, so it always returns one
+        assert generative_model is not None
     elif mode == "extractive":
         extractive_model = st.selectbox("Select an Extractive Model",
                                         extractive_models,
                                         key="extractive_model")
+        assert extractive_model is not None
     st.header("Set hyperparameters")
     if mode == 'generative':
         # slider to choose temperature
@@ -96,6 +118,21 @@ with st.sidebar:
                                max_value=8000,
                                value=50,
                                step=10)
+        map_reduce = st.checkbox("Answer groups of documents and combine "
+                                 "the answers (map-reduce)",
+                                 value=False,
+                                 help="Needed when the documents do not fit "
+                                      "in the context of the model.")
+    elif mode == "extractive":
+        stop_early = st.checkbox("Stop at the first confident answer",
+                                 value=True)
+        if stop_early:
+            answer_threshold = st.slider("Select the answer score that "
+                                         "stops the search",
+                                         min_value=0.0,
+                                         max_value=1.0,
+                                         value=0.5,
+                                         step=0.05)
 
     max_retrieved_docs = 100 if mode == "generative" else 10
     n_retrieved_docs = st.slider("Select number of returned documents",
@@ -104,6 +141,30 @@ with st.sidebar:
                                  value=10,
                                  step=1)
 
+    diversify = st.checkbox("Diversify the documents and merge adjacent "
+                            "chunks", value=False)
+    mmr_lambda = None
+    if diversify:
+        mmr_lambda = st.slider("Relevance against diversity",
+                               min_value=0.0,
+                               max_value=1.0,
+                               value=0.5,
+                               step=0.05)
+
+    use_reranker = st.checkbox("Re-rank with a cross-encoder", value=False)
+    if use_reranker:
+        reranker_model = st.selectbox("Select a Cross-Encoder",
+                                      RERANKER_MODEL_NAMES,
+                                      key="reranker_model")
+        rerank_budget_ms = st.slider("Re-ranking budget (ms)",
+                                     min_value=50,
+                                     max_value=2000,
+                                     value=300,
+                                     step=50)
+
+    st.header("Diagnostics")
+    show_timings = st.checkbox("Show timing breakdown", value=False)
+
 # -----------------------------------------------------------------------------
 
 if "answer" not in st.session_state:
@@ -116,6 +177,11 @@ if "relevant_documents" not in st.session_state:
     st.session_state["relevant_documents"] = []
 
 
+# Records the spans of this run to show where the time goes
+span_recorder = instrumentation.SpanRecorder()
+if show_timings:
+    span_recorder.start()
+
 # Playlist selection, multiple playlists can be selected
 # From st.session_state["loaded_playlist_names"] create checkboxes
 # for each playlist
@@ -135,7 +201,12 @@ for playlist_name in st.session_state["loaded_playlist_names"]:
                                       key=playlist_name + "_retriever")
 
         retriever_path = playlist_directory / selected_retriever
-        retriever = Retriever(retriever_path)
+        # Processes of the same host share the embeddings with
+        # RETRIEVER_MEMORY_MAP=1
+        retriever = Retriever(
+            retriever_path,
+            memory_map=os.environ.get("RETRIEVER_MEMORY_MAP") == "1",
+        )
         st.write(retriever.video_embeddings)
         retrievers.append(retriever)
 
@@ -147,20 +218,52 @@ if retrievers:
     if question:
 
         # Retrieve relevant documents
-        relevant_documents = Retriever.retrieve(retrievers,
-                                                question,
-                                                n_retrieved_docs)
+        if use_reranker:
+            candidates = Retriever.retrieve(retrievers,
+                                            question,
+                                            4 * n_retrieved_docs,
+                                            mmr_lambda=mmr_lambda)
+            relevant_documents = rerank(
+                question,
+                candidates,
+                n_retrieved_docs,
+                model_name=reranker_model,
+                latency_budget=rerank_budget_ms / 1000,
+            )
+        else:
+            relevant_documents = Retriever.retrieve(retrievers,
+                                                    question,
+                                                    n_retrieved_docs,
+                                                    mmr_lambda=mmr_lambda)
 
         st.write(relevant_documents)
 
-        if mode == "extractive":
+        if mode == "extractive" and stop_early:
+            st.subheader("Extractive Answer")
+            answers = search_extractive_answers(
+                question,
+                [document_info.document.page_content
+                 for document_info in relevant_documents],
+                extractive_model,
+                score_threshold=answer_threshold,
+            )
+            st.caption(f"Read {len(answers)} of {len(relevant_documents)} "
+                       "documents.")
+            for i, found_answer in enumerate(answers, start=1):
+                context_index = found_answer["context_index"]
+                document_info = relevant_documents[context_index]
+                playlist_name = document_info.playlist_name
+                with st.expander(f"Answer {i} from {playlist_name}"):
+                    st.write(found_answer)
+
+        elif mode == "extractive":
             st.subheader("Extractive Answer")
             for i, document_info in enumerate(relevant_documents, start=1):
 
                 answer = get_extractive_answer(
                     question,
                     document_info.document.page_content,
-                    extractive_model,  # type: ignore
+                    extractive_model,
                 )
                 playlist_name = document_info.playlist_name
                 # Expand the answer
@@ -174,9 +277,10 @@ if retrievers:
             answer = get_generative_answer(
                 question,
                 relevant_documents=docs,
-                model_name=generative_model,  # type: ignore
+                model_name=generative_model,
                 temperature=temperature,
-                max_length=max_length
+                max_length=max_length,
+                map_reduce=map_reduce,
             )
             st.write(answer)
             st.write(relevant_documents)
@@ -188,3 +292,16 @@ if retrievers:
                 # Expand the answer
                 with st.expander(f"Document {i} from {playlist_name}"):
                     st.write(answer)
+
+if show_timings:
+    span_recorder.stop()
+    st.subheader("Timing Breakdown")
+    breakdown = span_recorder.breakdown()
+    if breakdown:
+        st.table(breakdown)
+    else:
+        st.caption("No instrumented steps were executed in this run.")
+    cache_backend = caching.get_cache_backend()
+    if isinstance(cache_backend, caching.SQLiteCache):
+        st.subheader("Answer Cache")
+        st.table(cache_backend.stats())